@@ -0,0 +1,31 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+# Times create_manifest_from_json for growing manifests. The time per row should stay
+# about the same. Run from submissions-api/app with:
+#   python -m benchmarks.create_manifest
+
+import time
+
+from main.manifest_utils import create_manifest_from_json
+
+
+def time_per_row(rows):
+    body = {'samples': [{'row': row,
+                         'SPECIMEN_ID': 'SAN' + str(row).zfill(7),
+                         'TAXON_ID': 6344,
+                         'SCIENTIFIC_NAME': 'Arenicola marina',
+                         'LIFESTAGE': 'ADULT',
+                         'SEX': 'FEMALE',
+                         'ORGANISM_PART': 'MUSCLE',
+                         'EXTRA_FIELD': 'extra'}
+                        for row in range(1, rows + 1)]}
+    start = time.perf_counter()
+    create_manifest_from_json(body, None)
+    return (time.perf_counter() - start) / rows
+
+
+if __name__ == '__main__':
+    for rows in [1000, 10000, 50000]:
+        print(str(rows) + ' rows: ' + format(time_per_row(rows) * 1e6, '.1f') + ' us per row')
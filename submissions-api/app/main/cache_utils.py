@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import threading
+import time
+from collections import OrderedDict
+
+# All the caches in this worker, by name, so their statistics can be reported
+caches = {}
+
+
+class TTLCache:
+    """A bounded, thread-safe cache which discards the least recently used entry
+    when full and treats entries older than their time-to-live as missing"""
+
+    def __init__(self, name, maxsize, ttl, timer=time.monotonic):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        caches[name] = self
+
+    def get(self, key):
+        """Returns (True, value) if the key is cached and in date, otherwise (False, None)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.timer():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (self.timer() + (self.ttl if ttl is None else ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries),
+                    'maxSize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+def get_cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def clear_caches():
+    for cache in caches.values():
+        cache.clear()
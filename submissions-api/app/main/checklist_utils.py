@@ -0,0 +1,82 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+# The checklist samples are validated against. Each version is a file in checklists/, so
+# a new version can be used by adding its file and setting ENA_CHECKLIST
+DEFAULT_CHECKLIST = 'ERC000053'
+
+_checklist = None
+_checklist_lock = threading.Lock()
+
+
+class EnaChecklist:
+    """An ENA checklist with its patterns compiled and allowed values lowercased, ready to
+    validate any number of samples"""
+
+    def __init__(self, checklist):
+        self.checklist = checklist['checklist']
+        # Changes whenever the rules do, even if the checklist's name doesn't
+        self.digest = hashlib.sha256(json.dumps(checklist, sort_keys=True)
+                                     .encode('utf-8')).hexdigest()
+        self.checks = tuple((check['name'],
+                             check.get('field', check['name']),
+                             check['mandatory'],
+                             re.compile(check['regex']) if 'regex' in check else None,
+                             frozenset(x.lower() for x in check['allowed_values'])
+                             if 'allowed_values' in check else None)
+                            for check in checklist['fields'])
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def validate(self, ena_fields):
+        """Checks a sample's ENA fields (from SubmissionsSample.to_ena_dict)"""
+        results = []
+        for name, field_name, mandatory, regex, allowed_values in self.checks:
+            if name not in ena_fields:
+                if mandatory:
+                    results.append({'field': field_name,
+                                    'message': 'Must be given',
+                                    'severity': 'ERROR'})
+                continue
+            value = ena_fields[name]['value']
+            if mandatory and value == '':
+                results.append({'field': field_name,
+                                'message': 'Must not be empty',
+                                'severity': 'ERROR'})
+                continue
+
+            if regex is not None and not regex.search(value):
+                results.append({'field': field_name,
+                                'message': 'Must match specific pattern',
+                                'severity': 'ERROR'})
+
+            if allowed_values is not None and value.lower() not in allowed_values:
+                results.append({'field': field_name,
+                                'message': 'Must be in allowed values',
+                                'severity': 'ERROR'})
+        return results
+
+
+def get_checklist_path(checklist):
+    return os.path.join(os.path.dirname(__file__), 'checklists', checklist + '.json')
+
+
+def get_ena_checklist():
+    # Loaded once per worker
+    global _checklist
+    if _checklist is None:
+        with _checklist_lock:
+            if _checklist is None:
+                _checklist = EnaChecklist.from_file(
+                    get_checklist_path(os.getenv('ENA_CHECKLIST', DEFAULT_CHECKLIST)))
+    return _checklist
@@ -20,9 +20,9 @@ from jwt.exceptions import (
     JWTDecodeError,
 )
 
+from main.http_utils import get_session
 from main.model import SubmissionsState, SubmissionsUser, db
 
-import requests
 from requests.auth import HTTPBasicAuth
 
 
@@ -87,16 +87,16 @@ def get_token_from_callback(body=None):
     post_data = {'grant_type': 'authorization_code',
                  'code': body['code'],
                  'redirect_uri': os.getenv('ELIXIR_REDIRECT_URI')}
-    response = requests.post('https://login.elixir-czech.org/oidc/token',
-                             auth=client_auth,
-                             data=post_data)
+    response = get_session('elixir').post('https://login.elixir-czech.org/oidc/token',
+                                          auth=client_auth,
+                                          data=post_data)
     return jsonify(response.json())
 
 
 def create_user_profile(body=None):
     # Get the user infromation from Elixir for this token
-    response = requests.get('https://login.elixir-czech.org/oidc/userinfo',
-                            headers={'Authorization': 'Bearer ' + body['token']})
+    response = get_session('elixir').get('https://login.elixir-czech.org/oidc/userinfo',
+                                         headers={'Authorization': 'Bearer ' + body['token']})
     user_info_from_elixir = response.json()
     if user_info_from_elixir.get('error') is None:
         user = db.session.query(SubmissionsUser) \
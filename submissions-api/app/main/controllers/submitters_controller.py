@@ -2,33 +2,50 @@
 #
 # SPDX-License-Identifier: MIT
 
-import os
-
 import connexion
 
-from flask import jsonify
+from flask import Response, json, jsonify, stream_with_context
 
+import main.job_utils as job_utils
 import main.manifest_utils as manifest_utils
-from main.model import SubmissionsManifest, SubmissionsRole, \
+from main.cache_utils import get_cache_stats
+from main.manifest_utils import get_manifest_with_samples
+from main.model import SubmissionsJob, SubmissionsManifest, SubmissionsRole, \
     SubmissionsSample, SubmissionsUser, db
+from main.specimen_utils import get_samples_sts
 
-import requests
-
-from sqlalchemy import or_
+from sqlalchemy import func, or_
+from sqlalchemy.orm import joinedload, raiseload
 
 
-def get_manifests():
+def get_manifests(limit=100, cursor=None):
     role = db.session.query(SubmissionsRole) \
         .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
         .filter(SubmissionsRole.user_id == connexion.context['user']) \
         .one_or_none()
     if role is None:
         return jsonify({'detail': 'User does not have permission to use this function'}), 403
-    manifests = db.session.query(SubmissionsManifest) \
-        .order_by(SubmissionsManifest.manifest_id.desc()) \
+
+    # Newest first, counting the samples in the database rather than loading them
+    number_of_samples = db.session.query(func.count(SubmissionsSample.sample_id)) \
+        .filter(SubmissionsSample.manifest_id == SubmissionsManifest.manifest_id) \
+        .scalar_subquery()
+    query = db.session.query(SubmissionsManifest, number_of_samples) \
+        .options(raiseload(SubmissionsManifest.samples),
+                 joinedload(SubmissionsManifest.user).selectinload(SubmissionsUser.roles))
+    if cursor is not None:
+        query = query.filter(SubmissionsManifest.manifest_id < cursor)
+    # One extra to tell whether there is another page
+    manifests = query.order_by(SubmissionsManifest.manifest_id.desc()) \
+        .limit(limit + 1) \
         .all()
 
-    return jsonify([manifest.to_dict_short() for manifest in manifests])
+    headers = {}
+    if len(manifests) > limit:
+        manifests = manifests[:limit]
+        headers['X-Next-Cursor'] = str(manifests[-1][0].manifest_id)
+    return jsonify([manifest.to_dict_short(number_of_samples)
+                    for manifest, number_of_samples in manifests]), 200, headers
 
 
 def upload_manifest_json(body={}, excel_file=None):  # noqa: E501
@@ -43,9 +60,10 @@ def upload_manifest_json(body={}, excel_file=None):  # noqa: E501
         .one_or_none()
 
     manifest = manifest_utils.create_manifest_from_json(body, user)
-    db.session.add(manifest)
+    manifest_utils.save_manifest(manifest)
+    manifest_id = manifest.manifest_id
     db.session.commit()
-    return jsonify(manifest)
+    return jsonify(get_manifest_with_samples(manifest_id))
 
 
 def get_manifest(manifest_id=None):
@@ -57,9 +75,7 @@ def get_manifest(manifest_id=None):
         return jsonify({'detail': 'User does not have permission to use this function'}), 403
 
     # Does the manifest exist?
-    manifest = db.session.query(SubmissionsManifest) \
-        .filter(SubmissionsManifest.manifest_id == manifest_id) \
-        .one_or_none()
+    manifest = get_manifest_with_samples(manifest_id)
     if manifest is None:
         return jsonify({'detail': 'Manifest does not exist'}), 404
 
@@ -75,43 +91,18 @@ def fill_manifest(manifest_id=None):
         return jsonify({'detail': 'User does not have permission to use this function'}), 403
 
     # Does the manifest exist?
-    manifest = db.session.query(SubmissionsManifest) \
-        .filter(SubmissionsManifest.manifest_id == manifest_id) \
-        .one_or_none()
+    manifest = get_manifest_with_samples(manifest_id)
     if manifest is None:
         return jsonify({'detail': 'Manifest does not exist'}), 404
 
     ncbi_data = manifest_utils.get_ncbi_data(manifest)
+    samples_sts = get_samples_sts(sample.specimen_id for sample in manifest.samples)
+    errors = []
     for sample in manifest.samples:
-        # Call out to STS for the sample data. No this is a bit of a fudge because we have to
-        # choose a sample from the specimen which only really works if we don't resample the
-        # same specimen.
-        response = requests.post(os.getenv('STS_URL') + '/samples',
-                                 json={'specimen_specimen_id': sample.specimen_id},
-                                 headers={'Project': 'ALL',
-                                          'Authorization': os.getenv('STS_API_KEY')})
-        if (response.status_code != 200):
-            return jsonify({'detail': 'Specimen does not exist in STS: '
-                           + sample.specimen_id}), 404
-        samples = response.json()['data']['list']
-        if len(samples) < 1:
-            return jsonify({'detail': 'Samples do not exist in STS: ' + sample.specimen_id}), 404
-
-        # We don't get all the info we need on this endpoint, so we will use this to call
-        # another endpoint which does have the details
-        rack_id = samples[0].get('sample_rackid', None)
-        tube_id = samples[0].get('sample_tubeid', None)
-        response = requests.get(os.getenv('STS_URL') + '/samples/detail',
-                                params={'rack_id': rack_id,
-                                        'tube_id': tube_id},
-                                headers={'Project': 'ALL',
-                                         'Authorization': os.getenv('STS_API_KEY')})
-        if (response.status_code != 200):
-            return jsonify({'detail': 'Specimen does not exist in STS: '
-                           + sample.specimen_id}), 404
-        sample_from_sts = response.json()['data']
-        if len(sample_from_sts) < 1:
-            return jsonify({'detail': 'Sample does not exist in STS: ' + sample.specimen_id}), 404
+        sample_from_sts, error = samples_sts[sample.specimen_id]
+        if error is not None:
+            errors.append({'row': sample.row, 'detail': error})
+            continue
 
         for field in SubmissionsSample.all_fields:
             if 'sts_api_name' in field:
@@ -124,8 +115,10 @@ def fill_manifest(manifest_id=None):
 
         # NCBI for the taxonomy
         if sample.taxonomy_id not in ncbi_data:
-            return jsonify({'detail': 'Taxon ID does not exist in NCBI: '
-                           + str(sample.taxonomy_id)}), 404
+            errors.append({'row': sample.row,
+                           'detail': 'Taxon ID does not exist in NCBI: '
+                           + str(sample.taxonomy_id)})
+            continue
 
         ncbi_result = ncbi_data[sample.taxonomy_id]
 
@@ -139,11 +132,16 @@ def fill_manifest(manifest_id=None):
             elif rank == 'order':
                 sample.order_or_group = element.get('ScientificName').upper()
 
+    if errors:
+        db.session.rollback()
+        return jsonify({'detail': '; '.join(e['detail'] for e in errors),
+                        'errors': errors}), 404
+
     db.session.commit()
-    return jsonify(manifest)
+    return jsonify(get_manifest_with_samples(manifest_id))
 
 
-def validate_manifest(manifest_id=None):
+def validate_manifest(manifest_id=None, async_=False):
     # Do the validation here
     role = db.session.query(SubmissionsRole) \
         .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
@@ -152,10 +150,11 @@ def validate_manifest(manifest_id=None):
     if role is None:
         return jsonify({'detail': 'User does not have permission to use this function'}), 403
 
+    if async_:
+        return enqueue_job('validate', manifest_id)
+
     # Does the manifest exist?
-    manifest = db.session.query(SubmissionsManifest) \
-        .filter(SubmissionsManifest.manifest_id == manifest_id) \
-        .one_or_none()
+    manifest = get_manifest_with_samples(manifest_id)
     if manifest is None:
         return jsonify({'detail': 'Manifest does not exist'}), 404
 
@@ -165,6 +164,44 @@ def validate_manifest(manifest_id=None):
                     'validations': validation_results})
 
 
+def stream_manifest_validation(manifest_id=None, format_='ndjson'):
+    role = db.session.query(SubmissionsRole) \
+        .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
+        .filter(SubmissionsRole.user_id == connexion.context['user']) \
+        .one_or_none()
+    if role is None:
+        return jsonify({'detail': 'User does not have permission to use this function'}), 403
+
+    # Does the manifest exist?
+    manifest = get_manifest_with_samples(manifest_id)
+    if manifest is None:
+        return jsonify({'detail': 'Manifest does not exist'}), 404
+
+    if format_ == 'sse':
+        mimetype = 'text/event-stream'
+
+        def format_record(event, record):
+            return 'event: ' + event + '\ndata: ' + json.dumps(record) + '\n\n'
+    else:
+        mimetype = 'application/x-ndjson'
+
+        def format_record(event, record):
+            return json.dumps(record) + '\n'
+
+    def generate():
+        number_of_errors = 0
+        for result in manifest_utils.iter_validate_manifest(manifest):
+            number_of_errors += len(result['results'])
+            yield format_record('row', result)
+        yield format_record('summary', {'manifestId': manifest_id,
+                                        'number_of_errors': number_of_errors})
+
+    # Sent on as each row is ready rather than buffered by nginx
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 def submit_and_validate_manifest_json(body=None):
     role = db.session.query(SubmissionsRole) \
         .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
@@ -180,17 +217,30 @@ def submit_and_validate_manifest_json(body=None):
     # Add the manifest
     manifest = manifest_utils.create_manifest_from_json(body, user)
 
-    db.session.add(manifest)
+    manifest_utils.save_manifest(manifest)
+    manifest_id = manifest.manifest_id
     db.session.commit()
 
-    # Validate the manifest
-    number_of_errors, validation_results = manifest_utils.validate_manifest(manifest)
-    return jsonify({'manifestId': manifest.manifest_id,
+    # Validate the manifest, unless the same one was validated recently
+    cache_key = manifest_utils.get_validation_cache_key(body)
+    cached = manifest_utils.get_cached_validation(cache_key)
+    manifest = get_manifest_with_samples(manifest_id)
+    if cached is not None:
+        number_of_errors, validation_results = cached
+        # The new manifest's rows still keep their results, so that validating it again
+        # only checks the rows that change
+        for sample in manifest.samples:
+            manifest_utils.update_row_results(sample)
+        db.session.commit()
+    else:
+        number_of_errors, validation_results = manifest_utils.validate_manifest(manifest)
+        manifest_utils.cache_validation(cache_key, number_of_errors, validation_results)
+    return jsonify({'manifestId': manifest_id,
                     'number_of_errors': number_of_errors,
                     'validations': validation_results})
 
 
-def generate_ids_for_manifest(manifest_id=None):
+def generate_ids_for_manifest(manifest_id=None, async_=False):
     # Do the validation here
     role = db.session.query(SubmissionsRole) \
         .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
@@ -199,10 +249,11 @@ def generate_ids_for_manifest(manifest_id=None):
     if role is None:
         return jsonify({'detail': 'User does not have permission to use this function'}), 403
 
+    if async_:
+        return enqueue_job('generate', manifest_id)
+
     # Does the manifest exist?
-    manifest = db.session.query(SubmissionsManifest) \
-        .filter(SubmissionsManifest.manifest_id == manifest_id) \
-        .one_or_none()
+    manifest = get_manifest_with_samples(manifest_id)
     if manifest is None:
         return jsonify({'detail': 'Manifest does not exist'}), 404
 
@@ -213,7 +264,7 @@ def generate_ids_for_manifest(manifest_id=None):
                         'number_of_errors': number_of_errors,
                         'validations': validation_results})
 
-    return jsonify(manifest)
+    return jsonify(get_manifest_with_samples(manifest_id))
 
 
 def submit_and_generate_manifest_json(body=None):
@@ -231,8 +282,10 @@ def submit_and_generate_manifest_json(body=None):
     # Add the manifest
     manifest = manifest_utils.create_manifest_from_json(body, user)
 
-    db.session.add(manifest)
+    manifest_utils.save_manifest(manifest)
+    manifest_id = manifest.manifest_id
     db.session.commit()
+    manifest = get_manifest_with_samples(manifest_id)
 
     number_of_errors, validation_results = manifest_utils.generate_ids_for_manifest(manifest)
 
@@ -241,4 +294,44 @@ def submit_and_generate_manifest_json(body=None):
                         'number_of_errors': number_of_errors,
                         'validations': validation_results})
 
-    return jsonify(manifest)
+    return jsonify(get_manifest_with_samples(manifest_id))
+
+
+def enqueue_job(kind, manifest_id):
+    # Does the manifest exist?
+    manifest_exists = db.session.query(SubmissionsManifest.manifest_id) \
+        .filter(SubmissionsManifest.manifest_id == manifest_id) \
+        .one_or_none()
+    if manifest_exists is None:
+        return jsonify({'detail': 'Manifest does not exist'}), 404
+
+    job = job_utils.enqueue_job(kind, manifest_id, connexion.context['user'])
+    return jsonify(job), 202
+
+
+def get_job(job_id=None):
+    role = db.session.query(SubmissionsRole) \
+        .filter(or_(SubmissionsRole.role == 'submitter', SubmissionsRole.role == 'admin')) \
+        .filter(SubmissionsRole.user_id == connexion.context['user']) \
+        .one_or_none()
+    if role is None:
+        return jsonify({'detail': 'User does not have permission to use this function'}), 403
+
+    job = db.session.query(SubmissionsJob) \
+        .filter(SubmissionsJob.job_id == job_id) \
+        .one_or_none()
+    if job is None:
+        return jsonify({'detail': 'Job does not exist'}), 404
+
+    return jsonify(job)
+
+
+def get_caches():
+    role = db.session.query(SubmissionsRole) \
+        .filter(SubmissionsRole.role == 'admin') \
+        .filter(SubmissionsRole.user_id == connexion.context['user']) \
+        .one_or_none()
+    if role is None:
+        return jsonify({'detail': 'User does not have permission to use this function'}), 403
+
+    return jsonify(get_cache_stats())
@@ -10,7 +10,22 @@ from flask import jsonify
 from main.model import SubmissionsSample, db
 from main.specimen_utils import get_biospecimen_sts, get_specimen_sts
 
-from sqlalchemy import or_
+from sqlalchemy import select, union
+from sqlalchemy.orm import selectinload
+
+
+def query_samples_from_biospecimen(biospecimen_id):
+    # A union rather than an OR, so that each column's index can be used
+    sample_ids = union(
+        select(SubmissionsSample.sample_id)
+        .where(SubmissionsSample.sample_same_as == biospecimen_id),
+        select(SubmissionsSample.sample_id)
+        .where(SubmissionsSample.sample_derived_from == biospecimen_id),
+        select(SubmissionsSample.sample_id)
+        .where(SubmissionsSample.sample_symbiont_of == biospecimen_id))
+    return db.session.query(SubmissionsSample) \
+        .filter(SubmissionsSample.sample_id.in_(sample_ids)) \
+        .order_by(SubmissionsSample.sample_id)
 
 
 def get_samples_from_specimen(specimen):
@@ -18,12 +33,8 @@ def get_samples_from_specimen(specimen):
     biosspecimen_id = specimen.biosample_accession
 
     # Get all the samples from this specimen
-    samples = db.session.query(SubmissionsSample) \
-        .filter(or_(
-            SubmissionsSample.sample_same_as == biosspecimen_id,
-            SubmissionsSample.sample_derived_from == biosspecimen_id,
-            SubmissionsSample.sample_symbiont_of == biosspecimen_id,
-        )) \
+    samples = query_samples_from_biospecimen(biosspecimen_id) \
+        .options(selectinload(SubmissionsSample.sample_fields)) \
         .all()
 
     return jsonify({
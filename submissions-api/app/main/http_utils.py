@@ -0,0 +1,124 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import io
+import os
+import threading
+import uuid
+
+from main.lookup_utils import get_concurrency
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for a response from each upstream service, unless overridden with e.g.
+# ENA_TIMEOUT=600. ENA submissions can take minutes
+DEFAULT_TIMEOUTS = {'sts': 30,
+                    'tolid': 30,
+                    'ena': 300,
+                    'elixir': 30}
+DEFAULT_CONNECT_TIMEOUT = 5
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Applies a default timeout to requests that don't set their own"""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class MultipartFileStream:
+    """A multipart/form-data body of (name, (filename, file, content type)) files, read
+    from the files a block at a time rather than built in memory. Its length is known,
+    so it is sent with a Content-Length rather than chunked"""
+
+    def __init__(self, files):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.parts = []
+        for name, (filename, f, content_type) in files:
+            header = '--' + boundary + '\r\n' \
+                + 'Content-Disposition: form-data; name="' + name + '"; filename="' \
+                + filename + '"\r\n' \
+                + 'Content-Type: ' + content_type + '\r\n\r\n'
+            self.parts += [io.BytesIO(header.encode('utf-8')), f, io.BytesIO(b'\r\n')]
+        self.parts.append(io.BytesIO(('--' + boundary + '--\r\n').encode('utf-8')))
+        self.length = sum(remaining_length(part) for part in self.parts)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = []
+        while self.parts and size != 0:
+            block = self.parts[0].read(size)
+            if not block:
+                self.parts.pop(0)
+                continue
+            data.append(block)
+            if size > 0:
+                size -= len(block)
+        return b''.join(data)
+
+
+def remaining_length(f):
+    position = f.tell()
+    end = f.seek(0, io.SEEK_END)
+    f.seek(position)
+    return end - position
+
+
+def get_timeout(upstream):
+    return (float(os.getenv('HTTP_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+            float(os.getenv(upstream.upper() + '_TIMEOUT', DEFAULT_TIMEOUTS[upstream])))
+
+
+def get_headers(upstream):
+    if upstream == 'sts':
+        return {'Project': 'ALL',
+                'Authorization': os.getenv('STS_API_KEY')}
+    if upstream == 'tolid':
+        return {'api-key': os.getenv('TOLID_API_KEY')}
+    return {}
+
+
+def create_session(upstream):
+    session = requests.Session()
+    # Keep as many connections open as there can be simultaneous lookups
+    pool_size = int(os.getenv(upstream.upper() + '_POOL_SIZE', get_concurrency(upstream)))
+    adapter = TimeoutHTTPAdapter(get_timeout(upstream), pool_maxsize=max(1, pool_size))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Headers set to None are left out of the requests
+    session.headers.update(get_headers(upstream))
+    return session
+
+
+def get_session(upstream):
+    """The session for one of 'sts', 'tolid', 'ena' or 'elixir', which keeps its
+    connections open between requests. Created on first use, so that each uWSGI
+    worker has its own"""
+    session = _sessions.get(upstream)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(upstream)
+            if session is None:
+                session = _sessions[upstream] = create_session(upstream)
+    return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
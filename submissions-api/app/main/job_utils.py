@@ -0,0 +1,210 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from flask import json as flask_json
+
+import main.manifest_utils as manifest_utils
+from main.manifest_utils import get_manifest_with_samples
+from main.model import SubmissionsJob, db
+
+from sqlalchemy import func
+
+# Seconds the worker waits before looking for queued jobs again when there are none
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 5))
+
+# Seconds between the updates a running job makes to show that its worker is still
+# working on it, and after which a running job with no update is taken to have been lost
+# with its worker
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', 60))
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', 600))
+
+# Days finished jobs are kept for, so that their results can be fetched
+JOB_RETENTION_DAYS = float(os.getenv('JOB_RETENTION_DAYS', 30))
+
+
+class JobFailed(Exception):
+    """Raised by a job's work when it fails with a result worth keeping"""
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def enqueue_job(kind, manifest_id, user_id):
+    job = SubmissionsJob(kind=kind, manifest_id=manifest_id, created_by=user_id)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def claim_job():
+    """Marks the oldest queued job as running and returns it, or None if there are none.
+    Jobs being claimed by other workers are skipped rather than waited for"""
+    job = db.session.query(SubmissionsJob) \
+        .filter(SubmissionsJob.status == 'queued') \
+        .order_by(SubmissionsJob.job_id) \
+        .with_for_update(skip_locked=True) \
+        .first()
+    if job is None:
+        db.session.rollback()
+        return None
+    job.status = 'running'
+    job.started_at = func.now()
+    job.updated_at = func.now()
+    db.session.commit()
+    return job
+
+
+def fail_stale_jobs():
+    """Fails the running jobs that haven't been updated for JOB_TIMEOUT, whose workers
+    must have stopped, so that they aren't left running forever"""
+    db.session.query(SubmissionsJob) \
+        .filter(SubmissionsJob.status == 'running') \
+        .filter(SubmissionsJob.updated_at < func.now() - timedelta(seconds=JOB_TIMEOUT)) \
+        .update({'status': 'failed',
+                 'error': 'Timed out',
+                 'finished_at': func.now()},
+                synchronize_session=False)
+    db.session.commit()
+
+
+def purge_finished_jobs():
+    """Deletes the jobs that finished more than JOB_RETENTION_DAYS ago"""
+    db.session.query(SubmissionsJob) \
+        .filter(SubmissionsJob.finished_at
+                < func.now() - timedelta(days=JOB_RETENTION_DAYS)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def start_heartbeat(job_id):
+    """Updates the running job every JOB_HEARTBEAT_INTERVAL seconds, from a thread of its
+    own, until the returned event is set"""
+    # The thread has no app context to find the engine from
+    engine = db.engine
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            with engine.begin() as connection:
+                connection.execute(SubmissionsJob.__table__.update()
+                                   .where(SubmissionsJob.job_id == job_id)
+                                   .where(SubmissionsJob.status == 'running')
+                                   .values(updated_at=func.now()))
+
+    threading.Thread(target=beat, name='job-heartbeat-' + str(job_id), daemon=True).start()
+    return stopped
+
+
+def set_job_progress(job_id, phase, progress):
+    # In a transaction of its own, so it is seen straight away without committing the
+    # job's work
+    with db.engine.begin() as connection:
+        connection.execute(SubmissionsJob.__table__.update()
+                           .where(SubmissionsJob.job_id == job_id)
+                           .values(phase=phase, progress=progress, updated_at=func.now()))
+
+
+def to_json(o):
+    # The same as it would be in a response
+    return json.loads(flask_json.dumps(o))
+
+
+def run_generate(manifest, report_progress):
+    # Nobody is waiting for a job, so it can wait for ENA to recover
+    number_of_errors, validation_results = manifest_utils.generate_ids_for_manifest(
+        manifest, report_progress=report_progress, retries=manifest_utils.ENA_RETRIES,
+        retry_delay=manifest_utils.ENA_RETRY_DELAY)
+    if number_of_errors > 0:
+        raise JobFailed('IDs could not be generated for every sample',
+                        {'manifestId': manifest.manifest_id,
+                         'number_of_errors': number_of_errors,
+                         'validations': validation_results})
+    return get_manifest_with_samples(manifest.manifest_id)
+
+
+def run_validate(manifest, report_progress):
+    number_of_errors, validation_results = manifest_utils.validate_manifest(
+        manifest, report_progress=report_progress)
+    return {'manifestId': manifest.manifest_id,
+            'number_of_errors': number_of_errors,
+            'validations': validation_results}
+
+
+JOB_KINDS = {'generate': run_generate,
+             'validate': run_validate}
+
+
+def run_job(job):
+    job_id = job.job_id
+
+    def report_progress(phase, progress):
+        set_job_progress(job_id, phase, progress)
+
+    heartbeat = start_heartbeat(job_id)
+    try:
+        manifest = get_manifest_with_samples(job.manifest_id)
+        result = to_json(JOB_KINDS[job.kind](manifest, report_progress))
+        error = None
+    except JobFailed as e:
+        result = to_json(e.result)
+        error = str(e)
+    except Exception as e:
+        logging.exception('Job ' + str(job_id) + ' failed')
+        result = None
+        error = str(e)
+    finally:
+        heartbeat.set()
+
+    # Anything the work didn't commit is discarded, as it would be after a request
+    db.session.rollback()
+    if error is None:
+        outcome = {'status': 'succeeded',
+                   'progress': 100,
+                   'result': result}
+    else:
+        outcome = {'status': 'failed',
+                   'result': result,
+                   'error': error}
+    # Only if it is still running, rather than having been taken to be lost
+    finished = db.session.query(SubmissionsJob) \
+        .filter(SubmissionsJob.job_id == job_id) \
+        .filter(SubmissionsJob.status == 'running') \
+        .update({**outcome, 'finished_at': func.now()}, synchronize_session=False)
+    db.session.commit()
+    if finished == 0:
+        logging.warning('Job ' + str(job_id) + ' was no longer running when it finished')
+
+
+def run_next_job():
+    """Runs the oldest queued job, if there is one. Returns whether there was"""
+    fail_stale_jobs()
+    purge_finished_jobs()
+    job = claim_job()
+    if job is None:
+        return False
+    try:
+        run_job(job)
+    finally:
+        db.session.remove()
+    return True
+
+
+def work():
+    while True:
+        if not run_next_job():
+            time.sleep(JOB_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    # Run by uWSGI alongside the web workers
+    from main import application
+    with application().app.app_context():
+        work()
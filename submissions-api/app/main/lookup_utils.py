@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+# Default number of simultaneous requests allowed against each upstream service.
+# Override with e.g. TOLID_CONCURRENCY=16
+DEFAULT_CONCURRENCY = 8
+
+# One executor per upstream, shared by every request and job in this worker, so that
+# get_concurrency(upstream) limits the whole worker rather than each call
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_concurrency(upstream):
+    return max(1, int(os.getenv(upstream.upper() + '_CONCURRENCY', DEFAULT_CONCURRENCY)))
+
+
+def get_executor(upstream):
+    with _executors_lock:
+        if upstream not in _executors:
+            _executors[upstream] = ThreadPoolExecutor(
+                max_workers=get_concurrency(upstream),
+                thread_name_prefix='lookup-' + upstream)
+        return _executors[upstream]
+
+
+def shutdown_executors():
+    """Waits for the lookups running in this worker, and starts new executors the next
+    time they are needed, with the concurrency set then"""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+def run_lookups(lookups):
+    """Run a list of (upstream, function, args) lookups concurrently, with at most
+    get_concurrency(upstream) running against any one upstream at a time in this worker.
+    Returns the results in the same order as the lookups"""
+    results = [None] * len(lookups)
+    futures = {}
+    try:
+        for i, (upstream, function, args) in enumerate(lookups):
+            futures[get_executor(upstream).submit(function, *args)] = i
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        # Don't start lookups that are still waiting if one has failed, but let those
+        # already running finish before returning
+        for future in futures:
+            future.cancel()
+        wait(futures)
+    return results
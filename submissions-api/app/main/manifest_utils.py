@@ -2,21 +2,134 @@
 #
 # SPDX-License-Identifier: MIT
 
+import hashlib
+import json
 import logging
 import os
 import re
+import time
 import xml.etree.ElementTree as ElementTree
+from collections import defaultdict
+from datetime import datetime, timedelta
+from urllib.error import HTTPError, URLError
 
 from Bio import Entrez
 
+from main.cache_utils import TTLCache
+from main.checklist_utils import get_ena_checklist
+from main.http_utils import MultipartFileStream, get_session
+from main.lookup_utils import get_concurrency, run_lookups
 from main.model import SubmissionsManifest, SubmissionsSample, SubmissionsSampleField, \
-    SubmissionsSpecimen, db
-from main.specimen_utils import get_specimen_sts
+    SubmissionsSpecimen, SubmissionsTaxonomy, SubmissionsValidation, db
+from main.specimen_utils import get_specimens_sts
+from main.taxdump_utils import get_taxdump_index
 from main.xml_utils import build_bundle_sample_xml, build_submission_xml
 
 import requests
 from requests.auth import HTTPBasicAuth
 
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import selectinload
+
+# Parsed ENA taxonomy responses, shared by all requests in this worker. Unknown taxa are
+# only remembered for a short time in case they are added to ENA
+ena_taxonomy_cache = TTLCache('ena_taxonomy',
+                              maxsize=int(os.getenv('ENA_TAXONOMY_CACHE_SIZE', 10000)),
+                              ttl=int(os.getenv('ENA_TAXONOMY_CACHE_TTL', 86400)))
+ENA_TAXONOMY_CACHE_NEGATIVE_TTL = int(os.getenv('ENA_TAXONOMY_CACHE_NEGATIVE_TTL', 3600))
+
+# ToLID species and specimen responses, by path, shared by all requests in this worker.
+# Species and specimens ToLID doesn't know are only remembered for a short time, as they
+# are added to it as ToLIDs are assigned
+tolid_cache = TTLCache('tolid',
+                       maxsize=int(os.getenv('TOLID_CACHE_SIZE', 10000)),
+                       ttl=int(os.getenv('TOLID_CACHE_TTL', 3600)))
+TOLID_CACHE_NEGATIVE_TTL = int(os.getenv('TOLID_CACHE_NEGATIVE_TTL', 300))
+
+# Seconds the results of validating a submitted manifest are kept, so that the same
+# manifest submitted again isn't validated again
+VALIDATION_CACHE_TTL = int(os.getenv('VALIDATION_CACHE_TTL', 600))
+
+# Samples sent to ENA in each submission, and how many more times a submission that
+# failed to reach ENA is tried, waiting ENA_RETRY_DELAY seconds before the first retry and
+# twice as long before each one after. Only jobs retry, as a request would be kept waiting.
+# Chunks are submitted ENA_CONCURRENCY at a time
+ENA_CHUNK_SIZE = max(1, int(os.getenv('ENA_CHUNK_SIZE', 500)))
+ENA_RETRIES = int(os.getenv('ENA_RETRIES', 2))
+ENA_RETRY_DELAY = float(os.getenv('ENA_RETRY_DELAY', 5))
+
+# Rows validated together, looking up their taxa and specimens at the same time. Smaller
+# chunks give the first results sooner, larger ones make more lookups at once
+VALIDATION_CHUNK_SIZE = max(1, int(os.getenv('VALIDATION_CHUNK_SIZE', 100)))
+
+# How long a taxon's NCBI record is used before it is fetched again
+NCBI_TAXONOMY_MAX_AGE_DAYS = int(os.getenv('NCBI_TAXONOMY_MAX_AGE_DAYS', 30))
+
+# The names in a sample's JSON which are not kept as extra fields
+KNOWN_FIELD_NAMES = frozenset(['row', 'public_name']
+                              + [field['field_name'] for field in SubmissionsSample.all_fields])
+SAMPLE_FIELDS = tuple((field['python_name'], field['field_name'], field['required'])
+                      for field in SubmissionsSample.all_fields)
+
+# The per-field rules in SubmissionsSample.all_fields, compiled once and in field order,
+# leaving out fields that the rule doesn't apply to
+REQUIRED_FIELDS = tuple((field['python_name'], field['field_name'])
+                        for field in SubmissionsSample.all_fields
+                        if field['required'])
+ALLOWED_VALUES_RULES = tuple((field['python_name'],
+                              field['field_name'],
+                              re.compile(field['split_pattern'])
+                              if field.get('split_pattern') is not None else None,
+                              frozenset(field['allowed_values']))
+                             for field in SubmissionsSample.all_fields
+                             if field.get('allowed_values') is not None)
+REGEX_RULES = tuple((field['python_name'],
+                     field['field_name'],
+                     re.compile(field[regex_type]),
+                     severity)
+                    for field in SubmissionsSample.all_fields
+                    for regex_type, severity in [('error_regex', 'ERROR'),
+                                                 ('warning_regex', 'WARNING')]
+                    if field.get(regex_type) is not None)
+
+# Part of each row's validation hash. Change it when the rules change, so that rows
+# validated under the old rules are validated again
+VALIDATION_VERSION = 3
+HASHED_FIELDS = tuple(field['python_name']
+                      for field in SubmissionsSample.all_fields + SubmissionsSample.id_fields)
+
+# The order a sample's results are reported in, by the check that gave them. The cross-row
+# checks are among the single-row ones, where they have always been
+RESULT_ORDER = ('validate_required_fields',
+                'validate_allowed_values',
+                'validate_regexs',
+                'validate_specimen_id',
+                'validate_rack_plate_tube_well_not_both_na',
+                'validate_rack_plate_tube_well_unique',
+                'validate_no_orphaned_symbionts',
+                'validate_no_specimens_with_different_taxons',
+                'validate_barcoding',
+                'validate_whole_organisms_unique',
+                'validate_species_known_in_tolid',
+                'validate_specimen_against_tolid',
+                'validate_against_ena_checklist',
+                'validate_ena_submittable')
+
+
+def get_manifest_with_samples(manifest_id):
+    # The samples and their extra fields are loaded with one query each
+    return db.session.query(SubmissionsManifest) \
+        .options(selectinload(SubmissionsManifest.samples)
+                 .selectinload(SubmissionsSample.sample_fields)) \
+        .filter(SubmissionsManifest.manifest_id == manifest_id) \
+        .one_or_none()
+
+
+def ignore_progress(phase, progress):
+    # For when nothing is following a long-running task's progress
+    pass
+
 
 def create_manifest_from_json(json, user):
     manifest = SubmissionsManifest()
@@ -25,70 +138,206 @@ def create_manifest_from_json(json, user):
         manifest.project_name = json['projectName']
     if 'stsManifestId' in json:
         manifest.sts_manifest_id = json['stsManifestId']
-    ignore_fields = []
     for s in json['samples']:
         sample = SubmissionsSample()
         sample.manifest = manifest
         sample.row = s.get('row')
-        ignore_fields.append('row')
         # All named fields
-        for field in SubmissionsSample.all_fields:
-            value = s.get(field['field_name'])
+        for python_name, field_name, required in SAMPLE_FIELDS:
+            value = s.get(field_name)
             # Treat 'empty' strings as though they hadn't been given at all
-            if not field['required'] and isinstance(value, str) and value.strip() == '':
+            if not required and isinstance(value, str) and value.strip() == '':
                 value = None
-            setattr(sample, field['python_name'], value)
-            ignore_fields.append(field['field_name'])
+            setattr(sample, python_name, value)
 
         # Special treatment for tolid/public_name which only comes filled in
         # for taxon 32644
-            if s.get('public_name') is not None:
-                sample.tolid = s.get('public_name')
-                ignore_fields.append('public_name')
+        if s.get('public_name') is not None:
+            sample.tolid = s.get('public_name')
 
         # Extra fields
-        for field_name in s:
-            if field_name not in ignore_fields:
-                field_value = s.get(field_name)
-                if field_value is not None:
-                    sample_field = SubmissionsSampleField()
-                    sample_field.sample = sample
-                    sample_field.name = field_name
-                    sample_field.value = field_value
+        for field_name, field_value in s.items():
+            if field_value is not None and field_name not in KNOWN_FIELD_NAMES:
+                sample_field = SubmissionsSampleField()
+                sample_field.sample = sample
+                sample_field.name = field_name
+                sample_field.value = field_value
 
     return manifest
 
 
-def validate_manifest(manifest, full=True):
-    results = []
-    number_of_errors = 0
-
-    # Only need these for a full validation
+def save_manifest(manifest):
+    """Adds a new manifest from create_manifest_from_json to the session. Its samples and
+    their extra fields are inserted with one statement each rather than one per row"""
+    samples = list(manifest.samples)
+    # Keep the session from inserting the samples itself
+    manifest.samples = []
+    db.session.add(manifest)
+    db.session.flush()
+    if len(samples) == 0:
+        return
+
+    # Take all the sample IDs from the sequence at once
+    sample_ids = db.session.execute(
+        text("SELECT nextval(pg_get_serial_sequence('sample', 'sample_id')) "
+             'FROM generate_series(1, :count)'),
+        {'count': len(samples)}).scalars().all()
+    sample_rows = []
+    field_rows = []
+    for sample, sample_id in zip(samples, sample_ids):
+        sample.sample_id = sample_id
+        sample.manifest_id = manifest.manifest_id
+        sample_rows.append({column.key: getattr(sample, column.key)
+                            for column in SubmissionsSample.__table__.columns})
+        for sample_field in sample.sample_fields:
+            field_rows.append({'sample_id': sample_id,
+                               'name': sample_field.name,
+                               'value': sample_field.value})
+    db.session.execute(SubmissionsSample.__table__.insert(), sample_rows)
+    if len(field_rows) > 0:
+        db.session.execute(SubmissionsSampleField.__table__.insert(), field_rows)
+
+    # Load the stored samples in place of the unsaved ones when they are next used
+    db.session.expire(manifest, ['samples'])
+
+
+class ValidationContext:
+    """The state of one validation run, passed to the validators that need more than the
+    sample. Once built, external responses are only ever added to it, so the samples of
+    one or more manifests can be validated in parallel threads"""
+
+    def __init__(self, samples, external_data=None):
+        self.cross_row_results = validate_cross_row(samples)
+        # Responses not in here are fetched when they are needed
+        self.external_data = {} if external_data is None else external_data
+
+    def add_external_data(self, external_data):
+        for data_name, responses in external_data.items():
+            self.external_data.setdefault(data_name, {}).update(responses)
+
+
+def get_validation_hash(sample):
+    """A hash of everything the single-row checks of a sample depend on"""
+    inputs = [VALIDATION_VERSION, get_ena_checklist().digest, sample.manifest.project_name]
+    inputs += [getattr(sample, x) for x in HASHED_FIELDS]
+    return hashlib.sha256(json.dumps(inputs, default=str).encode('utf-8')).hexdigest()
+
+
+def get_validation_cache_key(body):
+    """The same for every submission of the same manifest JSON under the same rules"""
+    canonical = json.dumps(body, sort_keys=True, separators=(',', ':'), default=str)
+    inputs = [VALIDATION_VERSION, get_ena_checklist().digest, canonical]
+    return hashlib.sha256(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+
+def get_cached_validation(cache_key):
+    """Returns (number of errors, results) of the manifest with this
+    get_validation_cache_key, if they are still in date, otherwise None"""
+    cached = db.session.query(SubmissionsValidation) \
+        .filter(SubmissionsValidation.cache_key == cache_key) \
+        .filter(SubmissionsValidation.expires_at > func.now()) \
+        .one_or_none()
+    if cached is None:
+        return None
+    return cached.number_of_errors, cached.validations
+
+
+def cache_validation(cache_key, number_of_errors, results):
+    """Keeps the results for VALIDATION_CACHE_TTL seconds, so every worker can use them,
+    unless another service couldn't be reached, which might not happen next time"""
+    if any(is_communication_failure(result) for row in results for result in row['results']):
+        return
+    table = SubmissionsValidation.__table__
+    statement = postgresql.insert(table).values(
+        cache_key=cache_key,
+        number_of_errors=number_of_errors,
+        validations=results,
+        expires_at=func.now() + timedelta(seconds=VALIDATION_CACHE_TTL))
+    statement = statement.on_conflict_do_update(
+        index_elements=['cache_key'],
+        set_={x: statement.excluded[x] for x in ['number_of_errors', 'validations',
+                                                 'expires_at']})
+    # In a transaction of its own, so the request's work isn't committed with it. Those
+    # that have expired are cleared out at the same time
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(table.c.expires_at <= func.now()))
+        connection.execute(statement)
+
+
+def is_communication_failure(result):
+    # As reported by the checks that call out
+    return result['message'].startswith('Communication')
+
+
+def validate_manifest(manifest, full=True, report_progress=ignore_progress):
+    results = list(iter_validate_manifest(manifest, full=full,
+                                          report_progress=report_progress))
+    return sum(len(x['results']) for x in results), results
+
+
+def iter_validate_manifest(manifest, full=True, report_progress=ignore_progress):
+    """Yields the results of each row in turn. The ToLID and ENA lookups are made for
+    VALIDATION_CHUNK_SIZE rows at a time, so the first rows' results don't wait for the
+    rest of the manifest.
+    Rows that have not changed since they were last validated keep the results of their
+    single-row checks that don't call out, so only the changed rows are checked again.
+    The ToLID and ENA checks are always made again, as their answers can change, but only
+    call out when tolid_cache and ena_taxonomy_cache don't have the answers. The cross-row
+    checks are always made again too, and are the only ones done for the whole manifest
+    before the first row is yielded"""
+    samples = manifest.samples
+    stored_changed = False
+
+    # Only need this for a full validation
     if full:
-        # Reset the lists we might use for tracking previously seen rows
-        manifest.reset_trackers()
-
-        # Get the NCBI taxonomy info for the whole manifest to use later
-        manifest_results = get_ncbi_data(manifest)
-        manifest.ncbi_data = manifest_results
+        context = ValidationContext(samples)
 
     # Sample-level checks
-    for sample in manifest.samples:
+    report_progress('samples', 0)
+    # Reported about every tenth of the way through
+    step = max(1, len(samples) // 10)
+    for start in range(0, len(samples), VALIDATION_CHUNK_SIZE):
+        chunk = samples[start:start + VALIDATION_CHUNK_SIZE]
         if full:
-            sample_results = validate_sample(sample)
-        else:
-            sample_results = validate_required_fields(sample)
-        results.append({'row': sample.row,
-                        'results': sample_results})
-        number_of_errors += len(sample_results)
-    return number_of_errors, results
+            # ToLID and ENA responses for the chunk, leaving out those we already have
+            # from earlier chunks
+            context.add_external_data(get_external_data(chunk, context.external_data))
+
+        for i, sample in enumerate(chunk, start=start + 1):
+            if full:
+                if update_row_results(sample):
+                    stored_changed = stored_changed or sample.sample_id is not None
+                sample_results = order_results(sample.validation_results,
+                                               context.cross_row_results.get(sample, {}),
+                                               validate_external(sample, context))
+            else:
+                sample_results = validate_required_fields(sample)
+            yield {'row': sample.row,
+                   'results': sample_results}
+            if i % step == 0:
+                report_progress('samples', 100 * i // len(samples))
+
+    if stored_changed:
+        # Keep the results of stored rows for next time
+        db.session.commit()
+
+
+def update_row_results(sample):
+    """Checks the row again if it has changed since it was last validated, keeping the
+    results of its single-row checks that don't call out. Returns whether it had changed"""
+    validation_hash = get_validation_hash(sample)
+    if sample.validation_results is not None and sample.validation_hash == validation_hash:
+        return False
+    sample.validation_results = validate_row(sample)
+    sample.validation_hash = validation_hash
+    return True
 
 
 def validate_required_fields(sample):
     results = []
-    for field in sample.all_fields:
-        if field['required'] and getattr(sample, field['python_name']) is None:
-            results.append({'field': field['field_name'],
+    for python_name, field_name in REQUIRED_FIELDS:
+        if getattr(sample, python_name) is None:
+            results.append({'field': field_name,
                             'message': 'A value must be given',
                             'severity': 'ERROR'})
     return results
@@ -96,17 +345,17 @@ def validate_required_fields(sample):
 
 def validate_allowed_values(sample):
     results = []
-    for field in sample.all_fields:
-        field_value = getattr(sample, field['python_name'])
-        if field.get('allowed_values') is not None and field_value is not None:
-            if field.get('split_pattern') is not None:
-                values_to_check = re.split(field.get('split_pattern'), field_value)
+    for python_name, field_name, split_regex, allowed_values in ALLOWED_VALUES_RULES:
+        field_value = getattr(sample, python_name)
+        if field_value is not None:
+            if split_regex is not None:
+                values_to_check = split_regex.split(field_value)
             else:
                 values_to_check = [field_value]
 
             for value_to_check in values_to_check:
-                if value_to_check not in field.get('allowed_values'):
-                    results.append({'field': field['field_name'],
+                if value_to_check not in allowed_values:
+                    results.append({'field': field_name,
                                     'message': 'Must be an allowed value',
                                     'severity': 'ERROR'})
                     break
@@ -115,15 +364,12 @@ def validate_allowed_values(sample):
 
 def validate_regexs(sample):
     results = []
-    for field in sample.all_fields:
-        field_value = getattr(sample, field['python_name'])
-        for regex_type in ['error_regex', 'warning_regex']:
-            if field.get(regex_type) is not None and field_value is not None:
-                if not re.search(field.get(regex_type), field_value):
-                    results.append({'field': field['field_name'],
-                                    'message': 'Does not match a specific pattern',
-                                    'severity': 'ERROR' if regex_type == 'error_regex'
-                                    else 'WARNING'})
+    for python_name, field_name, regex, severity in REGEX_RULES:
+        field_value = getattr(sample, python_name)
+        if field_value is not None and not regex.search(field_value):
+            results.append({'field': field_name,
+                            'message': 'Does not match a specific pattern',
+                            'severity': severity})
     return results
 
 
@@ -178,44 +424,6 @@ def validate_rack_plate_tube_well_not_both_na(sample):
     return results
 
 
-def validate_rack_plate_tube_well_unique(sample):
-    results = []
-    if sample.rack_or_plate_id is not None and sample.tube_or_well_id is not None:
-        concatenated = sample.rack_or_plate_id + '/' + sample.tube_or_well_id
-        if concatenated in sample.manifest.duplicate_rack_plate_tube_wells:
-            results.append({'field': 'SYMBIONT',
-                            'message': 'Must only be one target specimen id per '
-                                       'rack/tube or plate/well',
-                            'severity': 'ERROR'})
-    return results
-
-
-def validate_no_orphaned_symbionts(sample):
-    results = []
-    if sample.rack_or_plate_id is not None and sample.tube_or_well_id is not None \
-            and sample.symbiont == 'SYMBIONT':
-        concatenated = sample.rack_or_plate_id + '/' + sample.tube_or_well_id
-        if concatenated not in sample.manifest.target_rack_plate_tube_wells:
-            results.append({'field': 'SYMBIONT',
-                            'message': 'All symbionts must have a TARGET with same '
-                                       'rack/plate and tube/well',
-                            'severity': 'ERROR'})
-    return results
-
-
-def validate_no_specimens_with_different_taxons(sample):
-    results = []
-    if sample.specimen_id is not None and sample.taxonomy_id is not None \
-            and not sample.is_symbiont():
-        if sample.specimen_id in sample.manifest.target_specimen_taxons \
-                and sample.manifest.target_specimen_taxons[sample.specimen_id] != sample.taxonomy_id:  # noqa
-            results.append({'field': 'TAXON_ID',
-                            'message': 'Targets must not use the same SPECIMEN_ID '
-                                       'with a different TAXON_ID',
-                            'severity': 'ERROR'})
-    return results
-
-
 def validate_barcoding(sample):
     results = []
     if sample.tissue_removed_for_barcoding is None or sample.tissue_removed_for_barcoding != 'Y':
@@ -230,42 +438,150 @@ def validate_barcoding(sample):
     return results
 
 
-def validate_whole_organisms_unique(sample):
-    results = []
-    if sample.specimen_id in sample.manifest.duplicate_whole_organisms:
-        results.append({'field': 'SPECIMEN_ID',
-                        'message': 'WHOLE_ORGANISM can only be used once',
-                        'severity': 'ERROR'})
+class CrossRowIndex:
+    """The groups of rows that cross-row rules are checked against, built in one pass
+    over the samples"""
+
+    def __init__(self, samples):
+        # (rack_or_plate_id, tube_or_well_id) -> samples
+        self.rack_plate_tube_wells = defaultdict(list)
+        # specimen_id -> samples
+        self.specimens = defaultdict(list)
+        for sample in samples:
+            if sample.rack_or_plate_id is not None and sample.tube_or_well_id is not None:
+                self.rack_plate_tube_wells[(sample.rack_or_plate_id,
+                                            sample.tube_or_well_id)].append(sample)
+            self.specimens[sample.specimen_id].append(sample)
+
+
+# Each cross-row rule yields (sample, result) for every row that breaks it
+def validate_rack_plate_tube_well_unique(index):
+    for samples in index.rack_plate_tube_wells.values():
+        if sum(1 for x in samples if not x.is_symbiont()) > 1:
+            for sample in samples:
+                yield sample, {'field': 'SYMBIONT',
+                               'message': 'Must only be one target specimen id per '
+                                          'rack/tube or plate/well',
+                               'severity': 'ERROR'}
+
+
+def validate_no_orphaned_symbionts(index):
+    for samples in index.rack_plate_tube_wells.values():
+        if all(x.is_symbiont() for x in samples):
+            for sample in samples:
+                if sample.symbiont == 'SYMBIONT':
+                    yield sample, {'field': 'SYMBIONT',
+                                   'message': 'All symbionts must have a TARGET with same '
+                                              'rack/plate and tube/well',
+                                   'severity': 'ERROR'}
+
+
+def validate_no_specimens_with_different_taxons(index):
+    for specimen_id, samples in index.specimens.items():
+        if specimen_id is None:
+            continue
+        targets = [x for x in samples if not x.is_symbiont() and x.taxonomy_id is not None]
+        # Checked against the first target using the specimen
+        for sample in targets[1:]:
+            if sample.taxonomy_id != targets[0].taxonomy_id:
+                yield sample, {'field': 'TAXON_ID',
+                               'message': 'Targets must not use the same SPECIMEN_ID '
+                                          'with a different TAXON_ID',
+                               'severity': 'ERROR'}
+
+
+def validate_whole_organisms_unique(index):
+    for samples in index.specimens.values():
+        if sum(1 for x in samples if x.organism_part == 'WHOLE_ORGANISM') > 1:
+            for sample in samples:
+                yield sample, {'field': 'SPECIMEN_ID',
+                               'message': 'WHOLE_ORGANISM can only be used once',
+                               'severity': 'ERROR'}
+
+
+CROSS_ROW_RULES = (validate_rack_plate_tube_well_unique,
+                   validate_no_orphaned_symbionts,
+                   validate_no_specimens_with_different_taxons,
+                   validate_whole_organisms_unique)
+
+
+def validate_cross_row(samples):
+    """The results of all the cross-row rules, by sample then rule"""
+    index = CrossRowIndex(samples)
+    results = defaultdict(dict)
+    for rule in CROSS_ROW_RULES:
+        for sample, result in rule(index):
+            results[sample].setdefault(rule.__name__, []).append(result)
     return results
 
 
-def validate_sample(sample):
-    results = []
-
-    # Validations that don't require external calls
-    results += validate_required_fields(sample)
-    results += validate_allowed_values(sample)
-    results += validate_regexs(sample)
-    results += validate_specimen_id(sample)
-    results += validate_rack_plate_tube_well_not_both_na(sample)
-    results += validate_rack_plate_tube_well_unique(sample)
-    results += validate_no_orphaned_symbionts(sample)
-    results += validate_no_specimens_with_different_taxons(sample)
-    results += validate_barcoding(sample)
-    results += validate_whole_organisms_unique(sample)
+# This function retrieves the ToLID and ENA data for the samples, calling out once per
+# distinct taxon and specimen that isn't already in known
+def get_external_data(samples, known=None):
+    known = known or {}
+    taxonomy_ids = list({x.taxonomy_id for x in samples}
+                        - known.get('tolid_species', {}).keys())
+    specimen_ids = list({x.specimen_id for x in samples if not x.is_symbiont()}
+                        - known.get('tolid_specimen', {}).keys())
+    lookups = [('tolid', get_tolid_species, (x,)) for x in taxonomy_ids] \
+        + [('tolid', get_tolid_specimen, (x,)) for x in specimen_ids] \
+        + [('ena', get_ena_taxonomy, (x,)) for x in taxonomy_ids]
+    responses = iter(run_lookups(lookups))
+    return {'tolid_species': {x: next(responses) for x in taxonomy_ids},
+            'tolid_specimen': {x: next(responses) for x in specimen_ids},
+            'ena_taxonomy': {x: next(responses) for x in taxonomy_ids}}
+
+
+def get_external_response(context, data_name, key, fetch):
+    # Use the manifest-wide data if it has been retrieved, otherwise call out directly
+    responses = context.external_data.get(data_name, {})
+    if key in responses:
+        return responses[key]
+    return fetch(key)
+
+
+def validate_sample(sample, context):
+    return order_results(validate_row(sample),
+                         context.cross_row_results.get(sample, {}),
+                         validate_external(sample, context))
+
+
+def order_results(*results_by_check):
+    """Puts together the results of some checks, by check, in RESULT_ORDER"""
+    results = {}
+    for x in results_by_check:
+        results.update(x)
+    return [result for check in RESULT_ORDER for result in results.get(check, [])]
+
+
+def validate_row(sample):
+    """The checks that only depend on the sample itself, and don't call out. Returns their
+    results by check"""
+    results = {}
+    for check in (validate_required_fields,
+                  validate_allowed_values,
+                  validate_regexs,
+                  validate_specimen_id,
+                  validate_rack_plate_tube_well_not_both_na,
+                  validate_barcoding,
+                  validate_against_ena_checklist):
+        results[check.__name__] = check(sample)
+    return results
 
-    # STS for rack/plate and tube/well
-    # results += validate_sts_rack_plate_tube_well(sample)
 
-    # ToLID service
-    results += validate_species_known_in_tolid(sample)
-    results += validate_specimen_against_tolid(sample)
+def validate_external(sample, context):
+    """The checks of the sample against the ToLID and ENA services. Returns their results
+    by check"""
+    results = {}
 
-    # Validate against ENA checklist
-    results += validate_against_ena_checklist(sample)
+    # STS for rack/plate and tube/well
+    # results['validate_sts_rack_plate_tube_well'] = validate_sts_rack_plate_tube_well(sample)
 
-    # Validate taxon is ENA submittable
-    results += validate_ena_submittable(sample)
+    # ToLID service, and whether the taxon is ENA submittable
+    for check in (validate_species_known_in_tolid,
+                  validate_specimen_against_tolid,
+                  validate_ena_submittable):
+        results[check.__name__] = check(sample, context)
 
     return results
 
@@ -276,11 +592,9 @@ def validate_sts_rack_plate_tube_well(sample):
         # Cannot do this check
         return results
 
-    response = requests.get(os.getenv('STS_URL', '') + '/samples/detail',
-                            params={'rack_id': sample.rack_or_plate_id,
-                                    'tube_id': sample.tube_or_well_id},
-                            headers={'Project': 'ALL',
-                                     'Authorization': os.getenv('STS_API_KEY')})
+    response = get_session('sts').get(os.getenv('STS_URL', '') + '/samples/detail',
+                                      params={'rack_id': sample.rack_or_plate_id,
+                                              'tube_id': sample.tube_or_well_id})
     if (response.status_code == 400):
         # This is fine - not used before
         return results
@@ -299,10 +613,33 @@ def validate_sts_rack_plate_tube_well(sample):
     return results
 
 
-def validate_species_known_in_tolid(sample):
+def get_tolid(path):
+    found, cached = tolid_cache.get(path)
+    if found:
+        return cached
+
+    try:
+        response = get_session('tolid').get(os.getenv('TOLID_URL', '') + path)
+    except requests.RequestException as e:
+        # Reported for the rows that needed it, with no status code
+        logging.warning('ToLID lookup failed: ' + str(e))
+        return requests.Response()
+    if response.status_code == 200:
+        tolid_cache.set(path, response)
+    elif response.status_code == 404:
+        tolid_cache.set(path, response, ttl=TOLID_CACHE_NEGATIVE_TTL)
+    # Don't remember failures
+    return response
+
+
+def get_tolid_species(taxonomy_id):
+    return get_tolid('/species/' + str(taxonomy_id))
+
+
+def validate_species_known_in_tolid(sample, context):
     results = []
-    response = requests.get(os.getenv('TOLID_URL', '') + '/species/'
-                            + str(sample.taxonomy_id))
+    response = get_external_response(context, 'tolid_species', sample.taxonomy_id,
+                                     get_tolid_species)
     if (response.status_code == 404):
         results.append({'field': 'TAXON_ID',
                         'message': 'Species not known in the ToLID service',
@@ -311,8 +648,9 @@ def validate_species_known_in_tolid(sample):
 
     if (response.status_code != 200):
         results.append({'field': 'TAXON_ID',
-                        'message': 'Communication failed with the ToLID service: status code '
-                        + str(response.status_code),
+                        'message': 'Communication failed with the ToLID service'
+                        + ('' if response.status_code is None
+                           else ': status code ' + str(response.status_code)),
                         'severity': 'ERROR'})
         return results
 
@@ -321,33 +659,104 @@ def validate_species_known_in_tolid(sample):
     return results
 
 
-# This function actually retrieves the NCBI taxonomy data for the whole manifest
+# This function actually retrieves the NCBI taxonomy data for the whole manifest. Taxa seen
+# before are read from the taxonomy table, and only those missing or older than
+# NCBI_TAXONOMY_MAX_AGE_DAYS are fetched from NCBI.
+# With NCBI_TAXONOMY_BACKEND=taxdump, an index built from an NCBI taxdump is used instead
 def get_ncbi_data(manifest):
-    Entrez.api_key = os.getenv('NIH_API_KEY')
     taxonomy_dict = {}
-    taxon_id_list = [str(x) for x in list(manifest.unique_taxonomy_ids())]
-    if any(id_ for id_ in taxon_id_list):
-        i = 0
-        while i < len(taxon_id_list):
-            window_list = taxon_id_list[i: i + 200]
-            i += 200
-            handle = Entrez.efetch(db='Taxonomy', id=window_list, retmode='xml')
-            records = Entrez.read(handle)
-            for element in records:
-                taxonomy_dict[int(element['TaxId'])] = element
+    taxonomy_ids = [int(x) for x in manifest.unique_taxonomy_ids() if x is not None]
+    if len(taxonomy_ids) == 0:
+        return taxonomy_dict
+
+    if os.getenv('NCBI_TAXONOMY_BACKEND', 'entrez') == 'taxdump':
+        taxdump_index = get_taxdump_index()
+        for taxonomy_id in taxonomy_ids:
+            record = taxdump_index.get(taxonomy_id)
+            if record is not None:
+                taxonomy_dict[taxonomy_id] = record
+        return taxonomy_dict
+
+    stored = {x.taxonomy_id: x for x in db.session.query(SubmissionsTaxonomy)
+              .filter(SubmissionsTaxonomy.taxonomy_id.in_(taxonomy_ids))
+              .all()}
+    stale_before = datetime.now() - timedelta(days=NCBI_TAXONOMY_MAX_AGE_DAYS)
+    to_fetch = []
+    for taxonomy_id in taxonomy_ids:
+        taxonomy = stored.get(taxonomy_id)
+        if taxonomy is not None and taxonomy.updated_at >= stale_before:
+            taxonomy_dict[taxonomy_id] = taxonomy.to_ncbi_dict()
+        else:
+            to_fetch.append(taxonomy_id)
+    if len(to_fetch) == 0:
+        return taxonomy_dict
+
+    try:
+        elements = fetch_ncbi_taxonomy(to_fetch)
+    except (HTTPError, URLError) as e:
+        # Make do with what we had before if we can
+        if any(x not in stored for x in to_fetch):
+            raise
+        logging.warning('Using stale NCBI taxonomy, fetch failed: ' + str(e))
+        for taxonomy_id in to_fetch:
+            taxonomy_dict[taxonomy_id] = stored[taxonomy_id].to_ncbi_dict()
+        return taxonomy_dict
+
+    rows = {}
+    for element in elements:
+        taxonomy = SubmissionsTaxonomy(taxonomy_id=int(element['TaxId']),
+                                       rank=str(element['Rank']),
+                                       scientific_name=str(element['ScientificName']),
+                                       lineage=[{'TaxId': str(x['TaxId']),
+                                                 'ScientificName': str(x['ScientificName']),
+                                                 'Rank': str(x['Rank'])}
+                                                for x in element['LineageEx']],
+                                       updated_at=datetime.now())
+        taxonomy_dict[taxonomy.taxonomy_id] = taxonomy.to_ncbi_dict()
+        rows[taxonomy.taxonomy_id] = {'taxonomy_id': taxonomy.taxonomy_id,
+                                      'rank': taxonomy.rank,
+                                      'scientific_name': taxonomy.scientific_name,
+                                      'lineage': taxonomy.lineage,
+                                      'updated_at': taxonomy.updated_at}
+    if len(rows) > 0:
+        # In a transaction of its own, so the caller's work isn't committed. Another
+        # request may be storing the same taxa at the same time
+        statement = postgresql.insert(SubmissionsTaxonomy.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=['taxonomy_id'],
+            set_={x: statement.excluded[x]
+                  for x in ['rank', 'scientific_name', 'lineage', 'updated_at']})
+        with db.engine.begin() as connection:
+            connection.execute(statement, list(rows.values()))
+        for taxonomy_id in rows:
+            if taxonomy_id in stored:
+                db.session.expire(stored[taxonomy_id])
     return taxonomy_dict
 
 
-def validate_against_ncbi(sample):
+def fetch_ncbi_taxonomy(taxonomy_ids):
+    Entrez.api_key = os.getenv('NIH_API_KEY')
+    elements = []
+    taxon_id_list = [str(x) for x in taxonomy_ids]
+    i = 0
+    while i < len(taxon_id_list):
+        window_list = taxon_id_list[i: i + 200]
+        i += 200
+        handle = Entrez.efetch(db='Taxonomy', id=window_list, retmode='xml')
+        elements += Entrez.read(handle)
+    return elements
+
+
+def validate_against_ncbi(sample, ncbi_data):
     results = []
 
-    if sample.taxonomy_id not in sample.manifest.ncbi_data:
+    if sample.taxonomy_id not in ncbi_data:
         results.append({'field': 'TAXON_ID',
                         'message': 'Species not known in the NCBI service',
                         'severity': 'ERROR'})
         return results
 
-    ncbi_result = sample.manifest.ncbi_data[sample.taxonomy_id]
+    ncbi_result = ncbi_data[sample.taxonomy_id]
 
     if not sample.is_symbiont() and ncbi_result['Rank'] != 'species':
         results.append({'field': 'TAXON_ID',
@@ -405,22 +814,27 @@ def validate_against_ncbi(sample):
     return results
 
 
-def validate_specimen_against_tolid(sample):
+def get_tolid_specimen(specimen_id):
+    return get_tolid('/specimens/' + str(specimen_id))
+
+
+def validate_specimen_against_tolid(sample, context):
     results = []
     # Do not do this check for symbionts
     if sample.is_symbiont():
         return results
 
-    response = requests.get(os.getenv('TOLID_URL', '') + '/specimens/'
-                            + str(sample.specimen_id))
+    response = get_external_response(context, 'tolid_specimen', sample.specimen_id,
+                                     get_tolid_specimen)
     if (response.status_code == 404):
         # Haven't used this Specimen ID before - nothing to check
         return results
 
     if (response.status_code != 200):
         results.append({'field': 'SPECIMEN_ID',
-                        'message': 'Communication failed with the ToLID service: status code '
-                        + str(response.status_code),
+                        'message': 'Communication failed with the ToLID service'
+                        + ('' if response.status_code is None
+                           else ': status code ' + str(response.status_code)),
                         'severity': 'ERROR'})
         return results
 
@@ -438,206 +852,37 @@ def validate_specimen_against_tolid(sample):
 
 
 def validate_against_ena_checklist(sample):
-    results = []
+    return get_ena_checklist().validate(sample.to_ena_dict())
 
-    ena_fields = sample.to_ena_dict()
 
-    ena_checklist = get_ena_checklist()
-
-    for check in ena_checklist:
-        field_name = check
-        if 'field' in ena_checklist[check]:
-            field_name = ena_checklist[check]['field']
-
-        # Check mandatory fields
-        if ena_checklist[check]['mandatory'] and check not in ena_fields:
-            results.append({'field': field_name,
-                            'message': 'Must be given',
-                            'severity': 'ERROR'})
-            continue
-        if ena_checklist[check]['mandatory'] and ena_fields[check]['value'] == '':
-            results.append({'field': field_name,
-                            'message': 'Must not be empty',
-                            'severity': 'ERROR'})
-            continue
+def get_ena_taxonomy(taxonomy_id):
+    # Returns the status code (None if ENA couldn't be reached) and the parsed taxonomy (None
+    # if not known at ENA)
+    found, cached = ena_taxonomy_cache.get(taxonomy_id)
+    if found:
+        return cached
 
-        # Check against regex
-        if 'regex' in ena_checklist[check] and check in ena_fields:
-            compiled_re = re.compile(ena_checklist[check]['regex'])
-            if not compiled_re.search(ena_fields[check]['value']):
-                results.append({'field': field_name,
-                                'message': 'Must match specific pattern',
-                                'severity': 'ERROR'})
-
-        # Check against allowed values
-        if 'allowed_values' in ena_checklist[check] and check in ena_fields:
-            if ena_fields[check]['value'].lower() not in \
-                    [x.lower() for x in ena_checklist[check]['allowed_values']]:
-                results.append({'field': field_name,
-                                'message': 'Must be in allowed values',
-                                'severity': 'ERROR'})
+    try:
+        response = get_session('ena').get('https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/'
+                                          + str(taxonomy_id))
+    except requests.RequestException as e:
+        # Reported for the rows that needed it, with no status code
+        logging.warning('ENA taxonomy lookup failed: ' + str(e))
+        return None, None
+    if (response.status_code != 200):
+        # Don't remember failures
+        return response.status_code, None
 
-    return results
+    if response.text == 'No results.':
+        ena_taxonomy = (response.status_code, None)
+        ena_taxonomy_cache.set(taxonomy_id, ena_taxonomy, ttl=ENA_TAXONOMY_CACHE_NEGATIVE_TTL)
+    else:
+        ena_taxonomy = (response.status_code, response.json())
+        ena_taxonomy_cache.set(taxonomy_id, ena_taxonomy)
+    return ena_taxonomy
 
 
-def get_ena_checklist():
-    return {'organism part': {'mandatory': True,
-                              'field': 'ORGANISM_PART'},
-            'lifestage': {'mandatory': True,
-                          'field': 'LIFESTAGE',
-                          'allowed_values': ['adult', 'egg', 'embryo', 'gametophyte', 'juvenile',
-                                             'larva', 'not applicable', 'not collected',
-                                             'not provided', 'pupa', 'spore-bearing structure',
-                                             'sporophyte', 'vegetative cell',
-                                             'vegetative structure', 'zygote']},
-            'project name': {'mandatory': True},
-            # 'tolid': {'mandatory': True,
-            #           'regex': r'(^[a-z]{1}[A-Z]{1}[a-z]{2}[A-Z]{1}[a-z]{2}[0-9]*$)|(^[a-z]{2}[A-Z]{1}[a-z]{2}[A-Z]{1}[a-z]{3}[0-9]*$)'},  # noqa
-            'collected by': {'mandatory': True,
-                             'field': 'COLLECTED_BY'},
-            'collection date': {'mandatory': True,
-                                'field': 'DATE_OF_COLLECTION',
-                                'regex': r'(^[0-9]{4}(-[0-9]{2}(-[0-9]{2}(T[0-9]{2}:[0-9]{2}(:[0-9]{2})?Z?([+-][0-9]{1,2})?)?)?)?(/[0-9]{4}(-[0-9]{2}(-[0-9]{2}(T[0-9]{2}:[0-9]{2}(:[0-9]{2})?Z?([+-][0-9]{1,2})?)?)?)?)?$)|(^not collected$)|(^not provided$)|(^restricted access$)'},  # noqa
-            'geographic location (country and/or sea)': {
-                'mandatory': True,
-                'field': 'COLLECTION_LOCATION',
-                'allowed_values': ['Afghanistan', 'Albania', 'Algeria', 'American Samoa',
-                                   'Andorra', 'Angola', 'Anguilla', 'Antarctica',
-                                   'Antigua and Barbuda', 'Arctic Ocean', 'Argentina', 'Armenia',
-                                   'Aruba', 'Ashmore and Cartier Islands', 'Atlantic Ocean',
-                                   'Australia', 'Austria', 'Azerbaijan', 'Bahamas', 'Bahrain',
-                                   'Baker Island', 'Baltic Sea', 'Bangladesh', 'Barbados',
-                                   'Bassas da India', 'Belarus', 'Belgium', 'Belize', 'Benin',
-                                   'Bermuda', 'Bhutan', 'Bolivia', 'Borneo',
-                                   'Bosnia and Herzegovina', 'Botswana', 'Bouvet Island',
-                                   'Brazil', 'British Virgin Islands', 'Brunei', 'Bulgaria',
-                                   'Burkina Faso', 'Burundi', 'Cambodia', 'Cameroon', 'Canada',
-                                   'Cape Verde', 'Cayman Islands', 'Central African Republic',
-                                   'Chad', 'Chile', 'China', 'Christmas Island',
-                                   'Clipperton Island', 'Cocos Islands', 'Colombia', 'Comoros',
-                                   'Cook Islands', 'Coral Sea Islands', 'Costa Rica',
-                                   "Cote d'Ivoire", 'Croatia', 'Cuba', 'Curacao', 'Cyprus',
-                                   'Czech Republic', 'Democratic Republic of the Congo',
-                                   'Denmark', 'Djibouti', 'Dominica', 'Dominican Republic',
-                                   'East Timor', 'Ecuador', 'Egypt', 'El Salvador',
-                                   'Equatorial Guinea', 'Eritrea', 'Estonia', 'Ethiopia',
-                                   'Europa Island', 'Falkland Islands (Islas Malvinas)',
-                                   'Faroe Islands', 'Fiji', 'Finland', 'France', 'French Guiana',
-                                   'French Polynesia', 'French Southern and Antarctic Lands',
-                                   'Gabon', 'Gambia', 'Gaza Strip', 'Georgia', 'Germany',
-                                   'Ghana', 'Gibraltar', 'Glorioso Islands', 'Greece',
-                                   'Greenland', 'Grenada', 'Guadeloupe', 'Guam', 'Guatemala',
-                                   'Guernsey', 'Guinea', 'Guinea-Bissau', 'Guyana', 'Haiti',
-                                   'Heard Island and McDonald Islands', 'Honduras', 'Hong Kong',
-                                   'Howland Island', 'Hungary', 'Iceland', 'India',
-                                   'Indian Ocean', 'Indonesia', 'Iran', 'Iraq', 'Ireland',
-                                   'Isle of Man', 'Israel', 'Italy', 'Jamaica', 'Jan Mayen',
-                                   'Japan', 'Jarvis Island', 'Jersey', 'Johnston Atoll',
-                                   'Jordan', 'Juan de Nova Island', 'Kazakhstan', 'Kenya',
-                                   'Kerguelen Archipelago', 'Kingman Reef', 'Kiribati', 'Kosovo',
-                                   'Kuwait', 'Kyrgyzstan', 'Laos', 'Latvia', 'Lebanon',
-                                   'Lesotho', 'Liberia', 'Libya', 'Liechtenstein', 'Lithuania',
-                                   'Luxembourg', 'Macau', 'Macedonia', 'Madagascar', 'Malawi',
-                                   'Malaysia', 'Maldives', 'Mali', 'Malta', 'Marshall Islands',
-                                   'Martinique', 'Mauritania', 'Mauritius', 'Mayotte',
-                                   'Mediterranean Sea', 'Mexico', 'Micronesia', 'Midway Islands',
-                                   'Moldova', 'Monaco', 'Mongolia', 'Montenegro', 'Montserrat',
-                                   'Morocco', 'Mozambique', 'Myanmar', 'Namibia', 'Nauru',
-                                   'Navassa Island', 'Nepal', 'Netherlands', 'New Caledonia',
-                                   'New Zealand', 'Nicaragua', 'Niger', 'Nigeria', 'Niue',
-                                   'Norfolk Island', 'North Korea', 'North Sea',
-                                   'Northern Mariana Islands', 'Norway', 'Oman', 'Pacific Ocean',
-                                   'Pakistan', 'Palau', 'Palmyra Atoll', 'Panama',
-                                   'Papua New Guinea', 'Paracel Islands', 'Paraguay', 'Peru',
-                                   'Philippines', 'Pitcairn Islands', 'Poland', 'Portugal',
-                                   'Puerto Rico', 'Qatar', 'Republic of the Congo', 'Reunion',
-                                   'Romania', 'Ross Sea', 'Russia', 'Rwanda', 'Saint Helena',
-                                   'Saint Kitts and Nevis', 'Saint Lucia',
-                                   'Saint Pierre and Miquelon',
-                                   'Saint Vincent and the Grenadines', 'Samoa', 'San Marino',
-                                   'Sao Tome and Principe', 'Saudi Arabia', 'Senegal', 'Serbia',
-                                   'Seychelles', 'Sierra Leone', 'Singapore', 'Sint Maarten',
-                                   'Slovakia', 'Slovenia', 'Solomon Islands', 'Somalia',
-                                   'South Africa',
-                                   'South Georgia and the South Sandwich Islands', 'South Korea',
-                                   'Southern Ocean', 'Spain', 'Spratly Islands', 'Sri Lanka',
-                                   'Sudan', 'Suriname', 'Svalbard', 'Swaziland', 'Sweden',
-                                   'Switzerland', 'Syria', 'Taiwan', 'Tajikistan', 'Tanzania',
-                                   'Tasman Sea', 'Thailand', 'Togo', 'Tokelau', 'Tonga',
-                                   'Trinidad and Tobago', 'Tromelin Island', 'Tunisia',
-                                   'Turkey', 'Turkmenistan', 'Turks and Caicos Islands',
-                                   'Tuvalu', 'USA', 'Uganda', 'Ukraine', 'United Arab Emirates',
-                                   'United Kingdom', 'Uruguay', 'Uzbekistan', 'Vanuatu',
-                                   'Venezuela', 'Viet Nam', 'Virgin Islands', 'Wake Island',
-                                   'Wallis and Futuna', 'West Bank', 'Western Sahara', 'Yemen',
-                                   'Zambia', 'Zimbabwe', 'not applicable', 'not collected',
-                                   'not provided', 'restricted access']},
-                'geographic location (latitude)': {'mandatory': True,
-                                                   'field': 'DECIMAL_LATITUDE',
-                                                   'regex': r'(^[+-]?[0-9]+.?[0-9]{0,8}$)|(^not collected$)|(^not provided$)|(^restricted access$)'},  # noqa
-                'geographic location (longitude)': {'mandatory': True,
-                                                    'field': 'DECIMAL_LONGITUDE',
-                                                    'regex': r'(^[+-]?[0-9]+.?[0-9]{0,8}$)|(^not collected$)|(^not provided$)|(^restricted access$)'},  # noqa
-                'geographic location (region and locality)': {'mandatory': True,
-                                                              'field': 'COLLECTION_LOCATION'},
-                'identified_by': {'mandatory': True,
-                                  'field': 'IDENTIFIED_BY'},
-                'geographic location (depth)': {'mandatory': False,
-                                                'field': 'DEPTH',
-                                                'regex': r'(0|((0\.)|([1-9][0-9]*\.?))[0-9]*)([Ee][+-]?[0-9]+)?'},  # noqa
-                'geographic location (elevation)': {'mandatory': False,
-                                                    'field': 'ELEVATION',
-                                                    'regex': r'[+-]?(0|((0\.)|([1-9][0-9]*\.?))[0-9]*)([Ee][+-]?[0-9]+)?'},  # noqa
-                'habitat': {'mandatory': True,
-                            'field': 'HABITAT'},
-                'identifier_affiliation': {'mandatory': True,
-                                           'field': 'IDENTIFIER_AFFILIATION'},
-                'original collection date': {'mandatory': False,
-                                             'field': 'ORIGINAL_COLLECTION_DATE',
-                                             'regex': r'^[0-9]{4}(-[0-9]{2}(-[0-9]{2}(T[0-9]{2}:[0-9]{2}(:[0-9]{2})?Z?([+-][0-9]{1,2})?)?)?)?(/[0-9]{4}(-[0-9]{2}(-[0-9]{2}(T[0-9]{2}:[0-9]{2}(:[0-9]{2})?Z?([+-][0-9]{1,2})?)?)?)?)?$'},  # noqa
-                'original geographic location': {'mandatory': False,
-                                                 'field': 'ORIGINAL_GEOGRAPHIC_LOCATION'},
-                'sample derived from': {'mandatory': False,
-                                        'regex': r'(^[ESD]R[SR]\d{6,}(,[ESD]R[SR]\d{6,})*$)|(^SAM[END][AG]?\d+(,SAM[END][AG]?\d+)*$)|(^EGA[NR]\d{11}(,EGA[NR]\d{11})*$)|(^[ESD]R[SR]\d{6,}-[ESD]R[SR]\d{6,}$)|(^SAM[END][AG]?\d+-SAM[END][AG]?\d+$)|(^EGA[NR]\d{11}-EGA[NR]\d{11}$)'},  # noqa
-                'sample same as': {'mandatory': False,
-                                   'regex': r'(^[ESD]RS\d{6,}(,[ESD]RS\d{6,})*$)|(^SAM[END][AG]?\d+(,SAM[END][AG]?\d+)*$)|(^EGAN\d{11}(,EGAN\d{11})*$)'},  # noqa
-                'sample symbiont of': {'mandatory': False,
-                                       'regex': r'(^[ESD]RS\d{6,}$)|(^SAM[END][AG]?\d+$)|(^EGAN\d{11}$)'},  # noqa
-                'sex': {'mandatory': True,
-                        'field': 'SEX'},
-                'relationship': {'mandatory': False,
-                                 'field': 'RELATIONSHIP'},
-                'symbiont': {'mandatory': False,
-                             'field': 'SYMBIONT',
-                             'allowed_values': ['N', 'Y']},
-                'collecting institution': {'mandatory': True,
-                                           'field': 'COLLECTOR_AFFILIATION'},
-                'GAL': {'mandatory': True,
-                        'field': 'GAL',
-                        'allowed_values': [
-                            'Dalhousie University', 'Earlham Institute',
-                            'Geomar Helmholtz Centre', 'Marine Biological Association',
-                            'Natural History Museum', 'Nova Southeastern University',
-                            'Portland State University', 'Queen Mary University of London',
-                            'Royal Botanic Garden Edinburgh', 'Royal Botanic Gardens Kew',
-                            'Sanger Institute', 'Senckenberg Research Institute',
-                            'The Sainsbury Laboratory', 'University of British Columbia',
-                            'University of California', 'University of Cambridge',
-                            'University of Derby', 'University of Edinburgh',
-                            'University of Oregon', 'University of Oxford',
-                            'University of Rhode Island', 'University of Vienna (Cephalopod)',
-                            'University of Vienna (Mollusc)']},
-                'specimen_voucher': {'mandatory': True,
-                                     'field': 'VOUCHER_ID'},
-                'specimen_id': {'mandatory': True,
-                                'field': 'SPECIMEN_ID'},
-                'GAL_sample_id': {'mandatory': True,
-                                  'field': 'GAL_SAMPLE_ID'},
-                'culture_or_strain_id': {'mandatory': False,
-                                         'field': 'CULTURE_OR_STRAIN_ID'}}
-
-
-def validate_ena_submittable(sample):
+def validate_ena_submittable(sample, context):
     # https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/9606
     #
     # {
@@ -656,22 +901,22 @@ def validate_ena_submittable(sample):
     # }
     results = []
 
-    response = requests.get('https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/'
-                            + str(sample.taxonomy_id))
-    if (response.status_code != 200):
+    status_code, data = get_external_response(context, 'ena_taxonomy', sample.taxonomy_id,
+                                              get_ena_taxonomy)
+    if (status_code != 200):
         results.append({'field': 'TAXON_ID',
-                        'message': 'Communication with ENA has failed with status code '
-                        + str(response.status_code),
+                        'message': 'Communication with ENA has failed'
+                        + ('' if status_code is None
+                           else ' with status code ' + str(status_code)),
                         'severity': 'ERROR'})
         return results
 
     # Might be an unknown TAX_ID
-    if response.text == 'No results.':
+    if data is None:
         results.append({'field': 'TAXON_ID',
                         'message': 'Is not known at ENA',
                         'severity': 'ERROR'})
         return results
-    data = response.json()
 
     # ENA submittable?
     if data['submittable'] != 'true':
@@ -687,61 +932,69 @@ def validate_ena_submittable(sample):
     return results
 
 
-def set_relationships_for_manifest(manifest):
+def set_relationships_for_manifest(manifest, retries=0, retry_delay=0):
     error_count = 0
     results = []
+    specimens = get_specimens([sample.specimen_id for sample in manifest.samples])
     for sample in manifest.samples:
-        set_relationships_for_sample(sample)
+        set_relationships_for_sample(sample, specimens[sample.specimen_id])
 
     # Any with no relationship set need a new specimen submitting to ENA
-    new_specimen_samples = []
-    seen = set()
+    new_specimen_samples = {}
     for sample in manifest.samples:
         if sample.sample_same_as is None and sample.sample_derived_from is None \
                 and sample.sample_symbiont_of is None:
-            if sample.specimen_id not in seen:
-                seen.add(sample.specimen_id)
-                new_specimen_samples.append(sample)
+            new_specimen_samples.setdefault(sample.specimen_id, sample)
 
     if len(new_specimen_samples) > 0:
         specimen_manifest = SubmissionsManifest()
         specimen_manifest.user = manifest.user
-        for sample in new_specimen_samples:
+        for sample in new_specimen_samples.values():
             specimen_sample = make_specimen_sample(sample)
             specimen_sample.manifest = specimen_manifest
-            db.session.add(specimen_sample)
         db.session.add(specimen_manifest)
-        db.session.commit()
+        # The specimen samples need their IDs for the submission
+        db.session.flush()
         # Submit this specimen_manifest to ENA
-        error_count, results = generate_ena_ids_for_manifest(specimen_manifest)
-
-        if error_count == 0:
-            # Save the specimens
-            for specimen_sample in specimen_manifest.samples:
-                specimen = SubmissionsSpecimen()
-                specimen.specimen_id = specimen_sample.specimen_id
-                specimen.biosample_accession = specimen_sample.biosample_accession
-                db.session.add(specimen)
-                db.session.commit()
-
-            # Update relationships to pick up these new ones
-            for sample in manifest.samples:
-                set_relationships_for_sample(sample)
-                db.session.commit()
-
+        error_count, results = generate_ena_ids_for_manifest(specimen_manifest,
+                                                             retries=retries,
+                                                             retry_delay=retry_delay)
+
+        # Save the specimens ENA accepted, even if it didn't accept them all, so that they
+        # aren't submitted again next time
+        for specimen_sample in specimen_manifest.samples:
+            if specimen_sample.biosample_accession is None:
+                continue
+            specimen = SubmissionsSpecimen()
+            specimen.specimen_id = specimen_sample.specimen_id
+            specimen.biosample_accession = specimen_sample.biosample_accession
+            db.session.add(specimen)
+            specimens[specimen.specimen_id] = specimen
+
+        # Update relationships to pick up these new ones
+        for sample in manifest.samples:
+            if sample.specimen_id in new_specimen_samples:
+                set_relationships_for_sample(sample, specimens[sample.specimen_id])
+
+    # Also commits the specimens when some weren't accepted, as generate_ids_for_manifest
+    # does for the samples
+    db.session.commit()
     return error_count, results
 
 
-def set_relationships_for_sample(sample):
-    # Look up previous specimens
-    specimen = db.session.query(SubmissionsSpecimen) \
-        .filter(SubmissionsSpecimen.specimen_id == sample.specimen_id) \
-        .one_or_none()
+def get_specimens(specimen_ids):
+    """Finds each distinct specimen once, from those we have already submitted with one
+    query, then in STS. Returns {specimen ID: specimen, or None if it is new}"""
+    specimens = dict.fromkeys(specimen_ids)
+    for specimen in db.session.query(SubmissionsSpecimen) \
+            .filter(SubmissionsSpecimen.specimen_id.in_(list(specimens))):
+        specimens[specimen.specimen_id] = specimen
+    specimens.update(get_specimens_sts(
+        [specimen_id for specimen_id, specimen in specimens.items() if specimen is None]))
+    return specimens
 
-    if specimen is None:
-        # Look up in STS
-        specimen = get_specimen_sts(sample.specimen_id)
 
+def set_relationships_for_sample(sample, specimen):
     if specimen is not None:
         if sample.is_symbiont():
             sample.sample_symbiont_of = specimen.biosample_accession
@@ -786,8 +1039,10 @@ def make_specimen_sample(sample):
     return specimen_sample
 
 
-def generate_ids_for_manifest(manifest):
+def generate_ids_for_manifest(manifest, report_progress=ignore_progress, retries=0,
+                              retry_delay=0):
     # ToLIDs
+    report_progress('tolids', 0)
     error_count, results = generate_tolids_for_manifest(manifest)
 
     if error_count > 0:
@@ -795,15 +1050,21 @@ def generate_ids_for_manifest(manifest):
         return error_count, results
 
     # sampleSameAs, sampleDerivedFrom (specimens)
-    error_count, results = set_relationships_for_manifest(manifest)
+    report_progress('relationships', 20)
+    error_count, results = set_relationships_for_manifest(manifest, retries=retries,
+                                                          retry_delay=retry_delay)
     if error_count > 0:
         # Something has gone wrong with the ENA assignment
         return error_count, results
 
     # ENA IDs
-    error_count, results = generate_ena_ids_for_manifest(manifest)
+    report_progress('ena', 50)
+    error_count, results = generate_ena_ids_for_manifest(manifest, retries=retries,
+                                                         retry_delay=retry_delay)
     if error_count > 0:
-        # Something has gone wrong with the ENA assignment
+        # Something has gone wrong with the ENA assignment. Keep the accessions of any
+        # chunks that were submitted, so only the rest are submitted next time
+        db.session.commit()
         return error_count, results
 
     db.session.commit()
@@ -814,18 +1075,18 @@ def generate_tolids_for_manifest(manifest):
     results = []
     error_count = 0
     # ToLIDs
-    # List of taxon-specimen pairs
-    taxon_specimens = []
+    # List of taxon-specimen pairs, and the samples for each pair in row order
+    taxon_specimens = {}
+    samples_by_specimen_taxon = {}
     for sample in manifest.samples:
+        key = (sample.specimen_id, int(sample.taxonomy_id))
+        samples_by_specimen_taxon.setdefault(key, []).append(sample)
         if not sample.is_symbiont() and sample.taxonomy_id != 32644:
-            taxon_specimen = {'taxonomyId': sample.taxonomy_id,
-                              'specimenId': sample.specimen_id}
-            if taxon_specimen not in taxon_specimens:
-                taxon_specimens.append(taxon_specimen)
-
-    response = requests.post(os.getenv('TOLID_URL', '') + '/tol-ids',
-                             json=taxon_specimens,
-                             headers={'api-key': os.getenv('TOLID_API_KEY')})
+            taxon_specimens.setdefault(key, {'taxonomyId': sample.taxonomy_id,
+                                             'specimenId': sample.specimen_id})
+
+    response = get_session('tolid').post(os.getenv('TOLID_URL', '') + '/tol-ids',
+                                         json=list(taxon_specimens.values()))
     if (response.status_code != 200):
         results.append({'row': sample.row,
                         'results': [{'field': 'TAXON_ID',
@@ -834,13 +1095,8 @@ def generate_tolids_for_manifest(manifest):
         return 1, results
 
     for tolid in response.json():
-        samples_to_update = db.session.query(SubmissionsSample) \
-            .filter(SubmissionsSample.manifest == manifest) \
-            .filter(SubmissionsSample.specimen_id == tolid['specimen']['specimenId']) \
-            .filter(SubmissionsSample.taxonomy_id == tolid['species']['taxonomyId']) \
-            .order_by(SubmissionsSample.row) \
-            .all()
-        for sample_to_update in samples_to_update:
+        key = (tolid['specimen']['specimenId'], int(tolid['species']['taxonomyId']))
+        for sample_to_update in samples_by_specimen_taxon.get(key, []):
             if 'tolId' in tolid:
                 sample_to_update.tolid = tolid['tolId']
             else:
@@ -850,7 +1106,6 @@ def generate_tolids_for_manifest(manifest):
                                              'message': 'A ToLID has not been generated',
                                              'severity': 'ERROR'}]})
                 error_count += 1
-
     if error_count > 0:
         return error_count, results
 
@@ -858,54 +1113,127 @@ def generate_tolids_for_manifest(manifest):
     return 0, []
 
 
-def generate_ena_ids_for_manifest(manifest):
-    results = []
-    error_count = 0
-    bundle_xml_file, sample_count = build_bundle_sample_xml(manifest)
-    if sample_count == 0:
-        results.append({'row': 1,
-                        'results': [{'field': 'TAXON_ID',
-                                     'message': 'All samples have unknown taxonomy ID',
-                                    'severity': 'WARNING'}]})
-        return 1, results
-    submission_xml_file = build_submission_xml(manifest)
-    xml_files = [('SAMPLE', open(bundle_xml_file, 'rb')),
-                 ('SUBMISSION', open(submission_xml_file, 'rb'))]
-    response = requests.post(os.getenv('ENA_URL', '') + '/ena/submit/drop-box/submit/',
-                             files=xml_files,
-                             auth=HTTPBasicAuth(os.getenv('ENA_USERNAME'),
-                                                os.getenv('ENA_PASSWORD')))
+def generate_ena_ids_for_manifest(manifest, retries=0, retry_delay=0):
+    """Submits the samples to ENA. Chunks that fail to reach ENA are tried up to retries
+    more times, waiting retry_delay seconds before the first retry and twice as long
+    before each one after"""
+    if len(manifest.samples) == 0:
+        return 1, [{'row': 1,
+                    'results': [{'field': 'TAXON_ID',
+                                 'message': 'All samples have unknown taxonomy ID',
+                                 'severity': 'WARNING'}]}]
+
+    chunks = plan_ena_submission(manifest)
+    pending = submit_ena_chunks(manifest, chunks)
+    for retry in range(retries):
+        if not pending:
+            break
+        # Give ENA a moment to recover rather than failing again straight away
+        time.sleep(retry_delay * 2 ** retry)
+        pending = submit_ena_chunks(manifest, pending)
 
-    if (response.status_code != 200):
-        results.append({'row': 1,
-                        'results': [{'field': 'TAXON_ID',
-                                     'message': 'Cannot connect to ENA service (status code '
-                                     + str(response.status_code) + ')',
-                                    'severity': 'ERROR'}]})
-        return 1, results
-
-    if not assign_ena_ids(manifest, response.text):
-        results.append({'row': 1,
+    results = []
+    for chunk in chunks:
+        if chunk['status'] == 'failed':
+            message = 'Cannot connect to ENA service' if chunk['status_code'] is None \
+                else 'Cannot connect to ENA service (status code ' \
+                + str(chunk['status_code']) + ')'
+        elif chunk['status'] == 'rejected':
+            message = 'Error returned from ENA service'
+        else:
+            continue
+        results.append({'row': chunk['samples'][0].row,
                         'results': [{'field': 'TAXON_ID',
-                                     'message': 'Error returned from ENA service',
+                                     'message': message,
                                      'severity': 'ERROR'}]})
-        return 1, results
-    return error_count, results
 
+    if any(chunk['status'] != 'failed' for chunk in chunks):
+        # Accepted by ENA only if every chunk was
+        manifest.submission_status = len(results) == 0
+    return len(results), results
+
+
+def plan_ena_submission(manifest):
+    """Splits the samples that don't have accessions yet into chunks of ENA_CHUNK_SIZE,
+    so that resubmitting a manifest only sends the chunks that failed before"""
+    samples = [sample for sample in manifest.samples if sample.biosample_accession is None]
+    return [{'samples': samples[i:i + ENA_CHUNK_SIZE],
+             'status': 'pending',
+             'status_code': None}
+            for i in range(0, len(samples), ENA_CHUNK_SIZE)]
+
+
+def submit_ena_chunks(manifest, chunks):
+    """Submits the chunks concurrently and records the receipts against their samples.
+    Returns the chunks that couldn't be submitted and are worth trying again"""
+    retry = []
+    # Only as many chunks' XML as can be submitted at once is kept
+    concurrency = get_concurrency('ena')
+    for i in range(0, len(chunks), concurrency):
+        batch = chunks[i:i + concurrency]
+        # The XML is built here rather than in the lookups, as it reads from the session
+        files = [(build_bundle_sample_xml(chunk['samples'])[0], build_submission_xml(manifest))
+                 for chunk in batch]
+        try:
+            ena_responses = run_lookups([('ena', post_ena_submission, chunk_files)
+                                         for chunk_files in files])
+        finally:
+            for bundle_xml, submission_xml in files:
+                bundle_xml.close()
+                submission_xml.close()
+
+        for chunk, response in zip(batch, ena_responses):
+            if response is None or response.status_code != 200:
+                chunk['status'] = 'failed'
+                chunk['status_code'] = None if response is None else response.status_code
+                # Only worth retrying if ENA might be able to take it next time
+                if response is None or response.status_code >= 500:
+                    retry.append(chunk)
+            elif assign_ena_ids(manifest, response.text, chunk['samples']):
+                chunk['status'] = 'submitted'
+            else:
+                chunk['status'] = 'rejected'
+    return retry
 
-def assign_ena_ids(manifest, xml):
+
+def post_ena_submission(bundle_xml, submission_xml):
+    # Streamed from the files, as requests would read them into memory to build the body
+    body = MultipartFileStream([
+        ('SAMPLE', ('sample.xml', bundle_xml, 'application/xml')),
+        ('SUBMISSION', ('submission.xml', submission_xml, 'application/xml'))])
+    try:
+        return get_session('ena').post(
+            os.getenv('ENA_URL', '') + '/ena/submit/drop-box/submit/',
+            data=body,
+            headers={'Content-Type': body.content_type},
+            auth=HTTPBasicAuth(os.getenv('ENA_USERNAME'), os.getenv('ENA_PASSWORD')))
+    except requests.RequestException as e:
+        logging.warning('ENA submission failed: ' + str(e))
+        return None
+
+
+def get_samples_by_alias(samples):
+    # ENA receipts refer to samples by the alias they were submitted with, their sample_id
+    return {str(sample.sample_id): sample for sample in samples}
+
+
+def assign_ena_ids(manifest, xml, samples=None):
+    """Records an ENA receipt against the samples that were submitted, by default all of
+    the manifest's. Returns whether ENA accepted them"""
+    if samples is None:
+        samples = manifest.samples
     try:
-        tree = ElementTree.fromstring(xml)
+        receipt = ElementTree.fromstring(xml)
     except ElementTree.ParseError:
         #  message = ' Unrecognized response from ENA - ' + str(
         #    xml) + ' Please try again later, if it persists contact admins'
         return False
 
-    success_status = tree.get('success')
+    success_status = receipt.get('success')
     if success_status == 'false':
         manifest.submission_status = False
         msg = ''
-        error_blocks = tree.find('MESSAGES').findall('ERROR')
+        error_blocks = receipt.find('MESSAGES').findall('ERROR')
         for error in error_blocks:
             msg += error.text + '<br>'
         if not msg:
@@ -913,35 +1241,27 @@ def assign_ena_ids(manifest, xml):
         # status = {'status': 'error', 'msg': msg}
         # print(status)
         logging.warning(msg)
-        for child in tree.iter():
-            if child.tag == 'SAMPLE':
-                sample_id = child.get('alias')
-                sample = db.session.query(SubmissionsSample) \
-                    .filter(SubmissionsSample.manifest == manifest) \
-                    .filter(SubmissionsSample.sample_id == sample_id) \
-                    .one_or_none()
+        samples_by_alias = get_samples_by_alias(samples)
+        for child in receipt.iterfind('SAMPLE'):
+            sample = samples_by_alias.get(child.get('alias'))
+            if sample is not None:
                 sample.submission_error = msg
         return False
     else:
         manifest.submission_status = True
-        return assign_biosample_accessions(manifest, xml)
-
-
-def assign_biosample_accessions(manifest, xml):
-    tree = ElementTree.fromstring(xml)
-    submission_accession = tree.find('SUBMISSION').get('accession')
-    for child in tree.iter():
-        if child.tag == 'SAMPLE':
-            sample_id = child.get('alias')
-            sra_accession = child.get('accession')
-            biosample_accession = child.find('EXT_ID').get('accession')
-            sample = db.session.query(SubmissionsSample) \
-                .filter(SubmissionsSample.manifest == manifest) \
-                .filter(SubmissionsSample.sample_id == sample_id) \
-                .one_or_none()
-            if sample is None:
-                continue
-            sample.biosample_accession = biosample_accession
-            sample.sra_accession = sra_accession
-            sample.submission_accession = submission_accession
+        return assign_biosample_accessions(samples, receipt)
+
+
+def assign_biosample_accessions(samples, receipt):
+    """Copies the accessions from a successful ENA receipt, already parsed, to the samples"""
+    submission_accession = receipt.find('SUBMISSION').get('accession')
+    samples_by_alias = get_samples_by_alias(samples)
+    for child in receipt.iterfind('SAMPLE'):
+        sample = samples_by_alias.get(child.get('alias'))
+        if sample is None:
+            continue
+        sample.biosample_accession = child.find('EXT_ID').get('accession')
+        sample.sra_accession = child.get('accession')
+        sample.submission_accession = submission_accession
+        sample.submission_error = None
     return True
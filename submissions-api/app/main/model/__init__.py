@@ -4,10 +4,13 @@
 
 from .base import db, Base  # noqa
 
+from .submissions_job import SubmissionsJob  # noqa
 from .submissions_manifest import SubmissionsManifest  # noqa
 from .submissions_role import SubmissionsRole  # noqa
 from .submissions_sample import SubmissionsSample  # noqa
 from .submissions_sample_field import SubmissionsSampleField # noqa
 from .submissions_specimen import SubmissionsSpecimen  # noqa
 from .submissions_state import SubmissionsState  # noqa
+from .submissions_taxonomy import SubmissionsTaxonomy  # noqa
 from .submissions_user import SubmissionsUser  # noqa
+from .submissions_validation import SubmissionsValidation  # noqa
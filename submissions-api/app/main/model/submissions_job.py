@@ -0,0 +1,39 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from .base import Base, db
+
+
+class SubmissionsJob(Base):
+    # Work on a manifest queued to be run by the job worker rather than in the request
+    __tablename__ = 'job'
+    # For the worker to find the next job to run
+    __table_args__ = (db.Index('ix_job_status_job_id', 'status', 'job_id'),)
+    job_id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(), nullable=False)
+    manifest_id = db.Column(db.Integer, db.ForeignKey('manifest.manifest_id'), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    status = db.Column(db.String(), nullable=False, default='queued')
+    phase = db.Column(db.String(), nullable=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.String(), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=db.func.now())
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Kept up to date while the job is running, to show its worker hasn't stopped
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {'jobId': self.job_id,
+                'kind': self.kind,
+                'manifestId': self.manifest_id,
+                'status': self.status,
+                'phase': self.phase,
+                'progress': self.progress,
+                'result': self.result,
+                'error': self.error,
+                'createdAt': self.created_at,
+                'startedAt': self.started_at,
+                'finishedAt': self.finished_at}
@@ -4,11 +4,15 @@
 
 import re
 
+from main.checklist_utils import get_ena_checklist
+
 from .base import Base, db
 
 
 class SubmissionsSample(Base):
     __tablename__ = 'sample'
+    __table_args__ = (db.Index('ix_sample_manifest_id_specimen_id_taxonomy_id',
+                               'manifest_id', 'specimen_id', 'taxonomy_id'),)
     row = db.Column(db.Integer, nullable=False)
     specimen_id = db.Column(db.String(), nullable=False)
     sample_id = db.Column(db.Integer, primary_key=True)
@@ -74,17 +78,22 @@ class SubmissionsSample(Base):
     barcode_hub = db.Column(db.String(), nullable=True)
 
     tolid = db.Column(db.String(), nullable=True)
-    biosample_accession = db.Column(db.String(), nullable=True)
+    biosample_accession = db.Column(db.String(), nullable=True, index=True)
     sra_accession = db.Column(db.String(), nullable=True)
     submission_accession = db.Column(db.String(), nullable=True)
     submission_error = db.Column(db.String(), nullable=True)
 
-    sample_same_as = db.Column(db.String(), nullable=True)
-    sample_derived_from = db.Column(db.String(), nullable=True)
-    sample_symbiont_of = db.Column(db.String(), nullable=True)
+    # The results of the single-row checks when the sample was last validated, and the
+    # hash of what they depend on
+    validation_hash = db.Column(db.String(), nullable=True)
+    validation_results = db.Column(db.JSON(), nullable=True)
+
+    sample_same_as = db.Column(db.String(), nullable=True, index=True)
+    sample_derived_from = db.Column(db.String(), nullable=True, index=True)
+    sample_symbiont_of = db.Column(db.String(), nullable=True, index=True)
 
     sample_fields = db.relationship('SubmissionsSampleField', back_populates='sample',
-                                    lazy=False, order_by='SubmissionsSampleField.name')
+                                    order_by='SubmissionsSampleField.name')
 
     def collection_country(self):
         return re.split(r'\s*\|\s*', self.collection_location)[0]
@@ -102,7 +111,7 @@ class SubmissionsSample(Base):
 
     def to_ena_dict(self):
         # Listed in the order they appear on the ENA checklist
-        ret = {'ENA-CHECKLIST': {'value': 'ERC000053'}}
+        ret = {'ENA-CHECKLIST': {'value': get_ena_checklist().checklist}}
         ret['organism part'] = {'value': self.organism_part.replace('_', ' ')}
         ret['lifestage'] = {
             'value': 'spore-bearing structure' if self.lifestage == 'SPORE_BEARING_STRUCTURE'
@@ -0,0 +1,22 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from .base import Base, db
+
+
+class SubmissionsTaxonomy(Base):
+    # Taxonomy records previously retrieved from NCBI
+    __tablename__ = 'taxonomy'
+    taxonomy_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.String(), nullable=False)
+    scientific_name = db.Column(db.String(), nullable=False)
+    lineage = db.Column(db.JSON, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=db.func.now())
+
+    def to_ncbi_dict(self):
+        # The same shape as the parts of an Entrez taxonomy record that we use
+        return {'TaxId': str(self.taxonomy_id),
+                'Rank': self.rank,
+                'ScientificName': self.scientific_name,
+                'LineageEx': self.lineage}
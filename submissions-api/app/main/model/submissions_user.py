@@ -13,7 +13,7 @@ class SubmissionsUser(Base):
     organisation = db.Column(db.String(), nullable=True)
     api_key = db.Column(db.String(), nullable=True, unique=True)
     token = db.Column(db.String(), nullable=True, unique=True)
-    roles = db.relationship('SubmissionsRole', lazy=False)
+    roles = db.relationship('SubmissionsRole')
 
     def to_dict(self):
         return {'name': self.name,
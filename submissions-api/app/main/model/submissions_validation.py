@@ -0,0 +1,17 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from .base import Base, db
+
+
+class SubmissionsValidation(Base):
+    # Results of validating submitted manifests, by get_validation_cache_key, so that a
+    # manifest submitted again to any worker while they are recent isn't validated again
+    __tablename__ = 'validation'
+    # For clearing out those that have expired
+    __table_args__ = (db.Index('ix_validation_expires_at', 'expires_at'),)
+    cache_key = db.Column(db.String(), primary_key=True)
+    number_of_errors = db.Column(db.Integer, nullable=False)
+    validations = db.Column(db.JSON, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
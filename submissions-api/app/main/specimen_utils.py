@@ -4,10 +4,10 @@
 
 import os
 
+from main.http_utils import get_session
+from main.lookup_utils import run_lookups
 from main.model.submissions_specimen import SubmissionsSpecimen
 
-import requests
-
 
 def process_specimen_sts(specimen_sts):
     specimen = SubmissionsSpecimen()
@@ -19,11 +19,9 @@ def process_specimen_sts(specimen_sts):
 
 
 def get_specimen_sts(specimen_id):
-    response = requests.get(
+    response = get_session('sts').get(
         os.getenv('STS_URL', '') + '/specimens',
-        params={'specimen_id': specimen_id},
-        headers={'Project': 'ALL',
-                 'Authorization': os.getenv('STS_API_KEY')}
+        params={'specimen_id': specimen_id}
     )
     if response.status_code != 200:
         return None
@@ -35,12 +33,19 @@ def get_specimen_sts(specimen_id):
     return process_specimen_sts(data[0])
 
 
+def get_specimens_sts(specimen_ids):
+    """Looks up each distinct specimen once, concurrently.
+    Returns {specimen ID: specimen, or None if STS doesn't have it}"""
+    specimen_ids = list(dict.fromkeys(specimen_ids))
+    results = run_lookups([('sts', get_specimen_sts, (specimen_id,))
+                           for specimen_id in specimen_ids])
+    return dict(zip(specimen_ids, results))
+
+
 def get_biospecimen_sts(biospecimen_id):
-    response = requests.get(
+    response = get_session('sts').get(
         os.getenv('STS_URL', '') + '/specimens',
-        params={'bio_specimen_id': biospecimen_id},
-        headers={'Project': 'ALL',
-                 'Authorization': os.getenv('STS_API_KEY')}
+        params={'bio_specimen_id': biospecimen_id}
     )
     if response.status_code != 200:
         return None
@@ -50,3 +55,37 @@ def get_biospecimen_sts(biospecimen_id):
         return None
 
     return process_specimen_sts(data[0])
+
+
+def get_sample_sts(specimen_id):
+    """Returns (sample details, None) for a sample of the specimen, or (None, error)"""
+    # This is a bit of a fudge because we have to choose a sample from the specimen, which
+    # only really works if we don't resample the same specimen
+    response = get_session('sts').post(os.getenv('STS_URL', '') + '/samples',
+                                       json={'specimen_specimen_id': specimen_id})
+    if response.status_code != 200:
+        return None, 'Specimen does not exist in STS: ' + str(specimen_id)
+    samples = response.json()['data']['list']
+    if len(samples) < 1:
+        return None, 'Samples do not exist in STS: ' + str(specimen_id)
+
+    # We don't get all the info we need on this endpoint, so we will use this to call
+    # another endpoint which does have the details
+    response = get_session('sts').get(os.getenv('STS_URL', '') + '/samples/detail',
+                                      params={'rack_id': samples[0].get('sample_rackid', None),
+                                              'tube_id': samples[0].get('sample_tubeid', None)})
+    if response.status_code != 200:
+        return None, 'Specimen does not exist in STS: ' + str(specimen_id)
+    sample_sts = response.json()['data']
+    if len(sample_sts) < 1:
+        return None, 'Sample does not exist in STS: ' + str(specimen_id)
+    return sample_sts, None
+
+
+def get_samples_sts(specimen_ids):
+    """Looks up each distinct specimen once, concurrently.
+    Returns {specimen ID: (sample details, error)}"""
+    specimen_ids = list(dict.fromkeys(specimen_ids))
+    results = run_lookups([('sts', get_sample_sts, (specimen_id,))
+                           for specimen_id in specimen_ids])
+    return dict(zip(specimen_ids, results))
@@ -0,0 +1,181 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+# Index file layout, little-endian and indexed directly by taxon ID:
+#   header: MAGIC, size (largest taxon ID + 1), length of rank names JSON, length of names
+#   rank names JSON, padded to 4 bytes
+#   parents: uint32[size]
+#   merged: uint32[size], the taxon each merged taxon ID is now part of, otherwise 0
+#   name offsets: uint32[size] into the names
+#   name lengths: uint16[size], 0 where there is no such taxon
+#   ranks: uint8[size] into the rank names
+#   names: UTF-8 scientific names
+MAGIC = b'TOLTAX02'
+HEADER = struct.Struct('<8sIII')
+ROOT_TAXONOMY_ID = 1
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _dmp_rows(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n').rstrip('\t|').split('\t|\t')
+
+
+def build_taxdump_index(nodes_path, names_path, merged_path, index_path):
+    """Builds an index file from the nodes.dmp, names.dmp and merged.dmp in an NCBI
+    taxdump"""
+    parents = {}
+    ranks = {}
+    for row in _dmp_rows(nodes_path):
+        taxonomy_id = int(row[0])
+        parents[taxonomy_id] = int(row[1])
+        ranks[taxonomy_id] = row[2]
+    names = {}
+    for row in _dmp_rows(names_path):
+        if row[3] == 'scientific name':
+            names[int(row[0])] = row[1]
+    merged = {int(row[0]): int(row[1]) for row in _dmp_rows(merged_path)}
+
+    size = max(max(parents), max(merged, default=0)) + 1
+    rank_names = sorted(set(ranks.values()))
+    rank_numbers = {rank: i for i, rank in enumerate(rank_names)}
+    parent_array = array.array('I', bytes(4 * size))
+    merged_array = array.array('I', bytes(4 * size))
+    offset_array = array.array('I', bytes(4 * size))
+    length_array = array.array('H', bytes(2 * size))
+    rank_array = array.array('B', bytes(size))
+    names_blob = bytearray()
+    for taxonomy_id, parent_id in parents.items():
+        name = names.get(taxonomy_id, '').encode('utf-8')
+        parent_array[taxonomy_id] = parent_id
+        offset_array[taxonomy_id] = len(names_blob)
+        length_array[taxonomy_id] = len(name)
+        rank_array[taxonomy_id] = rank_numbers[ranks[taxonomy_id]]
+        names_blob += name
+    for taxonomy_id, current_id in merged.items():
+        merged_array[taxonomy_id] = current_id
+
+    rank_json = json.dumps(rank_names).encode('utf-8')
+    rank_json += b' ' * (-len(rank_json) % 4)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, size, len(rank_json), len(names_blob)))
+        f.write(rank_json)
+        for a in [parent_array, merged_array, offset_array, length_array, rank_array]:
+            if sys.byteorder == 'big':
+                a.byteswap()
+            a.tofile(f)
+        f.write(names_blob)
+    # Workers already using the old index keep their mapping
+    os.replace(tmp_path, index_path)
+
+
+class TaxdumpIndex:
+    """Read-only view of an index file. The file is memory-mapped, so processes using
+    the same file share a single copy"""
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, rank_length, names_length = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError('Not a taxdump index, or from another version: ' + index_path)
+        view = memoryview(self.mmap)
+        start = HEADER.size
+        self.rank_names = json.loads(bytes(view[start:start + rank_length]))
+        start += rank_length
+        self.parents = self._array(view[start:start + 4 * self.size], 'I')
+        start += 4 * self.size
+        self.merged = self._array(view[start:start + 4 * self.size], 'I')
+        start += 4 * self.size
+        self.name_offsets = self._array(view[start:start + 4 * self.size], 'I')
+        start += 4 * self.size
+        self.name_lengths = self._array(view[start:start + 2 * self.size], 'H')
+        start += 2 * self.size
+        self.ranks = view[start:start + self.size]
+        start += self.size
+        self.names = view[start:start + names_length]
+
+    @staticmethod
+    def _array(view, typecode):
+        if sys.byteorder == 'little':
+            return view.cast(typecode)
+        # The file is little-endian, so needs a copy of its own here
+        a = array.array(typecode, view)
+        a.byteswap()
+        return a
+
+    def current(self, taxonomy_id):
+        """The taxon ID a merged taxon ID is now part of, otherwise the same taxon ID"""
+        if 0 < taxonomy_id < self.size and self.merged[taxonomy_id] > 0:
+            return self.merged[taxonomy_id]
+        return taxonomy_id
+
+    def __contains__(self, taxonomy_id):
+        return 0 < taxonomy_id < self.size and self.name_lengths[taxonomy_id] > 0
+
+    def rank(self, taxonomy_id):
+        return self.rank_names[self.ranks[taxonomy_id]]
+
+    def scientific_name(self, taxonomy_id):
+        offset = self.name_offsets[taxonomy_id]
+        return str(self.names[offset:offset + self.name_lengths[taxonomy_id]], 'utf-8')
+
+    def lineage(self, taxonomy_id):
+        """Ancestor taxon IDs, from the top down, not including the root or the taxon"""
+        ancestors = []
+        taxonomy_id = self.parents[taxonomy_id]
+        while taxonomy_id != ROOT_TAXONOMY_ID and taxonomy_id not in ancestors:
+            ancestors.append(taxonomy_id)
+            taxonomy_id = self.parents[taxonomy_id]
+        ancestors.reverse()
+        return ancestors
+
+    def ancestor(self, taxonomy_id, rank):
+        for ancestor_id in reversed(self.lineage(taxonomy_id)):
+            if self.rank(ancestor_id) == rank:
+                return self.scientific_name(ancestor_id)
+        return None
+
+    def get(self, taxonomy_id):
+        """The same shape as the parts of an Entrez taxonomy record that we use, or None.
+        As with Entrez, a merged taxon ID gives the record of the taxon it is now part of"""
+        taxonomy_id = self.current(taxonomy_id)
+        if taxonomy_id not in self:
+            return None
+        return {'TaxId': str(taxonomy_id),
+                'Rank': self.rank(taxonomy_id),
+                'ScientificName': self.scientific_name(taxonomy_id),
+                'LineageEx': [{'TaxId': str(x),
+                               'ScientificName': self.scientific_name(x),
+                               'Rank': self.rank(x)}
+                              for x in self.lineage(taxonomy_id)]}
+
+
+def get_taxdump_index():
+    # Opened on first use, so that each uWSGI worker maps the file after forking
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = TaxdumpIndex(os.environ['NCBI_TAXDUMP_INDEX'])
+    return _index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.exit('Usage: python -m main.taxdump_utils nodes.dmp names.dmp merged.dmp '
+                 'taxdump.idx')
+    build_taxdump_index(*sys.argv[1:])
@@ -3,59 +3,64 @@
 # SPDX-License-Identifier: MIT
 
 import os
-import shutil
 import tempfile
 import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import XMLGenerator
 
+# Bundles larger than this are written to disk rather than kept in memory
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
 
-def build_bundle_sample_xml(manifest):
-    __location__ = os.path.realpath(
-        os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    """build structure and save to file bundle_file_subfix.xml"""
-    dir_ = tempfile.TemporaryDirectory()
+SAMPLE_SET_ATTRIBUTES = {
+    'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+    'xsi:noNamespaceSchemaLocation': 'ftp://ftp.sra.ebi.ac.uk/meta/xsd/sra_1_5/SRA.sample.xsd'}
 
-    filename = dir_.name + 'bundle_' + str(manifest.manifest_id) + '.xml'
-    shutil.copy(os.path.join(__location__, 'templates/sample.xml'), filename)
-    sample_count = update_bundle_sample_xml(manifest, filename)
-    return filename, sample_count
 
+def build_bundle_sample_xml(samples):
+    """Writes the samples to a temporary file, returning it, rewound, and the
+    number of samples. The file is kept in memory until it becomes large"""
+    bundle_xml = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    sample_count = write_bundle_sample_xml(samples, bundle_xml)
+    bundle_xml.seek(0)
+    return bundle_xml, sample_count
 
-def update_bundle_sample_xml(manifest, bundlefile):
-    """update the sample with submission alias adding a new sample"""
-    # print('adding sample to bundle sample xml')
-    tree = ElementTree.parse(bundlefile)
-    root = tree.getroot()
+
+def write_bundle_sample_xml(samples, out):
+    """Streams a SAMPLE_SET to a binary file one sample at a time, so that only one
+    sample is in memory however large the bundle is"""
+    generator = XMLGenerator(out, encoding='utf-8')
+    generator.startElement('SAMPLE_SET', SAMPLE_SET_ATTRIBUTES)
     sample_count = 0
-    for sample in manifest.samples:
+    for sample in samples:
         sample_count += 1
-        sample_alias = ElementTree.SubElement(root, 'SAMPLE')
-        sample_alias.set('alias', str(sample.sample_id))
-        sample_alias.set('center_name', 'SangerInstitute')
-        title = str(sample.sample_id) + '-tol'
-
-        title_block = ElementTree.SubElement(sample_alias, 'TITLE')
-        title_block.text = title
-        sample_name = ElementTree.SubElement(sample_alias, 'SAMPLE_NAME')
-        taxon_id = ElementTree.SubElement(sample_name, 'TAXON_ID')
-        taxon_id.text = str(sample.taxonomy_id)
-        sample_attributes = ElementTree.SubElement(sample_alias, 'SAMPLE_ATTRIBUTES')
+        write_sample_xml(generator, sample)
+    generator.endElement('SAMPLE_SET')
+    return sample_count
 
-        ena_fields = sample.to_ena_dict()
-        for item in ena_fields:
-            sample_attribute = ElementTree.SubElement(sample_attributes, 'SAMPLE_ATTRIBUTE')
-            tag = ElementTree.SubElement(sample_attribute, 'TAG')
-            tag.text = item
-            value = ElementTree.SubElement(sample_attribute, 'VALUE')
-            value.text = str(ena_fields[item]['value'])
-            # add ena units where necessary
-            if 'units' in ena_fields[item]:
-                unit = ElementTree.SubElement(sample_attribute, 'UNITS')
-                unit.text = ena_fields[item]['units']
 
-    ElementTree.dump(tree)
-    tree.write(open(bundlefile, 'w'),
-               encoding='unicode')
-    return sample_count
+def write_sample_xml(generator, sample):
+    generator.startElement('SAMPLE', {'alias': str(sample.sample_id),
+                                      'center_name': 'SangerInstitute'})
+    write_text_element(generator, 'TITLE', str(sample.sample_id) + '-tol')
+    generator.startElement('SAMPLE_NAME', {})
+    write_text_element(generator, 'TAXON_ID', str(sample.taxonomy_id))
+    generator.endElement('SAMPLE_NAME')
+    generator.startElement('SAMPLE_ATTRIBUTES', {})
+    for tag, field in sample.to_ena_dict().items():
+        generator.startElement('SAMPLE_ATTRIBUTE', {})
+        write_text_element(generator, 'TAG', tag)
+        write_text_element(generator, 'VALUE', str(field['value']))
+        # add ena units where necessary
+        if 'units' in field:
+            write_text_element(generator, 'UNITS', field['units'])
+        generator.endElement('SAMPLE_ATTRIBUTE')
+    generator.endElement('SAMPLE_ATTRIBUTES')
+    generator.endElement('SAMPLE')
+
+
+def write_text_element(generator, name, text):
+    generator.startElement(name, {})
+    generator.characters(text)
+    generator.endElement(name)
 
 
 def build_submission_xml(manifest):
@@ -76,12 +81,7 @@ def build_submission_xml(manifest):
     copo_contact.set('name', os.getenv('ENA_CONTACT_NAME', ''))
     copo_contact.set('inform_on_error', os.getenv('ENA_CONTACT_EMAIL', ''))
     copo_contact.set('inform_on_status', os.getenv('ENA_CONTACT_EMAIL', ''))
-    ElementTree.dump(tree)
-    dir_ = tempfile.TemporaryDirectory()
-
-    submissionfile = dir_.name + 'submission_' + str(manifest.manifest_id) + '.xml'
-
-    tree.write(open(submissionfile, 'w'),
-               encoding='unicode')
-
-    return submissionfile
+    submission_xml = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    tree.write(submission_xml, encoding='utf-8')
+    submission_xml.seek(0)
+    return submission_xml
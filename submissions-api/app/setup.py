@@ -23,8 +23,8 @@ setup(
     author_email='',
     url='',
     keywords=['Swagger', 'Tree of Life public name API'],
-    packages=find_packages(),
-    package_data={'': ['swagger/swagger.yaml']},
+    packages=find_packages(exclude=['benchmarks', 'test*']),
+    package_data={'': ['swagger/swagger.yaml', 'checklists/*.json']},
     include_package_data=True,
     entry_points={
         'console_scripts': ['app=main.run:main']},
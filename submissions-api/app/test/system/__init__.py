@@ -4,14 +4,20 @@
 
 import logging
 import os
+from contextlib import contextmanager
 
 import connexion
 
 from flask_testing import TestCase
 
+from main.cache_utils import clear_caches
 from main.encoder import JSONEncoder
-from main.model import SubmissionsManifest, SubmissionsRole, SubmissionsSample, \
-    SubmissionsSampleField, SubmissionsSpecimen, SubmissionsState, SubmissionsUser, db
+from main.http_utils import close_sessions
+from main.model import SubmissionsJob, SubmissionsManifest, SubmissionsRole, \
+    SubmissionsSample, SubmissionsSampleField, SubmissionsSpecimen, SubmissionsState, \
+    SubmissionsTaxonomy, SubmissionsUser, SubmissionsValidation, db
+
+from sqlalchemy import event
 
 
 class BaseTestCase(TestCase):
@@ -25,6 +31,8 @@ class BaseTestCase(TestCase):
         os.environ['STS_URL'] = 'http://sts'
         os.environ['TOLID_URL'] = 'http://tolid'
         os.environ['ENA_URL'] = 'http://ena'
+        clear_caches()
+        close_sessions()
 
         db.create_all()
         self.tearDown()
@@ -59,6 +67,7 @@ class BaseTestCase(TestCase):
         db.engine.execute('ALTER SEQUENCE sample_sample_id_seq RESTART WITH 1;')
 
     def tearDown(self):
+        db.session.query(SubmissionsJob).delete()
         db.session.query(SubmissionsSampleField).delete()
         db.session.query(SubmissionsSample).delete()
         db.session.query(SubmissionsSpecimen).delete()
@@ -66,9 +75,25 @@ class BaseTestCase(TestCase):
         db.session.query(SubmissionsRole).delete()
         db.session.query(SubmissionsUser).delete()
         db.session.query(SubmissionsState).delete()
+        db.session.query(SubmissionsTaxonomy).delete()
+        db.session.query(SubmissionsValidation).delete()
         db.session.commit()
         db.session.remove()
 
+    @contextmanager
+    def assertQueryCount(self, count):
+        """Fails if the block doesn't run exactly this many SQL statements"""
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(statements), count, '\n'.join(statements))
+
     def create_app(self):
         # the two below were changed to prevent from spamming
         # the test STOUT with DEBUG messages
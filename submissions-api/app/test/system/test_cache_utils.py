@@ -0,0 +1,68 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+from test.system import BaseTestCase
+
+from main.cache_utils import TTLCache, caches, get_cache_stats
+
+
+class TestCacheUtils(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+        self.cache = TTLCache('test', maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def tearDown(self):
+        caches.pop('test', None)
+        super().tearDown()
+
+    def test_get_and_set(self):
+        self.assertEqual(self.cache.get(1), (False, None))
+        self.cache.set(1, 'one')
+        self.assertEqual(self.cache.get(1), (True, 'one'))
+        # None is a value that can be cached
+        self.cache.set(2, None)
+        self.assertEqual(self.cache.get(2), (True, None))
+        self.assertEqual(self.cache.stats(), {'size': 2,
+                                              'maxSize': 2,
+                                              'hits': 2,
+                                              'misses': 1,
+                                              'evictions': 0,
+                                              'expirations': 0})
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two')
+        self.cache.get(1)
+        self.cache.set(3, 'three')
+        self.assertEqual(self.cache.get(2), (False, None))
+        self.assertEqual(self.cache.get(1), (True, 'one'))
+        self.assertEqual(self.cache.get(3), (True, 'three'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expiry(self):
+        self.cache.set(1, 'one')
+        self.cache.set(2, 'two', ttl=1)
+        self.now = 5
+        self.assertEqual(self.cache.get(1), (True, 'one'))
+        self.assertEqual(self.cache.get(2), (False, None))
+        self.now = 10
+        self.assertEqual(self.cache.get(1), (False, None))
+        self.assertEqual(self.cache.stats()['expirations'], 2)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_clear(self):
+        self.cache.set(1, 'one')
+        self.cache.get(1)
+        self.cache.clear()
+        self.assertEqual(self.cache.get(1), (False, None))
+        self.assertEqual(get_cache_stats()['test']['hits'], 0)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
@@ -0,0 +1,78 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+from test.system import BaseTestCase
+
+from main.checklist_utils import EnaChecklist, get_ena_checklist
+
+
+class TestChecklistUtils(BaseTestCase):
+
+    def test_get_ena_checklist(self):
+        checklist = get_ena_checklist()
+        self.assertIs(checklist, get_ena_checklist())
+        self.assertEqual(checklist.checklist, 'ERC000053')
+
+    def test_validate(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        checklist_file = os.path.join(tmp_dir.name, 'ERC999999.json')
+        with open(checklist_file, 'w') as f:
+            json.dump({'checklist': 'ERC999999',
+                       'fields': [{'name': 'sex',
+                                   'mandatory': True,
+                                   'field': 'SEX',
+                                   'allowed_values': ['Female', 'Male']},
+                                  {'name': 'habitat',
+                                   'mandatory': True},
+                                  {'name': 'depth',
+                                   'mandatory': False,
+                                   'regex': r'^\d+$'}]}, f)
+        checklist = EnaChecklist.from_file(checklist_file)
+        self.assertEqual(checklist.checklist, 'ERC999999')
+        self.assertEqual(checklist.digest, EnaChecklist.from_file(checklist_file).digest)
+
+        self.assertEqual(checklist.validate({'sex': {'value': 'FEMALE'},
+                                             'habitat': {'value': 'Woodland'},
+                                             'depth': {'value': '10'}}), [])
+        self.assertEqual(checklist.validate({'sex': {'value': 'NEUTER'},
+                                             'habitat': {'value': ''},
+                                             'depth': {'value': 'deep'}}),
+                         [{'field': 'SEX',
+                           'message': 'Must be in allowed values',
+                           'severity': 'ERROR'},
+                          {'field': 'habitat',
+                           'message': 'Must not be empty',
+                           'severity': 'ERROR'},
+                          {'field': 'depth',
+                           'message': 'Must match specific pattern',
+                           'severity': 'ERROR'}])
+        self.assertEqual(checklist.validate({}),
+                         [{'field': 'SEX',
+                           'message': 'Must be given',
+                           'severity': 'ERROR'},
+                          {'field': 'habitat',
+                           'message': 'Must be given',
+                           'severity': 'ERROR'}])
+
+    def test_digest(self):
+        checklist = {'checklist': 'ERC999999',
+                     'fields': [{'name': 'depth',
+                                 'mandatory': False,
+                                 'regex': r'^\d+$'}]}
+        digest = EnaChecklist(checklist).digest
+
+        # The same name with different rules
+        checklist['fields'][0]['mandatory'] = True
+        self.assertNotEqual(digest, EnaChecklist(checklist).digest)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+import io
+import os
+from test.system import BaseTestCase
+
+from flask import request
+
+from main.http_utils import MultipartFileStream, close_sessions, get_session, get_timeout
+
+import responses
+
+
+class TestHttpUtils(BaseTestCase):
+
+    def test_get_session_reused(self):
+        self.assertIs(get_session('sts'), get_session('sts'))
+        self.assertIsNot(get_session('sts'), get_session('tolid'))
+        sts = get_session('sts')
+        close_sessions()
+        self.assertIsNot(get_session('sts'), sts)
+
+    def test_get_timeout(self):
+        self.assertEqual(get_timeout('tolid'), (5, 30))
+        self.assertEqual(get_timeout('ena'), (5, 300))
+        os.environ['TOLID_TIMEOUT'] = '2.5'
+        self.assertEqual(get_timeout('tolid'), (5, 2.5))
+        os.environ.pop('TOLID_TIMEOUT')
+
+    @responses.activate
+    def test_session_headers_and_timeout(self):
+        os.environ['STS_API_KEY'] = 'sts-key'
+        close_sessions()
+        responses.add(responses.GET, 'http://sts/specimens', json={}, status=200)
+        get_session('sts').get('http://sts/specimens')
+        request = responses.calls[0].request
+        self.assertEqual(request.headers['Project'], 'ALL')
+        self.assertEqual(request.headers['Authorization'], 'sts-key')
+        self.assertEqual(request.req_kwargs['timeout'], (5, 30))
+        os.environ.pop('STS_API_KEY')
+
+        # No API key, so no header
+        close_sessions()
+        responses.add(responses.GET, 'http://tolid/species/1', json={}, status=200)
+        get_session('tolid').get('http://tolid/species/1')
+        self.assertNotIn('api-key', responses.calls[1].request.headers)
+
+    def test_multipart_file_stream(self):
+        sample_xml = io.BytesIO(b'<SAMPLE_SET>' + b'x' * 100000 + b'</SAMPLE_SET>')
+        submission_xml = io.BytesIO(b'<SUBMISSION/>')
+        body = MultipartFileStream([
+            ('SAMPLE', ('sample.xml', sample_xml, 'application/xml')),
+            ('SUBMISSION', ('submission.xml', submission_xml, 'application/xml'))])
+
+        # Read a block at a time, as it is when sent
+        blocks = []
+        while True:
+            block = body.read(8192)
+            if not block:
+                break
+            self.assertLessEqual(len(block), 8192)
+            blocks.append(block)
+        data = b''.join(blocks)
+        self.assertEqual(len(body), len(data))
+
+        with self.app.test_request_context(method='POST', data=data,
+                                           content_type=body.content_type):
+            self.assertEqual(request.files['SAMPLE'].filename, 'sample.xml')
+            self.assertEqual(request.files['SAMPLE'].read(), sample_xml.getvalue())
+            self.assertEqual(request.files['SUBMISSION'].read(), b'<SUBMISSION/>')
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
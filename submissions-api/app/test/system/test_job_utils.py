@@ -0,0 +1,192 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+import time
+from datetime import timedelta
+from test.system import BaseTestCase
+from unittest.mock import patch
+
+from main.job_utils import claim_job, enqueue_job, run_next_job
+from main.model import SubmissionsJob, SubmissionsManifest, db
+
+from sqlalchemy import func
+
+
+class TestJobUtils(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        db.session.add(manifest)
+        db.session.commit()
+        self.manifest_id = manifest.manifest_id
+
+    def get_job(self, job_id):
+        # Progress is written outside the session, so read it afresh
+        return db.session.query(SubmissionsJob) \
+            .populate_existing() \
+            .filter(SubmissionsJob.job_id == job_id) \
+            .one()
+
+    def test_run_next_job(self):
+        self.assertFalse(run_next_job())
+
+        first_job_id = enqueue_job('generate', self.manifest_id, 100).job_id
+        second_job_id = enqueue_job('generate', self.manifest_id, 100).job_id
+        progress = []
+
+        def generate_ids_for_manifest(manifest, report_progress, retries, retry_delay):
+            # A job retries ENA submissions, unlike a request
+            self.assertEqual((3, 0), (retries, retry_delay))
+            report_progress('tolids', 0)
+            # Seen before the job finishes
+            progress.append((self.get_job(first_job_id).phase,
+                             self.get_job(first_job_id).status))
+            report_progress('ena', 50)
+            progress.append((self.get_job(first_job_id).phase,
+                             self.get_job(first_job_id).progress))
+            db.session.rollback()
+            return 1, [{'row': 1,
+                        'results': [{'field': 'TAXON_ID',
+                                     'message': 'Error returned from ENA service',
+                                     'severity': 'ERROR'}]}]
+
+        # The oldest job is run first
+        with patch('main.manifest_utils.ENA_RETRIES', 3), \
+                patch('main.manifest_utils.ENA_RETRY_DELAY', 0), \
+                patch('main.manifest_utils.generate_ids_for_manifest',
+                      side_effect=generate_ids_for_manifest):
+            self.assertTrue(run_next_job())
+
+        self.assertEqual([('tolids', 'running'), ('ena', 50)], progress)
+        # Failed, with the samples' errors
+        job = self.get_job(first_job_id)
+        self.assertEqual('failed', job.status)
+        self.assertEqual('IDs could not be generated for every sample', job.error)
+        self.assertEqual(50, job.progress)
+        self.assertEqual({'manifestId': self.manifest_id,
+                          'number_of_errors': 1,
+                          'validations': [{'row': 1,
+                                           'results': [{'field': 'TAXON_ID',
+                                                        'message': 'Error returned from ENA '
+                                                        'service',
+                                                        'severity': 'ERROR'}]}]},
+                         job.result)
+        self.assertIsNotNone(job.started_at)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual('queued', self.get_job(second_job_id).status)
+
+    def test_run_next_job_failed(self):
+        job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+
+        with patch('main.manifest_utils.validate_manifest',
+                   side_effect=Exception('Something went wrong')):
+            self.assertTrue(run_next_job())
+
+        job = self.get_job(job_id)
+        self.assertEqual('failed', job.status)
+        self.assertEqual('Something went wrong', job.error)
+        self.assertIsNone(job.result)
+        self.assertFalse(run_next_job())
+
+    def test_claim_job_skips_locked(self):
+        job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+
+        # Another worker is claiming the job
+        with db.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(SubmissionsJob.__table__.select()
+                                   .where(SubmissionsJob.job_id == job_id)
+                                   .with_for_update())
+                self.assertIsNone(claim_job())
+
+        self.assertEqual(job_id, claim_job().job_id)
+        self.assertEqual('running', self.get_job(job_id).status)
+
+    def test_run_next_job_fails_stale_jobs(self):
+        stale_job_id = enqueue_job('generate', self.manifest_id, 100).job_id
+        running_job_id = enqueue_job('generate', self.manifest_id, 100).job_id
+        claim_job()
+        claim_job()
+        # The worker running this one stopped two hours ago
+        db.session.query(SubmissionsJob) \
+            .filter(SubmissionsJob.job_id == stale_job_id) \
+            .update({'updated_at': func.now() - timedelta(hours=2)})
+        # This one has been running as long, but is still being updated
+        db.session.query(SubmissionsJob) \
+            .filter(SubmissionsJob.job_id == running_job_id) \
+            .update({'started_at': func.now() - timedelta(hours=2)})
+        db.session.commit()
+
+        self.assertFalse(run_next_job())
+
+        job = self.get_job(stale_job_id)
+        self.assertEqual('failed', job.status)
+        self.assertEqual('Timed out', job.error)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual('running', self.get_job(running_job_id).status)
+
+    def test_run_next_job_heartbeat(self):
+        job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+        updated_at = []
+
+        def validate_manifest(manifest, report_progress):
+            # Nothing is reported for a while
+            with db.engine.begin() as connection:
+                connection.execute(SubmissionsJob.__table__.update()
+                                   .where(SubmissionsJob.job_id == job_id)
+                                   .values(updated_at=func.now() - timedelta(hours=2)))
+            time.sleep(0.5)
+            updated_at.append(self.get_job(job_id).updated_at)
+            return 0, []
+
+        with patch('main.job_utils.JOB_HEARTBEAT_INTERVAL', 0.1), \
+                patch('main.manifest_utils.validate_manifest',
+                      side_effect=validate_manifest):
+            self.assertTrue(run_next_job())
+
+        # Updated while the work went on
+        self.assertGreater(updated_at[0], self.get_job(job_id).started_at)
+        self.assertEqual('succeeded', self.get_job(job_id).status)
+
+    def test_run_next_job_lost(self):
+        job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+
+        def validate_manifest(manifest, report_progress):
+            # Another worker took this one to have been lost
+            with db.engine.begin() as connection:
+                connection.execute(SubmissionsJob.__table__.update()
+                                   .where(SubmissionsJob.job_id == job_id)
+                                   .values(status='failed', error='Timed out'))
+            return 0, []
+
+        with patch('main.manifest_utils.validate_manifest',
+                   side_effect=validate_manifest):
+            self.assertTrue(run_next_job())
+
+        job = self.get_job(job_id)
+        self.assertEqual('failed', job.status)
+        self.assertEqual('Timed out', job.error)
+        self.assertIsNone(job.result)
+
+    def test_run_next_job_purges_finished_jobs(self):
+        old_job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+        recent_job_id = enqueue_job('validate', self.manifest_id, 100).job_id
+        db.session.query(SubmissionsJob) \
+            .filter(SubmissionsJob.job_id == old_job_id) \
+            .update({'status': 'succeeded',
+                     'finished_at': func.now() - timedelta(days=31)})
+        db.session.query(SubmissionsJob) \
+            .filter(SubmissionsJob.job_id == recent_job_id) \
+            .update({'status': 'succeeded',
+                     'finished_at': func.now() - timedelta(days=29)})
+        db.session.commit()
+
+        self.assertFalse(run_next_job())
+
+        self.assertEqual([recent_job_id],
+                         [job.job_id for job in db.session.query(SubmissionsJob)])
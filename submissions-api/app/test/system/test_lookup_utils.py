@@ -0,0 +1,96 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+from test.system import BaseTestCase
+
+from main.lookup_utils import get_concurrency, run_lookups, shutdown_executors
+
+
+class TestLookupUtils(BaseTestCase):
+
+    def test_get_concurrency(self):
+        os.environ.pop('TOLID_CONCURRENCY', None)
+        self.assertEqual(get_concurrency('tolid'), 8)
+        os.environ['TOLID_CONCURRENCY'] = '3'
+        self.assertEqual(get_concurrency('tolid'), 3)
+        os.environ['TOLID_CONCURRENCY'] = '0'
+        self.assertEqual(get_concurrency('tolid'), 1)
+        os.environ.pop('TOLID_CONCURRENCY')
+
+    def test_run_lookups_keeps_order(self):
+        def slow_double(x):
+            # Later lookups finish first
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+
+        lookups = [('tolid' if x % 2 else 'ena', slow_double, (x,)) for x in range(5)]
+        self.assertEqual(run_lookups(lookups), [0, 2, 4, 6, 8])
+        self.assertEqual(run_lookups([]), [])
+
+    def tearDown(self):
+        # So the concurrency set by the next test is used
+        shutdown_executors()
+        super().tearDown()
+
+    def test_run_lookups_limits_concurrency(self):
+        os.environ['TOLID_CONCURRENCY'] = '2'
+        shutdown_executors()
+        lock = threading.Lock()
+        running = {'now': 0, 'max': 0}
+
+        def tracked():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.02)
+            with lock:
+                running['now'] -= 1
+
+        run_lookups([('tolid', tracked, ()) for _ in range(10)])
+        self.assertEqual(running['max'], 2)
+
+        # Also across lookups run at the same time, by different requests
+        running['max'] = 0
+        threads = [threading.Thread(target=run_lookups,
+                                    args=([('tolid', tracked, ()) for _ in range(5)],))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running['max'], 2)
+        os.environ.pop('TOLID_CONCURRENCY')
+
+    def test_run_lookups_raises(self):
+        def broken():
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            run_lookups([('ena', broken, ())])
+
+    def test_run_lookups_cancels_waiting_lookups(self):
+        os.environ['ENA_CONCURRENCY'] = '1'
+        shutdown_executors()
+        started = []
+
+        def broken():
+            started.append(True)
+            time.sleep(0.01)
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            run_lookups([('ena', broken, ()) for _ in range(10)])
+        os.environ.pop('ENA_CONCURRENCY')
+        # The one running when the first failed may have started, but no more
+        self.assertLessEqual(len(started), 2)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
@@ -4,25 +4,92 @@
 
 from __future__ import absolute_import
 
+import datetime
 import json
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from test.system import BaseTestCase
 from unittest.mock import patch
-
-from main.manifest_utils import generate_ena_ids_for_manifest, generate_tolids_for_manifest, \
-    set_relationships_for_manifest, validate_against_ena_checklist, validate_against_ncbi, \
-    validate_allowed_values, validate_barcoding, validate_ena_submittable, validate_manifest, \
-    validate_no_orphaned_symbionts, validate_no_specimens_with_different_taxons, \
-    validate_rack_plate_tube_well_not_both_na, validate_rack_plate_tube_well_unique, \
-    validate_regexs, validate_species_known_in_tolid, validate_specimen_against_tolid, \
-    validate_specimen_id, validate_sts_rack_plate_tube_well, validate_whole_organisms_unique
-from main.model import SubmissionsManifest, SubmissionsSample, SubmissionsSpecimen, db
+from urllib.error import URLError
+
+from main.cache_utils import clear_caches
+from main.manifest_utils import ALLOWED_VALUES_RULES, KNOWN_FIELD_NAMES, REGEX_RULES, \
+    ValidationContext, assign_ena_ids, cache_validation, create_manifest_from_json, \
+    ena_taxonomy_cache, generate_ena_ids_for_manifest, generate_tolids_for_manifest, \
+    get_cached_validation, get_manifest_with_samples, get_ncbi_data, order_results, \
+    save_manifest, set_relationships_for_manifest, validate_against_ena_checklist, \
+    validate_against_ncbi, validate_allowed_values, validate_barcoding, validate_cross_row, \
+    validate_ena_submittable, validate_manifest, validate_rack_plate_tube_well_not_both_na, \
+    validate_regexs, validate_row, validate_species_known_in_tolid, \
+    validate_specimen_against_tolid, validate_specimen_id, validate_sts_rack_plate_tube_well
+from main.model import SubmissionsManifest, SubmissionsSample, SubmissionsSpecimen, \
+    SubmissionsTaxonomy, SubmissionsValidation, db
+
+import requests
 
 import responses
 
 
 class TestManifestUtils(BaseTestCase):
 
+    def test_create_manifest_from_json(self):
+        body = {'projectName': 'ToL',
+                'samples': [{'row': 1,
+                             'SPECIMEN_ID': 'SAN0000100',
+                             'TAXON_ID': 6344,
+                             'COMMON_NAME': ' ',
+                             'public_name': 'wuAreMari1',
+                             'EXTRA_FIELD': 'extra',
+                             'EMPTY_EXTRA_FIELD': None}]}
+        manifest = create_manifest_from_json(body, None)
+        self.assertEqual(manifest.project_name, 'ToL')
+        sample = manifest.samples[0]
+        self.assertEqual(sample.specimen_id, 'SAN0000100')
+        self.assertIsNone(sample.common_name)
+        self.assertEqual(sample.tolid, 'wuAreMari1')
+        self.assertEqual([(f.name, f.value) for f in sample.sample_fields],
+                         [('EXTRA_FIELD', 'extra')])
+
+    def test_create_manifest_from_json_extra_fields(self):
+        # Every named field, and nothing else, is kept out of the extra fields
+        sample_json = {field_name: 'value' for field_name in KNOWN_FIELD_NAMES}
+        sample_json.update({'row': 1, 'EXTRA_FIELD': 'extra', 'specimen_id': 'lower case'})
+        manifest = create_manifest_from_json({'samples': [sample_json]}, None)
+        self.assertEqual(sorted((f.name, f.value) for f in manifest.samples[0].sample_fields),
+                         [('EXTRA_FIELD', 'extra'), ('specimen_id', 'lower case')])
+        self.assertIn('row', KNOWN_FIELD_NAMES)
+        self.assertIn('public_name', KNOWN_FIELD_NAMES)
+        self.assertLessEqual({field['field_name'] for field in SubmissionsSample.all_fields},
+                             KNOWN_FIELD_NAMES)
+
+    def test_save_manifest(self):
+        body = {'samples': [{'row': row,
+                             'SPECIMEN_ID': 'SAN' + str(row).zfill(7),
+                             'TAXON_ID': 6344,
+                             'SCIENTIFIC_NAME': 'Arenicola marina',
+                             'LIFESTAGE': 'ADULT',
+                             'SEX': 'FEMALE',
+                             'ORGANISM_PART': 'MUSCLE',
+                             'EXTRA_FIELD': 'extra ' + str(row),
+                             'OTHER_EXTRA_FIELD': 'other'}
+                            for row in range(1, 5001)]}
+        manifest = create_manifest_from_json(body, self.user1)
+        db.session.refresh(self.user1)
+        # The manifest, the sample IDs, the samples and the extra fields
+        with self.assertQueryCount(4):
+            save_manifest(manifest)
+            db.session.commit()
+
+        manifest = db.session.query(SubmissionsManifest).one()
+        self.assertEqual(len(manifest.samples), 5000)
+        sample = manifest.samples[4999]
+        self.assertEqual(sample.row, 5000)
+        self.assertEqual(sample.specimen_id, 'SAN0005000')
+        self.assertEqual(sample.manifest, manifest)
+        self.assertEqual([(f.name, f.value) for f in sample.sample_fields],
+                         [('EXTRA_FIELD', 'extra 5000'), ('OTHER_EXTRA_FIELD', 'other')])
+
     def test_validate_allowed_values(self):
         self.sample1 = SubmissionsSample(collected_by='ALEX COLLECTOR',
                                          collection_location='UNITED KINGDOM | DARK FOREST',
@@ -122,6 +189,22 @@ class TestManifestUtils(BaseTestCase):
                      'severity': 'ERROR'}]
         self.assertEqual(results, expected)
 
+    def test_field_rules(self):
+        # Only fields with rules are checked
+        self.assertEqual(len(ALLOWED_VALUES_RULES),
+                         len([f for f in SubmissionsSample.all_fields if 'allowed_values' in f]))
+        self.assertEqual([r[1] for r in REGEX_RULES],
+                         ['SERIES', 'RACK_OR_PLATE_ID', 'TUBE_OR_WELL_ID', 'TIME_OF_COLLECTION',
+                          'TIME_ELAPSED_FROM_COLLECTION_TO_PRESERVATION'])
+
+        self.sample1 = SubmissionsSample(organism_part='HEAD | THORAX', row=1)
+        self.assertEqual(validate_allowed_values(self.sample1), [])
+        self.sample1.organism_part = 'HEAD|UNKNOWN'
+        self.assertEqual(validate_allowed_values(self.sample1),
+                         [{'field': 'ORGANISM_PART',
+                           'message': 'Must be an allowed value',
+                           'severity': 'ERROR'}])
+
     def test_validate_regexs(self):
         self.sample1 = SubmissionsSample(series='INVALID',
                                          time_of_collection='INVALID',
@@ -241,23 +324,19 @@ class TestManifestUtils(BaseTestCase):
         manifest = SubmissionsManifest()
         sample1.manifest = manifest
         sample2.manifest = manifest
-        manifest.reset_trackers()
+        results = validate_cross_row(manifest.samples)
 
         expected = [{'field': 'SYMBIONT',
                      'message': 'Must only be one target specimen id per rack/tube or plate/well',
                      'severity': 'ERROR'}]
 
-        results = validate_rack_plate_tube_well_unique(sample1)
-        self.assertEqual(results, expected)
-
-        results = validate_rack_plate_tube_well_unique(sample2)
-        self.assertEqual(results, expected)
+        self.assertEqual(order_results(results[sample1]), expected)
+        self.assertEqual(order_results(results[sample2]), expected)
 
         # Symbionts are allowed
         sample2.symbiont = 'SYMBIONT'
-        manifest.reset_trackers()
-        results = validate_rack_plate_tube_well_unique(sample2)
-        self.assertEqual(results, [])
+        results = validate_cross_row(manifest.samples)
+        self.assertEqual(order_results(results[sample2]), [])
 
     def test_validate_no_orphaned_symbionts(self):
         sample1 = SubmissionsSample(rack_or_plate_id='RR12345678',
@@ -271,25 +350,21 @@ class TestManifestUtils(BaseTestCase):
         manifest = SubmissionsManifest()
         sample1.manifest = manifest
         sample2.manifest = manifest
-        manifest.reset_trackers()
+        results = validate_cross_row(manifest.samples)
 
         expected = [{'field': 'SYMBIONT',
                      'message': 'All symbionts must have a TARGET with '
                                 'same rack/plate and tube/well',
                      'severity': 'ERROR'}]
 
-        results = validate_no_orphaned_symbionts(sample1)
-        self.assertEqual(results, [])
-
-        results = validate_no_orphaned_symbionts(sample2)
-        self.assertEqual(results, expected)
+        self.assertEqual(order_results(results[sample1]), [])
+        self.assertEqual(order_results(results[sample2]), expected)
 
         # Symbiont has a target
         sample2.rack_or_plate_id = 'RR12345678'
         sample2.tube_or_well_id = 'TB12345678'
-        manifest.reset_trackers()
-        results = validate_no_orphaned_symbionts(sample2)
-        self.assertEqual(results, [])
+        results = validate_cross_row(manifest.samples)
+        self.assertEqual(order_results(results[sample2]), [])
 
     def test_validate_no_specimens_with_different_taxons(self):
         sample1 = SubmissionsSample(specimen_id='SAN12345678',
@@ -303,35 +378,28 @@ class TestManifestUtils(BaseTestCase):
         manifest = SubmissionsManifest()
         sample1.manifest = manifest
         sample2.manifest = manifest
-        manifest.reset_trackers()
+        results = validate_cross_row(manifest.samples)
 
         expected = [{'field': 'TAXON_ID',
                      'message': 'Targets must not use the same SPECIMEN_ID '
                                 'with a different TAXON_ID',
                      'severity': 'ERROR'}]
 
-        results = validate_no_specimens_with_different_taxons(sample1)
-        self.assertEqual(results, [])
-
-        results = validate_no_specimens_with_different_taxons(sample2)
-        self.assertEqual(results, expected)
+        self.assertEqual(order_results(results[sample1]), [])
+        self.assertEqual(order_results(results[sample2]), expected)
 
         # Correct
         sample2.taxonomy_id = 6344
-        manifest.reset_trackers()
-        results = validate_no_specimens_with_different_taxons(sample1)
-        self.assertEqual(results, [])
-        results = validate_no_specimens_with_different_taxons(sample2)
-        self.assertEqual(results, [])
+        results = validate_cross_row(manifest.samples)
+        self.assertEqual(order_results(results[sample1]), [])
+        self.assertEqual(order_results(results[sample2]), [])
 
         # Valid for symbionts
         sample2.taxonomy_id = 6355
         sample2.symbiont = 'SYMBIONT'
-        manifest.reset_trackers()
-        results = validate_no_specimens_with_different_taxons(sample1)
-        self.assertEqual(results, [])
-        results = validate_no_specimens_with_different_taxons(sample2)
-        self.assertEqual(results, [])
+        results = validate_cross_row(manifest.samples)
+        self.assertEqual(order_results(results[sample1]), [])
+        self.assertEqual(order_results(results[sample2]), [])
 
     def test_validate_barcoding(self):
         sample1 = SubmissionsSample(tissue_removed_for_barcoding='N',
@@ -376,23 +444,108 @@ class TestManifestUtils(BaseTestCase):
         manifest = SubmissionsManifest()
         sample1.manifest = manifest
         sample2.manifest = manifest
-        manifest.reset_trackers()
+        results = validate_cross_row(manifest.samples)
 
         expected = [{'field': 'SPECIMEN_ID',
                      'message': 'WHOLE_ORGANISM can only be used once',
                      'severity': 'ERROR'}]
 
-        results = validate_whole_organisms_unique(sample1)
-        self.assertEqual(results, expected)
-
-        results = validate_whole_organisms_unique(sample2)
-        self.assertEqual(results, expected)
+        self.assertEqual(order_results(results[sample1]), expected)
+        self.assertEqual(order_results(results[sample2]), expected)
 
         # Symbionts are allowed
         sample2.specimen_id = 'SAN7654321'
-        manifest.reset_trackers()
-        results = validate_whole_organisms_unique(sample2)
-        self.assertEqual(results, [])
+        results = validate_cross_row(manifest.samples)
+        self.assertEqual(order_results(results[sample2]), [])
+
+    def test_validate_cross_row(self):
+        # Every rule broken at once, in a single pass
+        samples = [SubmissionsSample(specimen_id='SAN1234567',
+                                     taxonomy_id=6344,
+                                     organism_part='WHOLE_ORGANISM',
+                                     rack_or_plate_id='RR12345678',
+                                     tube_or_well_id='TB12345678',
+                                     symbiont='TARGET',
+                                     row=1),
+                   SubmissionsSample(specimen_id='SAN1234567',
+                                     taxonomy_id=6355,
+                                     organism_part='WHOLE_ORGANISM',
+                                     rack_or_plate_id='RR12345678',
+                                     tube_or_well_id='TB12345678',
+                                     symbiont='TARGET',
+                                     row=2),
+                   SubmissionsSample(specimen_id='SAN7654321',
+                                     taxonomy_id=6355,
+                                     organism_part='MUSCLE',
+                                     rack_or_plate_id='RR99999999',
+                                     tube_or_well_id='TB99999999',
+                                     symbiont='SYMBIONT',
+                                     row=3)]
+
+        results = validate_cross_row(samples)
+        self.assertEqual({'validate_rack_plate_tube_well_unique': ['SYMBIONT'],
+                          'validate_whole_organisms_unique': ['SPECIMEN_ID']},
+                         {rule: [result['field'] for result in rule_results]
+                          for rule, rule_results in results[samples[0]].items()})
+        self.assertEqual([result['field'] for result in order_results(results[samples[1]])],
+                         ['SYMBIONT', 'TAXON_ID', 'SPECIMEN_ID'])
+        self.assertEqual([result['message'] for result in order_results(results[samples[2]])],
+                         ['All symbionts must have a TARGET with same rack/plate and '
+                          'tube/well'])
+
+    @responses.activate
+    def test_validate_manifest_result_order(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'false'},
+                      status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                      json=[], status=404)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/specimens/SAN0000100',
+                      json=[], status=404)
+
+        manifest = SubmissionsManifest()
+        manifest.project_name = 'TestProj1'
+        for row in range(1, 3):
+            sample = SubmissionsSample(collected_by='ALEX COLLECTOR',
+                                       collection_location='UNITED KINGDOM | DARK FOREST',
+                                       collector_affiliation='THE COLLECTOR INSTITUTE',
+                                       date_of_collection='2020-09-01',
+                                       decimal_latitude='50.12345678',
+                                       decimal_longitude='-1.98765432',
+                                       family='Arenicolidae',
+                                       GAL='SANGER INSTITUTE',
+                                       GAL_sample_id='SAN000100',
+                                       genus='Arenicola',
+                                       habitat='Woodland',
+                                       identified_by='JO IDENTIFIER',
+                                       identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                                       lifestage='ADULT',
+                                       organism_part='WHOLE_ORGANISM',
+                                       order_or_group='Scolecida',
+                                       scientific_name='Arenicola marina',
+                                       sex='FEMALE',
+                                       specimen_id='SAN0000100',
+                                       symbiont='TARGET',
+                                       taxonomy_id=6344,
+                                       voucher_id='voucher1',
+                                       rack_or_plate_id='NOT_APPLICABLE',
+                                       tube_or_well_id='NOT_APPLICABLE',
+                                       tissue_removed_for_barcoding='N',
+                                       plate_id_for_barcoding='PL12345678',
+                                       row=row)
+            sample.manifest = manifest
+
+        # The cross-row results are among the single-row ones, as they have always been
+        number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual(['RACK_OR_PLATE_ID',
+                          'TUBE_OR_WELL_ID',
+                          'TUBE_OR_WELL_ID',
+                          'SYMBIONT',
+                          'PLATE_ID_FOR_BARCODING',
+                          'SPECIMEN_ID',
+                          'TAXON_ID',
+                          'TAXON_ID'],
+                         [result['field'] for result in results[0]['results']])
 
     @responses.activate
     @patch('main.manifest_utils.get_ncbi_data')
@@ -535,6 +688,287 @@ class TestManifestUtils(BaseTestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(len(results[0]['results']), 0)
 
+    @responses.activate
+    def test_validate_manifest_looks_up_each_taxon_and_specimen_once(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                      json=[], status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/specimens/SAN0000100',
+                      json=[], status=404)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/specimens/SAN0000101',
+                      json=[], status=404)
+
+        manifest = SubmissionsManifest()
+        manifest.project_name = 'TestProj1'
+        for row, (specimen_id, symbiont) in enumerate([('SAN0000100', 'TARGET'),
+                                                       ('SAN0000100', 'TARGET'),
+                                                       ('SAN0000101', 'TARGET'),
+                                                       ('SAN0000102', 'SYMBIONT')], start=1):
+            sample = SubmissionsSample(collected_by='ALEX COLLECTOR',
+                                       collection_location='UNITED KINGDOM | DARK FOREST',
+                                       collector_affiliation='THE COLLECTOR INSTITUTE',
+                                       date_of_collection='2020-09-01',
+                                       decimal_latitude='50.12345678',
+                                       decimal_longitude='-1.98765432',
+                                       family='Arenicolidae',
+                                       GAL='SANGER INSTITUTE',
+                                       GAL_sample_id='SAN000100',
+                                       genus='Arenicola',
+                                       habitat='Woodland',
+                                       identified_by='JO IDENTIFIER',
+                                       identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                                       lifestage='ADULT',
+                                       organism_part='MUSCLE',
+                                       order_or_group='Scolecida',
+                                       scientific_name='Arenicola marina',
+                                       sex='FEMALE',
+                                       specimen_id=specimen_id,
+                                       symbiont=symbiont,
+                                       taxonomy_id=6344,
+                                       voucher_id='voucher1',
+                                       row=row)
+            sample.manifest = manifest
+
+        # NCBI isn't looked up, as none of the checks use it
+        with patch('main.manifest_utils.get_ncbi_data') as get_ncbi_data:
+            number_of_errors, results = validate_manifest(manifest)
+        get_ncbi_data.assert_not_called()
+        self.assertEqual(len(results), 4)
+        self.assertEqual([result['row'] for result in results], [1, 2, 3, 4])
+        called_urls = [call.request.url for call in responses.calls]
+        self.assertEqual(sorted(called_urls),
+                         ['http://tolid/species/6344',
+                          'http://tolid/specimens/SAN0000100',
+                          'http://tolid/specimens/SAN0000101',
+                          'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344'])
+
+    @responses.activate
+    def test_validate_manifest_unreachable_services(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6355',
+                      body=requests.ConnectionError())
+        responses.add(responses.GET, re.compile(os.getenv('TOLID_URL', '') + '/species/.*'),
+                      json=[], status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/specimens/SAN0000100',
+                      body=requests.ConnectionError())
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/specimens/SAN0000101',
+                      json=[], status=404)
+
+        manifest = SubmissionsManifest()
+        manifest.project_name = 'TestProj1'
+        for row, (specimen_id, taxonomy_id) in enumerate([('SAN0000100', 6344),
+                                                         ('SAN0000101', 6344),
+                                                         ('SAN0000102', 6355)], start=1):
+            sample = SubmissionsSample(collected_by='ALEX COLLECTOR',
+                                       collection_location='UNITED KINGDOM | DARK FOREST',
+                                       collector_affiliation='THE COLLECTOR INSTITUTE',
+                                       date_of_collection='2020-09-01',
+                                       decimal_latitude='50.12345678',
+                                       decimal_longitude='-1.98765432',
+                                       family='Arenicolidae',
+                                       GAL='SANGER INSTITUTE',
+                                       GAL_sample_id='SAN000100',
+                                       genus='Arenicola',
+                                       habitat='Woodland',
+                                       identified_by='JO IDENTIFIER',
+                                       identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                                       lifestage='ADULT',
+                                       organism_part='MUSCLE',
+                                       order_or_group='Scolecida',
+                                       scientific_name='Arenicola marina',
+                                       sex='FEMALE',
+                                       specimen_id=specimen_id,
+                                       symbiont='SYMBIONT' if row == 3 else 'TARGET',
+                                       taxonomy_id=taxonomy_id,
+                                       voucher_id='voucher1',
+                                       row=row)
+            sample.manifest = manifest
+
+        # Only the rows that needed the services that couldn't be reached report it
+        number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual([[{'field': 'SPECIMEN_ID',
+                            'message': 'Communication failed with the ToLID service',
+                            'severity': 'ERROR'}],
+                          [],
+                          [{'field': 'TAXON_ID',
+                            'message': 'Communication with ENA has failed',
+                            'severity': 'ERROR'}]],
+                         [result['results'] for result in results])
+
+    @responses.activate
+    def test_validate_manifests_in_parallel(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                      json=[], status=200)
+        responses.add(responses.GET, re.compile(os.getenv('TOLID_URL', '') + '/specimens/.*'),
+                      json=[], status=404)
+
+        # The same rack/tube is used twice in the first manifest, but only once in the other
+        manifests = []
+        for number_of_samples in [2, 1]:
+            manifest = SubmissionsManifest()
+            manifest.project_name = 'TestProj1'
+            for row in range(1, number_of_samples + 1):
+                sample = SubmissionsSample(collected_by='ALEX COLLECTOR',
+                                           collection_location='UNITED KINGDOM | DARK FOREST',
+                                           collector_affiliation='THE COLLECTOR INSTITUTE',
+                                           date_of_collection='2020-09-01',
+                                           decimal_latitude='50.12345678',
+                                           decimal_longitude='-1.98765432',
+                                           family='Arenicolidae',
+                                           GAL='SANGER INSTITUTE',
+                                           GAL_sample_id='SAN000100',
+                                           genus='Arenicola',
+                                           habitat='Woodland',
+                                           identified_by='JO IDENTIFIER',
+                                           identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                                           lifestage='ADULT',
+                                           organism_part='MUSCLE',
+                                           order_or_group='Scolecida',
+                                           scientific_name='Arenicola marina',
+                                           sex='FEMALE',
+                                           specimen_id='SAN000010' + str(row),
+                                           symbiont='TARGET',
+                                           taxonomy_id=6344,
+                                           voucher_id='voucher1',
+                                           rack_or_plate_id='RR12345678',
+                                           tube_or_well_id='TB12345678',
+                                           row=row)
+                sample.manifest = manifest
+            manifests.append(manifest)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(validate_manifest, manifests * 10))
+
+        unique_error = {'field': 'SYMBIONT',
+                        'message': 'Must only be one target specimen id per rack/tube or '
+                                   'plate/well',
+                        'severity': 'ERROR'}
+        for i, (number_of_errors, manifest_results) in enumerate(results):
+            self.assertEqual(len(manifest_results), 2 if i % 2 == 0 else 1)
+            for result in manifest_results:
+                self.assertEqual(unique_error in result['results'], i % 2 == 0)
+
+    @responses.activate
+    def test_validate_manifest_incremental(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                      json=[], status=200)
+        responses.add(responses.GET, re.compile(os.getenv('TOLID_URL', '') + '/specimens/.*'),
+                      json=[], status=404)
+
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        manifest.project_name = 'TestProj1'
+        for row in range(1, 4):
+            SubmissionsSample(collected_by='ALEX COLLECTOR',
+                              collection_location='UNITED KINGDOM | DARK FOREST',
+                              collector_affiliation='THE COLLECTOR INSTITUTE',
+                              date_of_collection='2020-09-01',
+                              decimal_latitude='50.12345678',
+                              decimal_longitude='-1.98765432',
+                              family='Arenicolidae',
+                              GAL='SANGER INSTITUTE',
+                              GAL_sample_id='SAN000100',
+                              genus='Arenicola',
+                              habitat='Woodland',
+                              identified_by='JO IDENTIFIER',
+                              identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                              lifestage='ADULT',
+                              organism_part='MUSCLE',
+                              order_or_group='Scolecida',
+                              scientific_name='Arenicola marina',
+                              sex='FEMALE',
+                              specimen_id='SAN000010' + str(row),
+                              symbiont='TARGET',
+                              taxonomy_id=6344,
+                              voucher_id='voucher1',
+                              rack_or_plate_id='RR1234567' + str(row),
+                              tube_or_well_id='TB12345678',
+                              row=row,
+                              manifest=manifest)
+        db.session.add(manifest)
+        db.session.commit()
+        manifest_id = manifest.manifest_id
+
+        number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual(0, number_of_errors)
+        specimen_calls = [call for call in responses.calls if '/specimens/' in call.request.url]
+        self.assertEqual(3, len(specimen_calls))
+
+        # Nothing has changed, so nothing is checked again, and ToLID and ENA's answers
+        # are remembered
+        responses.calls.reset()
+        manifest = get_manifest_with_samples(manifest_id)
+        with patch('main.manifest_utils.validate_row', wraps=validate_row) as row_checks:
+            self.assertEqual((number_of_errors, results), validate_manifest(manifest))
+        row_checks.assert_not_called()
+        self.assertEqual(0, len(responses.calls))
+
+        # Only the changed row is checked again, but the row it now shares a rack/tube with
+        # is reported too
+        manifest = get_manifest_with_samples(manifest_id)
+        manifest.samples[2].specimen_id = 'SAN0000104'
+        manifest.samples[2].rack_or_plate_id = 'RR12345671'
+        db.session.commit()
+        manifest = get_manifest_with_samples(manifest_id)
+        with patch('main.manifest_utils.validate_row', wraps=validate_row) as row_checks:
+            number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual([manifest.samples[2]],
+                         [call.args[0] for call in row_checks.call_args_list])
+        self.assertEqual(2, number_of_errors)
+        self.assertEqual([['SYMBIONT'], [], ['SYMBIONT']],
+                         [[x['field'] for x in result['results']] for result in results])
+
+        # Failing to reach the ToLID service isn't remembered
+        clear_caches()
+        responses.replace(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                          json=[], status=500)
+        manifest = get_manifest_with_samples(manifest_id)
+        number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual(5, number_of_errors)
+        responses.replace(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                          json=[], status=200)
+        manifest = get_manifest_with_samples(manifest_id)
+        number_of_errors, results = validate_manifest(manifest)
+        self.assertEqual(2, number_of_errors)
+
+    def test_cache_validation(self):
+        results = [{'row': 1,
+                    'results': [{'field': 'TAXON_ID',
+                                 'message': 'Species not known in the ToLID service',
+                                 'severity': 'WARNING'}]}]
+        self.assertIsNone(get_cached_validation('key1'))
+        cache_validation('key1', 1, results)
+        self.assertEqual((1, results), get_cached_validation('key1'))
+
+        # Replaced when validated again
+        cache_validation('key1', 0, [{'row': 1, 'results': []}])
+        self.assertEqual((0, [{'row': 1, 'results': []}]), get_cached_validation('key1'))
+
+        # Not kept if a service couldn't be reached
+        cache_validation('key2', 1, [{'row': 1,
+                                      'results': [{'field': 'TAXON_ID',
+                                                   'message': 'Communication with ENA has '
+                                                              'failed with status code 500',
+                                                   'severity': 'ERROR'}]}])
+        self.assertIsNone(get_cached_validation('key2'))
+
+        # Expired results aren't used, and are cleared out when others are kept
+        with patch('main.manifest_utils.VALIDATION_CACHE_TTL', -1):
+            cache_validation('key1', 1, results)
+        self.assertIsNone(get_cached_validation('key1'))
+        cache_validation('key3', 1, results)
+        self.assertEqual(['key3'], [x.cache_key for x in db.session.query(SubmissionsValidation)])
+
     def test_validate_against_ena_checklist_fail(self):
         manifest = SubmissionsManifest()
         manifest.project_name = 'MostExcellentProject'
@@ -695,7 +1129,7 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_ena_submittable(sample)
+        results = validate_ena_submittable(sample, ValidationContext([sample]))
         expected = []
 
         self.assertEqual(results, expected)
@@ -742,7 +1176,7 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_ena_submittable(sample)
+        results = validate_ena_submittable(sample, ValidationContext([sample]))
         expected = [{'field': 'TAXON_ID',
                      'message': 'Is not ENA submittable',
                      'severity': 'ERROR'},
@@ -785,7 +1219,7 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_ena_submittable(sample)
+        results = validate_ena_submittable(sample, ValidationContext([sample]))
         expected = [{'field': 'TAXON_ID',
                      'message': 'Is not known at ENA',
                      'severity': 'ERROR'}]
@@ -825,13 +1259,43 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_ena_submittable(sample)
+        results = validate_ena_submittable(sample, ValidationContext([sample]))
         expected = [{'field': 'TAXON_ID',
                      'message': 'Communication with ENA has failed with status code 500',
                      'severity': 'ERROR'}]
 
         self.assertEqual(results, expected)
 
+    @responses.activate
+    def test_validate_ena_submittable_cached(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/1',
+                      body='No results.', status=200)
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/2',
+                      body='', status=500)
+
+        sample = SubmissionsSample()
+        sample.scientific_name = 'Arenicola marina'
+        for taxonomy_id in [6344, 6344, 1, 1, 2, 2]:
+            sample.taxonomy_id = taxonomy_id
+            validate_ena_submittable(sample, ValidationContext([sample]))
+
+        # Failures are not cached
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(ena_taxonomy_cache.get(6344),
+                         (True, (200, {'scientificName': 'Arenicola marina',
+                                       'submittable': 'true'})))
+        self.assertEqual(ena_taxonomy_cache.get(1), (True, (200, None)))
+        self.assertEqual(ena_taxonomy_cache.get(2), (False, None))
+        stats = ena_taxonomy_cache.stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 4)
+        # Unknown taxa expire sooner
+        expires_at = {key: entry[0] for key, entry in ena_taxonomy_cache.entries.items()}
+        self.assertLess(expires_at[1], expires_at[6344])
+
     # The real version of this does a call to the ToLID service. We mock that call here
     @responses.activate
     def test_validate_tolid_correct(self):
@@ -871,7 +1335,7 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_species_known_in_tolid(sample)
+        results = validate_species_known_in_tolid(sample, ValidationContext([sample]))
         expected = []
 
         self.assertEqual(results, expected)
@@ -910,7 +1374,7 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_species_known_in_tolid(sample)
+        results = validate_species_known_in_tolid(sample, ValidationContext([sample]))
         expected = [{'field': 'TAXON_ID',
                      'message': 'Species not known in the ToLID service',
                      'severity': 'WARNING'}]
@@ -951,16 +1415,116 @@ class TestManifestUtils(BaseTestCase):
         sample.depth = '1000'
         sample.relationship = 'child of 1234'
 
-        results = validate_species_known_in_tolid(sample)
+        results = validate_species_known_in_tolid(sample, ValidationContext([sample]))
         expected = [{'field': 'TAXON_ID',
                      'message': 'Communication failed with the ToLID service: status code 500',
                      'severity': 'ERROR'}]
 
         self.assertEqual(results, expected)
 
+    @patch('main.manifest_utils.Entrez')
+    def test_get_ncbi_data_stores_taxonomy(self, entrez):
+        arenicola = {'TaxId': '6344',
+                     'ScientificName': 'Arenicola marina',
+                     'Rank': 'species',
+                     'ParentTaxId': '6343',
+                     'LineageEx': [{'TaxId': '42115', 'ScientificName': 'Arenicolidae',
+                                    'Rank': 'family'},
+                                   {'TaxId': '6343', 'ScientificName': 'Arenicola',
+                                    'Rank': 'genus'}]}
+        entrez.read.return_value = [arenicola]
+
+        manifest = SubmissionsManifest()
+        sample = SubmissionsSample(taxonomy_id=6344)
+        sample.manifest = manifest
+        expected = {6344: {'TaxId': '6344',
+                           'ScientificName': 'Arenicola marina',
+                           'Rank': 'species',
+                           'LineageEx': arenicola['LineageEx']}}
+
+        self.assertEqual(get_ncbi_data(manifest), expected)
+        self.assertEqual(entrez.efetch.call_count, 1)
+        self.assertEqual(entrez.efetch.call_args.kwargs['id'], ['6344'])
+
+        # Seen before, so NCBI is not asked again
+        self.assertEqual(get_ncbi_data(manifest), expected)
+        self.assertEqual(entrez.efetch.call_count, 1)
+
+        # Only the new taxon is fetched
+        sample = SubmissionsSample(taxonomy_id=6345)
+        sample.manifest = manifest
+        entrez.read.return_value = []
+        self.assertEqual(get_ncbi_data(manifest), expected)
+        self.assertEqual(entrez.efetch.call_count, 2)
+        self.assertEqual(entrez.efetch.call_args.kwargs['id'], ['6345'])
+
+        # Stale taxa are fetched again
+        taxonomy = db.session.query(SubmissionsTaxonomy).one()
+        taxonomy.updated_at = datetime.datetime.now() - datetime.timedelta(days=31)
+        db.session.commit()
+        arenicola['ScientificName'] = 'Arenicola marina2'
+        entrez.read.return_value = [arenicola]
+        self.assertEqual(get_ncbi_data(manifest)[6344]['ScientificName'], 'Arenicola marina2')
+        self.assertEqual(sorted(entrez.efetch.call_args.kwargs['id']), ['6344', '6345'])
+        self.assertEqual(db.session.query(SubmissionsTaxonomy).one().scientific_name,
+                         'Arenicola marina2')
+
+    @patch('main.manifest_utils.Entrez')
+    def test_get_ncbi_data_stored_at_the_same_time(self, entrez):
+        entrez.read.return_value = [{'TaxId': '6344',
+                                     'ScientificName': 'Arenicola marina',
+                                     'Rank': 'species',
+                                     'LineageEx': []}]
+
+        def stored_by_another_request(*args, **kwargs):
+            with db.engine.begin() as connection:
+                connection.execute(SubmissionsTaxonomy.__table__.insert(),
+                                   {'taxonomy_id': 6344,
+                                    'rank': 'species',
+                                    'scientific_name': 'Arenicola marina1',
+                                    'lineage': [],
+                                    'updated_at': datetime.datetime.now()})
+        entrez.efetch.side_effect = stored_by_another_request
+
+        manifest = SubmissionsManifest()
+        sample = SubmissionsSample(taxonomy_id=6344)
+        sample.manifest = manifest
+        # Work of the caller's that it hasn't committed
+        db.session.add(SubmissionsSpecimen(specimen_id='SAN0000100',
+                                           biosample_accession='SAMEA1'))
+        db.session.flush()
+
+        self.assertEqual(get_ncbi_data(manifest)[6344]['ScientificName'], 'Arenicola marina')
+        db.session.rollback()
+        self.assertEqual(db.session.query(SubmissionsSpecimen).count(), 0)
+        self.assertEqual(db.session.query(SubmissionsTaxonomy).one().scientific_name,
+                         'Arenicola marina')
+
+    @patch('main.manifest_utils.Entrez')
+    def test_get_ncbi_data_stale_when_ncbi_unavailable(self, entrez):
+        taxonomy = SubmissionsTaxonomy(taxonomy_id=6344,
+                                       rank='species',
+                                       scientific_name='Arenicola marina',
+                                       lineage=[],
+                                       updated_at=datetime.datetime(2020, 1, 1))
+        db.session.add(taxonomy)
+        db.session.commit()
+        entrez.efetch.side_effect = URLError('unavailable')
+
+        manifest = SubmissionsManifest()
+        sample = SubmissionsSample(taxonomy_id=6344)
+        sample.manifest = manifest
+        self.assertEqual(get_ncbi_data(manifest)[6344]['ScientificName'], 'Arenicola marina')
+
+        # Cannot do without a taxon we've never seen
+        sample = SubmissionsSample(taxonomy_id=6345)
+        sample.manifest = manifest
+        with self.assertRaises(URLError):
+            get_ncbi_data(manifest)
+
     def test_validate_ncbi_correct(self):
         manifest = SubmissionsManifest()
-        manifest.ncbi_data = {6344: {
+        ncbi_data = {6344: {
             'TaxId': '6344',
             'ScientificName': 'Arenicola marina',
             'OtherNames': {
@@ -1038,14 +1602,14 @@ class TestManifestUtils(BaseTestCase):
         sample.relationship = 'child of 1234'
         sample.manifest = manifest
 
-        results = validate_against_ncbi(sample)
+        results = validate_against_ncbi(sample, ncbi_data)
         expected = []
 
         self.assertEqual(results, expected)
 
     def test_validate_ncbi_species_missing(self):
         manifest = SubmissionsManifest()
-        manifest.ncbi_data = {}
+        ncbi_data = {}
 
         sample = SubmissionsSample()
         sample.specimen_id = 'specimen1234'
@@ -1075,7 +1639,7 @@ class TestManifestUtils(BaseTestCase):
         sample.relationship = 'child of 1234'
         sample.manifest = manifest
 
-        results = validate_against_ncbi(sample)
+        results = validate_against_ncbi(sample, ncbi_data)
         expected = [{'field': 'TAXON_ID',
                      'message': 'Species not known in the NCBI service',
                      'severity': 'ERROR'}]
@@ -1084,7 +1648,7 @@ class TestManifestUtils(BaseTestCase):
 
     def test_validate_ncbi_species_not_species(self):
         manifest = SubmissionsManifest()
-        manifest.ncbi_data = {6344: {
+        ncbi_data = {6344: {
             'TaxId': '6344',
             'ScientificName': 'Arenicola marina',
             'OtherNames': {
@@ -1163,7 +1727,7 @@ class TestManifestUtils(BaseTestCase):
         sample.relationship = 'child of 1234'
         sample.manifest = manifest
 
-        results = validate_against_ncbi(sample)
+        results = validate_against_ncbi(sample, ncbi_data)
         expected = [{'field': 'TAXON_ID',
                      'message': 'All TARGETs must be of NCBI rank species',
                      'severity': 'ERROR'}]
@@ -1172,7 +1736,7 @@ class TestManifestUtils(BaseTestCase):
 
     def test_validate_ncbi_order_is_a_clade(self):
         manifest = SubmissionsManifest()
-        manifest.ncbi_data = {6344: {
+        ncbi_data = {6344: {
             'TaxId': '6344',
             'ScientificName': 'Arenicola marina',
             'OtherNames': {
@@ -1251,7 +1815,7 @@ class TestManifestUtils(BaseTestCase):
         sample.relationship = 'child of 1234'
         sample.manifest = manifest
 
-        results = validate_against_ncbi(sample)
+        results = validate_against_ncbi(sample, ncbi_data)
         expected = [{'field': 'ORDER_OR_GROUP',
                      'message': 'Does not match a node in the NCBI service',
                      'severity': 'ERROR'}]
@@ -1260,7 +1824,7 @@ class TestManifestUtils(BaseTestCase):
 
     def test_validate_ncbi_name_genus_family_order(self):
         manifest = SubmissionsManifest()
-        manifest.ncbi_data = {6344: {
+        ncbi_data = {6344: {
             'TaxId': '6344',
             'ScientificName': 'Arenicola marina',
             'OtherNames': {
@@ -1339,7 +1903,7 @@ class TestManifestUtils(BaseTestCase):
         sample.relationship = 'child of 1234'
         sample.manifest = manifest
 
-        results = validate_against_ncbi(sample)
+        results = validate_against_ncbi(sample, ncbi_data)
         expected = [{'field': 'SCIENTIFIC_NAME',
                      'message': 'Does not match that in the NCBI service '
                      + '(expecting Arenicola marina)',
@@ -1385,7 +1949,7 @@ class TestManifestUtils(BaseTestCase):
         sample.specimen_id = 'SAN0001234'
         sample.taxonomy_id = 6344
 
-        results = validate_specimen_against_tolid(sample)
+        results = validate_specimen_against_tolid(sample, ValidationContext([sample]))
         expected = []
 
         self.assertEqual(results, expected)
@@ -1401,7 +1965,7 @@ class TestManifestUtils(BaseTestCase):
         sample.specimen_id = 'SAN0001234'
         sample.taxonomy_id = 6344
 
-        results = validate_specimen_against_tolid(sample)
+        results = validate_specimen_against_tolid(sample, ValidationContext([sample]))
         self.assertEqual(results, [])
 
     # The real version of this does a call to the ToLID service. We mock that call here
@@ -1415,7 +1979,7 @@ class TestManifestUtils(BaseTestCase):
         sample.specimen_id = 'SAN0001234'
         sample.taxonomy_id = 6344
 
-        results = validate_specimen_against_tolid(sample)
+        results = validate_specimen_against_tolid(sample, ValidationContext([sample]))
         expected = [{'field': 'SPECIMEN_ID',
                      'message': 'Communication failed with the ToLID service: status code 500',
                      'severity': 'ERROR'}]
@@ -1464,7 +2028,7 @@ class TestManifestUtils(BaseTestCase):
         sample = SubmissionsSample()
         sample.specimen_id = 'SAN0001234'
         sample.taxonomy_id = 6366
-        results = validate_specimen_against_tolid(sample)
+        results = validate_specimen_against_tolid(sample, ValidationContext([sample]))
         expected = [{'field': 'SPECIMEN_ID',
                      'message': 'Has been used before but with different taxonomy ID',
                      'severity': 'ERROR'}]
@@ -1477,7 +2041,7 @@ class TestManifestUtils(BaseTestCase):
         sample.taxonomy_id = 6344
         sample.symbiont = 'SYMBIONT'
 
-        results = validate_specimen_against_tolid(sample)
+        results = validate_specimen_against_tolid(sample, ValidationContext([sample]))
 
         self.assertEqual(results, [])
 
@@ -1616,12 +2180,17 @@ class TestManifestUtils(BaseTestCase):
         db.session.add(manifest)
         db.session.commit()
 
-        number_of_errors, results = generate_tolids_for_manifest(manifest)
+        # Only the samples are loaded, not one query per ToLID
+        with self.assertQueryCount(2):
+            number_of_errors, results = generate_tolids_for_manifest(manifest)
 
         self.assertEqual(0, number_of_errors)
         self.assertEqual([], results)
         self.assertEqual('wuAreMari1', sample.tolid)
         self.assertEqual('wuAreMari1', sample2.tolid)
+        # Each specimen and taxon is only asked for once
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         [{'taxonomyId': 6344, 'specimenId': 'specimen1234'}])
 
     @responses.activate
     def test_generate_tolids_for_manifest_failure(self):
@@ -1874,6 +2443,47 @@ class TestManifestUtils(BaseTestCase):
 
         self.assertEqual('SAMEA8521239', specimen.biosample_accession)
 
+    @responses.activate
+    def test_set_relationships_for_manifest_batched(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        for i, specimen_id in enumerate(['specimen1', 'specimen2', 'specimen3',
+                                         'specimen1', 'specimen2', 'specimen3'], start=1):
+            SubmissionsSample(row=i,
+                              specimen_id=specimen_id,
+                              taxonomy_id=6344,
+                              scientific_name='Arenicola marina',
+                              lifestage='ADULT',
+                              sex='FEMALE',
+                              organism_part='MUSCLE',
+                              manifest=manifest)
+        specimen = SubmissionsSpecimen()
+        specimen.specimen_id = 'specimen1'
+        specimen.biosample_accession = 'SAMEA1'
+        db.session.add(specimen)
+        db.session.add(manifest)
+        db.session.commit()
+        samples = manifest.samples
+
+        for specimen_id, biosample_accession in [('specimen2', 'SAMEA2'),
+                                                 ('specimen3', 'SAMEA3')]:
+            responses.add(responses.GET, os.getenv('STS_URL', '')
+                          + '/specimens?specimen_id=' + specimen_id,
+                          json={'data': {'list': [{'specimen_id': specimen_id,
+                                                   'bio_specimen_id': biosample_accession}]}})
+
+        # One query for the known specimens, then the updates
+        with self.assertQueryCount(2) as statements:
+            error_count, results = set_relationships_for_manifest(manifest)
+
+        self.assertEqual(1, sum('FROM specimen' in statement for statement in statements))
+        self.assertEqual(0, error_count)
+        self.assertEqual([], results)
+        # Each specimen that we don't already have is looked up in STS once
+        self.assertEqual(2, len(responses.calls))
+        self.assertEqual(['SAMEA1', 'SAMEA2', 'SAMEA3'] * 2,
+                         [sample.sample_derived_from for sample in samples])
+
     @responses.activate
     def test_set_relationships_for_manifest_new_specimen_ena_error(self):
         manifest = SubmissionsManifest()
@@ -1933,6 +2543,84 @@ class TestManifestUtils(BaseTestCase):
                                         'severity': 'ERROR'}],
                            'row': 1}], results)
 
+    @responses.activate
+    def test_set_relationships_for_manifest_new_specimens_partly_accepted(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        for i, specimen_id in enumerate(['specimen1', 'specimen2'], start=1):
+            SubmissionsSample(row=i,
+                              specimen_id=specimen_id,
+                              taxonomy_id=6344,
+                              scientific_name='Arenicola marina',
+                              lifestage='ADULT',
+                              sex='FEMALE',
+                              organism_part='MUSCLE',
+                              GAL='Sanger Institute',
+                              GAL_sample_id='SAN000100',
+                              collected_by='ALEX COLLECTOR',
+                              collector_affiliation='THE COLLECTOR INSTUTUTE',
+                              date_of_collection='2020-09-01',
+                              collection_location='UNITED KINGDOM | DARK FOREST',
+                              decimal_latitude='+50.12345678',
+                              decimal_longitude='-1.98765432',
+                              habitat='WOODLAND',
+                              identified_by='JO IDENTIFIER',
+                              identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                              voucher_id='voucher1',
+                              manifest=manifest)
+        db.session.add(manifest)
+        db.session.commit()
+        samples = manifest.samples
+
+        for specimen_id in ['specimen1', 'specimen2']:
+            responses.add(responses.GET, os.getenv('STS_URL', '')
+                          + '/specimens?specimen_id=' + specimen_id,
+                          json={'data': {'list': []}})
+
+        submitted = []
+        rejected = ['specimen2']
+
+        def ena_callback(request):
+            specimen_id = re.search(rb'<TAG>specimen_id</TAG>\s*<VALUE>(\w+)</VALUE>',
+                                    request.body).group(1).decode()
+            alias = re.search(rb'<SAMPLE alias="(\d+)"', request.body).group(1).decode()
+            submitted.append(specimen_id)
+            if specimen_id in rejected:
+                return (200, {}, '<RECEIPT success="false"><SAMPLE alias="' + alias
+                        + '"/><MESSAGES><ERROR>Invalid</ERROR></MESSAGES></RECEIPT>')
+            return (200, {}, '<RECEIPT success="true"><SAMPLE accession="ERS' + alias
+                    + '" alias="' + alias + '"><EXT_ID accession="SAMEA' + specimen_id
+                    + '"/></SAMPLE><SUBMISSION accession="ERA3819349"/></RECEIPT>')
+
+        responses.add_callback(responses.POST,
+                               os.getenv('ENA_URL', '') + '/ena/submit/drop-box/submit/',
+                               callback=ena_callback)
+
+        with patch('main.manifest_utils.ENA_CHUNK_SIZE', 1):
+            error_count, results = set_relationships_for_manifest(manifest)
+
+        self.assertEqual(1, error_count)
+        # The chunks are submitted at the same time
+        self.assertEqual(['specimen1', 'specimen2'], sorted(submitted))
+        # The accepted specimen is kept
+        db.session.rollback()
+        specimen = db.session.query(SubmissionsSpecimen) \
+            .filter(SubmissionsSpecimen.specimen_id == 'specimen1') \
+            .one()
+        self.assertEqual('SAMEAspecimen1', specimen.biosample_accession)
+        self.assertEqual('SAMEAspecimen1', samples[0].sample_derived_from)
+        self.assertIsNone(samples[1].sample_derived_from)
+
+        # Only the rejected specimen is submitted again
+        rejected = []
+        with patch('main.manifest_utils.ENA_CHUNK_SIZE', 1):
+            error_count, results = set_relationships_for_manifest(manifest)
+
+        self.assertEqual(0, error_count)
+        self.assertEqual(['specimen2'], submitted[2:])
+        self.assertEqual(['SAMEAspecimen1', 'SAMEAspecimen2'],
+                         [sample.sample_derived_from for sample in samples])
+
     @responses.activate
     def test_generate_ena_ids_for_manifest(self):
         manifest = SubmissionsManifest()
@@ -2016,6 +2704,133 @@ class TestManifestUtils(BaseTestCase):
         self.assertTrue(sample.submission_error is None)
         self.assertTrue(sample2.submission_error is None)
 
+    def test_assign_ena_ids(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        for i in range(1, 501):
+            sample = SubmissionsSample()
+            sample.row = i
+            sample.specimen_id = 'specimen' + str(i)
+            sample.taxonomy_id = 6344
+            sample.scientific_name = 'Arenicola marina'
+            sample.lifestage = 'ADULT'
+            sample.sex = 'FEMALE'
+            sample.organism_part = 'MUSCLE'
+            sample.manifest = manifest
+        db.session.add(manifest)
+        db.session.commit()
+        samples = manifest.samples
+
+        receipt = '<RECEIPT success="true">' + ''.join(
+            '<SAMPLE accession="ERS' + str(i) + '" alias="' + str(sample.sample_id) + '">'
+            '<EXT_ID accession="SAMEA' + str(i) + '" type="biosample"/></SAMPLE>'
+            for i, sample in enumerate(samples)) \
+            + '<SAMPLE accession="ERS0" alias="0"><EXT_ID accession="SAMEA0"/></SAMPLE>' \
+            + '<SUBMISSION accession="ERA3819349"/></RECEIPT>'
+
+        # The aliases are looked up in the samples already loaded
+        with self.assertQueryCount(0):
+            self.assertTrue(assign_ena_ids(manifest, receipt))
+
+        self.assertTrue(manifest.submission_status)
+        for i, sample in enumerate(samples):
+            self.assertEqual('SAMEA' + str(i), sample.biosample_accession)
+            self.assertEqual('ERS' + str(i), sample.sra_accession)
+            self.assertEqual('ERA3819349', sample.submission_accession)
+
+        receipt = '<RECEIPT success="false"><SAMPLE alias="' + str(samples[1].sample_id) \
+            + '"/><SAMPLE alias="0"/><MESSAGES><ERROR>Already exists</ERROR></MESSAGES>' \
+            + '</RECEIPT>'
+        with self.assertQueryCount(0):
+            self.assertFalse(assign_ena_ids(manifest, receipt))
+
+        self.assertFalse(manifest.submission_status)
+        self.assertIsNone(samples[0].submission_error)
+        self.assertEqual('Already exists<br>', samples[1].submission_error)
+
+    @responses.activate
+    def test_generate_ena_ids_for_manifest_chunked(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        for i in range(1, 6):
+            SubmissionsSample(row=i,
+                              specimen_id='specimen' + str(i),
+                              taxonomy_id=6344,
+                              scientific_name='Arenicola marina',
+                              lifestage='ADULT',
+                              sex='FEMALE',
+                              organism_part='MUSCLE',
+                              GAL='Sanger Institute',
+                              GAL_sample_id='SAN000100',
+                              collected_by='ALEX COLLECTOR',
+                              collector_affiliation='THE COLLECTOR INSTUTUTE',
+                              date_of_collection='2020-09-01',
+                              collection_location='UNITED KINGDOM | DARK FOREST',
+                              decimal_latitude='+50.12345678',
+                              decimal_longitude='-1.98765432',
+                              habitat='WOODLAND',
+                              identified_by='JO IDENTIFIER',
+                              identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                              voucher_id='voucher1',
+                              manifest=manifest)
+        db.session.add(manifest)
+        db.session.commit()
+        samples = manifest.samples
+        rejected_alias = str(samples[4].sample_id)
+        submitted = []
+
+        def ena_callback(request):
+            aliases = [alias.decode() for alias in
+                       re.findall(rb'<SAMPLE alias="(\d+)"', request.body)]
+            submitted.append(aliases)
+            if aliases == [str(samples[2].sample_id), str(samples[3].sample_id)] \
+                    and submitted.count(aliases) == 1:
+                return (503, {}, '')
+            if rejected_alias in aliases:
+                return (200, {}, '<RECEIPT success="false"><SAMPLE alias="' + rejected_alias
+                        + '"/><MESSAGES><ERROR>Invalid</ERROR></MESSAGES></RECEIPT>')
+            return (200, {}, '<RECEIPT success="true">' + ''.join(
+                '<SAMPLE accession="ERS' + alias + '" alias="' + alias + '">'
+                '<EXT_ID accession="SAMEA' + alias + '"/></SAMPLE>' for alias in aliases)
+                + '<SUBMISSION accession="ERA3819349"/></RECEIPT>')
+
+        responses.add_callback(responses.POST,
+                               os.getenv('ENA_URL', '') + '/ena/submit/drop-box/submit/',
+                               callback=ena_callback)
+
+        with patch('main.manifest_utils.ENA_CHUNK_SIZE', 2), \
+                patch('main.manifest_utils.time.sleep') as sleep:
+            number_of_errors, results = generate_ena_ids_for_manifest(manifest, retries=2,
+                                                                      retry_delay=3)
+
+        # The chunk that couldn't reach ENA is tried again after a pause, the rejected one isn't
+        sleep.assert_called_once_with(3)
+        self.assertEqual(4, len(submitted))
+        self.assertEqual(1, number_of_errors)
+        self.assertEqual([{'row': 5,
+                           'results': [{'field': 'TAXON_ID',
+                                        'message': 'Error returned from ENA service',
+                                        'severity': 'ERROR'}]}], results)
+        self.assertFalse(manifest.submission_status)
+        for sample in samples[:4]:
+            self.assertEqual('SAMEA' + str(sample.sample_id), sample.biosample_accession)
+            self.assertEqual('ERS' + str(sample.sample_id), sample.sra_accession)
+            self.assertIsNone(sample.submission_error)
+        self.assertIsNone(samples[4].biosample_accession)
+        self.assertEqual('Invalid<br>', samples[4].submission_error)
+
+        # Only the rejected chunk is submitted again
+        rejected_alias = None
+        with patch('main.manifest_utils.ENA_CHUNK_SIZE', 2):
+            number_of_errors, results = generate_ena_ids_for_manifest(manifest)
+
+        self.assertEqual([str(samples[4].sample_id)], submitted[-1])
+        self.assertEqual(5, len(submitted))
+        self.assertEqual(0, number_of_errors)
+        self.assertTrue(manifest.submission_status)
+        self.assertEqual('SAMEA' + str(samples[4].sample_id), samples[4].biosample_accession)
+        self.assertIsNone(samples[4].submission_error)
+
     @responses.activate
     def test_generate_ena_ids_for_manifest_connection_failed(self):
         manifest = SubmissionsManifest()
@@ -0,0 +1,51 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+from test.system import BaseTestCase
+
+from main.controllers.users_controller import query_samples_from_biospecimen
+from main.model import SubmissionsSample, db
+
+from sqlalchemy.dialects import postgresql
+
+
+class TestQueryPlans(BaseTestCase):
+
+    def explain(self, query):
+        statement = query.statement.compile(dialect=postgresql.dialect(),
+                                            compile_kwargs={'literal_binds': True})
+        # The test tables are tiny, so only use a sequential scan if there is no index
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        plan = '\n'.join(row[0] for row in db.session.execute('EXPLAIN ' + str(statement)))
+        db.session.rollback()
+        return plan
+
+    def assertIndexed(self, query):
+        plan = self.explain(query)
+        self.assertNotIn('Seq Scan on sample', plan, plan)
+
+    def test_samples_from_biospecimen_indexed(self):
+        self.assertIndexed(query_samples_from_biospecimen('SAMEA7701562'))
+
+    def test_sample_by_biosample_accession_indexed(self):
+        self.assertIndexed(db.session.query(SubmissionsSample)
+                           .filter(SubmissionsSample.biosample_accession == 'SAMEA7701758'))
+
+    def test_samples_by_manifest_indexed(self):
+        self.assertIndexed(db.session.query(SubmissionsSample)
+                           .filter(SubmissionsSample.manifest_id == 1))
+        self.assertIndexed(db.session.query(SubmissionsSample)
+                           .filter(SubmissionsSample.manifest_id == 1)
+                           .filter(SubmissionsSample.specimen_id == 'SAN0000100')
+                           .filter(SubmissionsSample.taxonomy_id == 6344))
+        self.assertIndexed(db.session.query(SubmissionsSample)
+                           .filter(SubmissionsSample.manifest_id == 1)
+                           .filter(SubmissionsSample.sample_id == 1))
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
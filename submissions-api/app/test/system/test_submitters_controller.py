@@ -5,10 +5,12 @@
 from __future__ import absolute_import
 
 import datetime
+import json
 import os
 from test.system import BaseTestCase
 from unittest.mock import patch
 
+from main.job_utils import run_next_job
 from main.model import SubmissionsManifest, SubmissionsSample, \
     SubmissionsSpecimen, db
 
@@ -560,6 +562,94 @@ class TestSubmittersController(BaseTestCase):
                     ]
         self.assertEqual(expected, response.json)
 
+    def test_manifest_query_counts(self):
+        api_key = self.user3.api_key
+        body = {'samples': [{'row': row,
+                             'SPECIMEN_ID': 'SAN0000100',
+                             'TAXON_ID': 6344,
+                             'SCIENTIFIC_NAME': 'Arenicola marina',
+                             'LIFESTAGE': 'ADULT',
+                             'SEX': 'FEMALE',
+                             'ORGANISM_PART': 'MUSCLE',
+                             'EXTRA_FIELD': 'extra',
+                             'OTHER_EXTRA_FIELD': 'other'}
+                            for row in range(1, 11)]}
+
+        # Authorisation, role, user, four to insert and three to return the manifest
+        with self.assertQueryCount(10):
+            response = self.client.open(
+                '/api/v1/manifests',
+                method='POST',
+                headers={'api-key': api_key},
+                json=body)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual(len(response.json['samples']), 10)
+
+        # Authorisation, role, manifest, samples, extra fields
+        with self.assertQueryCount(5):
+            response = self.client.open(
+                '/api/v1/manifests/1',
+                method='GET',
+                headers={'api-key': api_key})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual(response.json['samples'][9]['OTHER_EXTRA_FIELD'], 'other')
+
+        # Authorisation, role, manifests with their users, users' roles
+        with self.assertQueryCount(4):
+            response = self.client.open(
+                '/api/v1/manifests',
+                method='GET',
+                headers={'api-key': api_key})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual(response.json[0]['numberOfSamples'], 10)
+
+    def test_get_manifests_paginated(self):
+        for i in range(3):
+            manifest = SubmissionsManifest()
+            manifest.user = self.user1
+            for row in range(i):
+                sample = SubmissionsSample(specimen_id='SAN0000100',
+                                           taxonomy_id=6344,
+                                           scientific_name='Arenicola marina',
+                                           lifestage='ADULT',
+                                           sex='FEMALE',
+                                           organism_part='MUSCLE',
+                                           row=row + 1)
+                sample.manifest = manifest
+            db.session.add(manifest)
+        db.session.commit()
+
+        response = self.client.open(
+            '/api/v1/manifests?limit=2',
+            method='GET',
+            headers={'api-key': self.user3.api_key})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual([(m['manifestId'], m['numberOfSamples']) for m in response.json],
+                         [(3, 2), (2, 1)])
+        self.assertEqual(response.headers['X-Next-Cursor'], '2')
+
+        response = self.client.open(
+            '/api/v1/manifests?limit=2&cursor=2',
+            method='GET',
+            headers={'api-key': self.user3.api_key})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual([(m['manifestId'], m['numberOfSamples']) for m in response.json],
+                         [(1, 0)])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+        # Limit out of range
+        response = self.client.open(
+            '/api/v1/manifests?limit=0',
+            method='GET',
+            headers={'api-key': self.user3.api_key})
+        self.assert400(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
     @responses.activate
     @patch('main.manifest_utils.get_ncbi_data')
     def test_fill_manifest(self, get_ncbi_data):
@@ -1029,6 +1119,61 @@ class TestSubmittersController(BaseTestCase):
         self.assert404(response,
                        'Response body is : ' + response.data.decode('utf-8'))
 
+    @responses.activate
+    @patch('main.manifest_utils.get_ncbi_data')
+    def test_fill_manifest_reports_all_errors(self, get_ncbi_data):
+        def sts_samples(request):
+            specimen_id = json.loads(request.body)['specimen_specimen_id']
+            if specimen_id == 'SAN0000000':
+                return (400, {}, '{}')
+            return (200, {}, json.dumps({'data': {'list': [{'sample_rackid': '1234',
+                                                            'sample_tubeid': '5678'}]}}))
+        responses.add_callback(responses.POST, os.getenv('STS_URL', '') + '/samples',
+                               callback=sts_samples)
+        responses.add(responses.GET, os.getenv('STS_URL', '') + '/samples/detail',
+                      json={'data': {'gal_name_raw': 'UNIVERSITY OF OXFORD'}}, status=200)
+        get_ncbi_data.return_value = {63445: {'LineageEx': []}}
+
+        body = {'samples': [{
+            'row': row,
+            'SPECIMEN_ID': specimen_id,
+            'TAXON_ID': taxonomy_id,
+            'SCIENTIFIC_NAME': 'Arenicola marina symbiont',
+            'LIFESTAGE': 'ADULT',
+            'SEX': 'FEMALE',
+            'ORGANISM_PART': 'MUSCLE',
+            'SYMBIONT': 'SYMBIONT'}
+            for row, specimen_id, taxonomy_id in [(1, 'SAN1234567', 63445),
+                                                  (2, 'SAN1234567', 63445),
+                                                  (3, 'SAN0000000', 63445),
+                                                  (4, 'SAN1234567', 99999)]
+        ]}
+        response = self.client.open(
+            '/api/v1/manifests',
+            method='POST',
+            headers={'api-key': self.user3.api_key},
+            json=body)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        response = self.client.open(
+            '/api/v1/manifests/1/fill',
+            method='PATCH',
+            headers={'api-key': self.user3.api_key},
+            json=body)
+        self.assert404(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual(response.json['errors'], [
+            {'row': 3, 'detail': 'Specimen does not exist in STS: SAN0000000'},
+            {'row': 4, 'detail': 'Taxon ID does not exist in NCBI: 99999'}])
+        # One pair of STS calls for SAN1234567 and one failed call for SAN0000000
+        self.assertEqual(len(responses.calls), 3)
+
+        # Nothing is filled in when there are errors
+        sample = db.session.query(SubmissionsSample) \
+            .filter(SubmissionsSample.row == 1) \
+            .one()
+        self.assertIsNone(sample.GAL)
+
     @responses.activate
     @patch('main.manifest_utils.get_ncbi_data')
     def test_validate_manifest_json(self, get_ncbi_data):
@@ -1223,6 +1368,104 @@ class TestSubmittersController(BaseTestCase):
                     ]}
         self.assertEqual(expected, response.json)
 
+    @responses.activate
+    @patch('main.manifest_utils.VALIDATION_CHUNK_SIZE', 1)
+    def test_stream_manifest_validation(self):
+        responses.add(responses.GET, 'https://www.ebi.ac.uk/ena/taxonomy/rest/tax-id/6344',
+                      json={'scientificName': 'Arenicola marina', 'submittable': 'true'},
+                      status=200)
+        responses.add(responses.GET, os.getenv('TOLID_URL', '') + '/species/6344',
+                      json=[], status=200)
+        for row in range(1, 4):
+            responses.add(responses.GET,
+                          os.getenv('TOLID_URL', '') + '/specimens/SAN000010' + str(row),
+                          json=[], status=404)
+
+        manifest = SubmissionsManifest()
+        manifest.user = self.user3
+        manifest.project_name = 'TestProj1'
+        for row in range(1, 4):
+            SubmissionsSample(collected_by='ALEX COLLECTOR',
+                              collection_location='UNITED KINGDOM | DARK FOREST',
+                              collector_affiliation='THE COLLECTOR INSTITUTE',
+                              date_of_collection='2020-09-01',
+                              decimal_latitude='50.12345678',
+                              decimal_longitude='-1.98765432',
+                              family='Arenicolidae',
+                              GAL='SANGER INSTITUTE',
+                              GAL_sample_id='SAN000100',
+                              genus='Arenicola',
+                              habitat='Woodland',
+                              identified_by='JO IDENTIFIER',
+                              identifier_affiliation='THE IDENTIFIER INSTITUTE',
+                              lifestage='ADULT',
+                              organism_part='MUSCLE',
+                              order_or_group='Scolecida',
+                              scientific_name='Arenicola marina',
+                              sex='FEMALE',
+                              specimen_id='SAN000010' + str(row),
+                              symbiont='TARGET',
+                              taxonomy_id=6344,
+                              voucher_id='' if row == 2 else 'voucher1',
+                              row=row,
+                              manifest=manifest)
+        db.session.add(manifest)
+        db.session.commit()
+        manifest_id = manifest.manifest_id
+        url = '/api/v1/manifests/' + str(manifest_id) + '/validate/stream'
+
+        # Incorrect manifest ID
+        response = self.client.open(
+            '/api/v1/manifests/' + str(manifest_id + 1) + '/validate/stream',
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assert404(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # Not a submitter
+        response = self.client.open(
+            url,
+            method='GET',
+            headers={'api-key': self.api_key})
+        self.assert403(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # The first row is sent before the other rows are looked up
+        response = self.client.open(
+            url,
+            method='GET',
+            headers={'api-key': self.api_key3},
+            buffered=False)
+        self.assert200(response)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        records = iter(response.response)
+        self.assertEqual({'row': 1, 'results': []}, json.loads(next(records)))
+        self.assertEqual(['http://tolid/specimens/SAN0000101'],
+                         [call.request.url for call in responses.calls
+                          if '/specimens/' in call.request.url])
+        self.assertEqual([{'row': 2,
+                           'results': [{'field': 'VOUCHER_ID',
+                                        'message': 'Must not be empty',
+                                        'severity': 'ERROR'}]},
+                          {'row': 3, 'results': []},
+                          {'manifestId': manifest_id, 'number_of_errors': 1}],
+                         [json.loads(record) for record in records])
+        response.close()
+
+        # As server-sent events
+        response = self.client.open(
+            url + '?format=sse',
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assert200(response)
+        self.assertEqual('text/event-stream', response.mimetype)
+        events = response.data.decode('utf-8').split('\n\n')
+        self.assertEqual('', events.pop())
+        self.assertEqual(['row', 'row', 'row', 'summary'],
+                         [event.split('\n')[0][len('event: '):] for event in events])
+        self.assertEqual({'manifestId': manifest_id, 'number_of_errors': 1},
+                         json.loads(events[-1].split('\n')[1][len('data: '):]))
+
     @responses.activate
     @patch('main.manifest_utils.get_ncbi_data')
     def test_validate_manifest_json_unknown_taxon(self, get_ncbi_data):
@@ -1584,6 +1827,36 @@ class TestSubmittersController(BaseTestCase):
                     ]}
         self.assertEqual(expected, response.json)
 
+        # The same manifest again is saved, but not validated again
+        with patch('main.manifest_utils.validate_manifest') as validate_manifest:
+            response = self.client.open(
+                '/api/v1/manifests/validate',
+                method='POST',
+                headers={'api-key': self.api_key3},
+                json=body)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual({**expected, 'manifestId': 2}, response.json)
+        validate_manifest.assert_not_called()
+        # Its rows keep their results all the same
+        first_sample, second_sample = db.session.query(SubmissionsSample) \
+            .order_by(SubmissionsSample.manifest_id) \
+            .all()
+        self.assertEqual(first_sample.validation_hash, second_sample.validation_hash)
+        self.assertIsNotNone(second_sample.validation_hash)
+        self.assertEqual(first_sample.validation_results, second_sample.validation_results)
+
+        # A changed manifest is validated
+        body['samples'][0]['VOUCHER_ID'] = 'voucher1'
+        response = self.client.open(
+            '/api/v1/manifests/validate',
+            method='POST',
+            headers={'api-key': self.api_key3},
+            json=body)
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual(0, response.json['number_of_errors'])
+
     @responses.activate
     def test_generate_ids(self):
         specimen = SubmissionsSpecimen()
@@ -2236,6 +2509,145 @@ class TestSubmittersController(BaseTestCase):
                     ]}
         self.assertEqual(expected, response.json)
 
+    def test_generate_ids_for_manifest_async(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        db.session.add(manifest)
+        db.session.commit()
+
+        # No authorisation token given
+        response = self.client.open(
+            '/api/v1/manifests/1/generate?async=true',
+            method='PATCH')
+        self.assert401(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # User not a submitter
+        response = self.client.open(
+            '/api/v1/manifests/1/generate?async=true',
+            method='PATCH',
+            headers={'api-key': self.api_key})
+        self.assert403(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # Manifest does not exist
+        response = self.client.open(
+            '/api/v1/manifests/2/generate?async=true',
+            method='PATCH',
+            headers={'api-key': self.api_key3})
+        self.assert404(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        response = self.client.open(
+            '/api/v1/manifests/1/generate?async=true',
+            method='PATCH',
+            headers={'api-key': self.api_key3})
+        self.assertStatus(response, 202,
+                          'Response body is : ' + response.data.decode('utf-8'))
+        job_id = response.json['jobId']
+        self.assertEqual('generate', response.json['kind'])
+        self.assertEqual(1, response.json['manifestId'])
+        self.assertEqual('queued', response.json['status'])
+        self.assertEqual(0, response.json['progress'])
+
+        response = self.client.open(
+            '/api/v1/jobs/' + str(job_id),
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual('queued', response.json['status'])
+
+    def test_get_job(self):
+        manifest = SubmissionsManifest()
+        manifest.user = self.user1
+        db.session.add(manifest)
+        db.session.commit()
+
+        response = self.client.open(
+            '/api/v1/manifests/1/validate?async=true',
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assertStatus(response, 202,
+                          'Response body is : ' + response.data.decode('utf-8'))
+        job_id = response.json['jobId']
+        self.assertEqual('validate', response.json['kind'])
+
+        # No authorisation token given
+        response = self.client.open(
+            '/api/v1/jobs/' + str(job_id),
+            method='GET')
+        self.assert401(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # User not a submitter
+        response = self.client.open(
+            '/api/v1/jobs/' + str(job_id),
+            method='GET',
+            headers={'api-key': self.api_key})
+        self.assert403(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # Job does not exist
+        response = self.client.open(
+            '/api/v1/jobs/' + str(job_id + 1),
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assert404(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        def validate_manifest(manifest, report_progress):
+            report_progress('samples', 50)
+            return 0, [{'row': 1, 'results': []}]
+
+        with patch('main.manifest_utils.validate_manifest', side_effect=validate_manifest):
+            self.assertTrue(run_next_job())
+
+        response = self.client.open(
+            '/api/v1/jobs/' + str(job_id),
+            method='GET',
+            headers={'api-key': self.api_key3})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        self.assertEqual('succeeded', response.json['status'])
+        self.assertEqual('samples', response.json['phase'])
+        self.assertEqual(100, response.json['progress'])
+        self.assertEqual({'manifestId': 1,
+                          'number_of_errors': 0,
+                          'validations': [{'row': 1, 'results': []}]},
+                         response.json['result'])
+        self.assertIsNotNone(response.json['finishedAt'])
+
+    def test_get_caches(self):
+        # No authorisation token given
+        response = self.client.open(
+            '/api/v1/caches',
+            method='GET')
+        self.assert401(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        # Submitters cannot see the caches
+        response = self.client.open(
+            '/api/v1/caches',
+            method='GET',
+            headers={'api-key': self.user3.api_key})
+        self.assert403(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+
+        response = self.client.open(
+            '/api/v1/caches',
+            method='GET',
+            headers={'api-key': self.user2.api_key})
+        self.assert200(response,
+                       'Response body is : ' + response.data.decode('utf-8'))
+        expected = {'size': 0,
+                    'maxSize': 10000,
+                    'hits': 0,
+                    'misses': 0,
+                    'evictions': 0,
+                    'expirations': 0}
+        self.assertEqual(response.json['ena_taxonomy'], expected)
+
 
 if __name__ == '__main__':
     import unittest
@@ -0,0 +1,148 @@
+# SPDX-FileCopyrightText: 2021 Genome Research Ltd.
+#
+# SPDX-License-Identifier: MIT
+
+from __future__ import absolute_import
+
+import os
+import struct
+import tempfile
+from test.system import BaseTestCase
+from unittest.mock import patch
+
+import main.taxdump_utils as taxdump_utils
+from main.manifest_utils import get_ncbi_data, validate_against_ncbi
+from main.model import SubmissionsManifest, SubmissionsSample
+from main.taxdump_utils import TaxdumpIndex, build_taxdump_index
+
+NODES = [(1, 1, 'no rank'),
+         (131567, 1, 'no rank'),
+         (2759, 131567, 'superkingdom'),
+         (33208, 2759, 'kingdom'),
+         (6340, 33208, 'phylum'),
+         (105387, 6340, 'infraclass'),
+         (42115, 105387, 'family'),
+         (6343, 42115, 'genus'),
+         (6344, 6343, 'species')]
+NAMES = [(1, 'root', 'scientific name'),
+         (131567, 'cellular organisms', 'scientific name'),
+         (2759, 'Eukaryota', 'scientific name'),
+         (33208, 'Metazoa', 'scientific name'),
+         (33208, 'metazoans', 'genbank common name'),
+         (6340, 'Annelida', 'scientific name'),
+         (105387, 'Scolecida', 'scientific name'),
+         (42115, 'Arenicolidae', 'scientific name'),
+         (6343, 'Arenicola', 'scientific name'),
+         (6344, 'Arenicola marina', 'scientific name'),
+         (6344, 'lugworm', 'genbank common name')]
+# An old taxon ID, now part of Arenicola marina
+MERGED = [(36342, 6344)]
+
+
+class TestTaxdumpUtils(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        nodes_path = os.path.join(self.dir.name, 'nodes.dmp')
+        with open(nodes_path, 'w') as f:
+            for taxonomy_id, parent_id, rank in NODES:
+                f.write(f'{taxonomy_id}\t|\t{parent_id}\t|\t{rank}\t|\t\t|\t0\t|\n')
+        names_path = os.path.join(self.dir.name, 'names.dmp')
+        with open(names_path, 'w') as f:
+            for taxonomy_id, name, name_class in NAMES:
+                f.write(f'{taxonomy_id}\t|\t{name}\t|\t\t|\t{name_class}\t|\n')
+        merged_path = os.path.join(self.dir.name, 'merged.dmp')
+        with open(merged_path, 'w') as f:
+            for taxonomy_id, current_id in MERGED:
+                f.write(f'{taxonomy_id}\t|\t{current_id}\t|\n')
+        self.index_path = os.path.join(self.dir.name, 'taxdump.idx')
+        build_taxdump_index(nodes_path, names_path, merged_path, self.index_path)
+
+    def tearDown(self):
+        taxdump_utils._index = None
+        super().tearDown()
+
+    def test_index(self):
+        index = TaxdumpIndex(self.index_path)
+        self.assertIn(6344, index)
+        self.assertNotIn(6345, index)
+        self.assertNotIn(1000000, index)
+        self.assertEqual(index.rank(6344), 'species')
+        self.assertEqual(index.scientific_name(6344), 'Arenicola marina')
+        self.assertEqual(index.scientific_name(33208), 'Metazoa')
+        self.assertEqual(index.ancestor(6344, 'genus'), 'Arenicola')
+        self.assertEqual(index.ancestor(6344, 'family'), 'Arenicolidae')
+        self.assertIsNone(index.ancestor(6344, 'order'))
+        self.assertIsNone(index.get(6345))
+        expected = {'TaxId': '6344',
+                    'Rank': 'species',
+                    'ScientificName': 'Arenicola marina',
+                    'LineageEx': [
+                        {'TaxId': '131567', 'ScientificName': 'cellular organisms',
+                         'Rank': 'no rank'},
+                        {'TaxId': '2759', 'ScientificName': 'Eukaryota',
+                         'Rank': 'superkingdom'},
+                        {'TaxId': '33208', 'ScientificName': 'Metazoa', 'Rank': 'kingdom'},
+                        {'TaxId': '6340', 'ScientificName': 'Annelida', 'Rank': 'phylum'},
+                        {'TaxId': '105387', 'ScientificName': 'Scolecida',
+                         'Rank': 'infraclass'},
+                        {'TaxId': '42115', 'ScientificName': 'Arenicolidae',
+                         'Rank': 'family'},
+                        {'TaxId': '6343', 'ScientificName': 'Arenicola', 'Rank': 'genus'}]}
+        self.assertEqual(index.get(6344), expected)
+
+    def test_merged(self):
+        index = TaxdumpIndex(self.index_path)
+        self.assertEqual(index.current(36342), 6344)
+        self.assertEqual(index.current(6344), 6344)
+        self.assertEqual(index.current(1000000), 1000000)
+        self.assertNotIn(36342, index)
+        self.assertEqual(index.get(36342), index.get(6344))
+
+    def test_byte_order(self):
+        # The same on any architecture
+        with open(self.index_path, 'rb') as f:
+            data = f.read()
+        magic, size, rank_length, _ = struct.unpack_from('<8sIII', data)
+        self.assertEqual((magic, size), (b'TOLTAX02', 131568))
+        self.assertEqual(struct.unpack_from('<I', data, 20 + rank_length + 4 * 6344),
+                         (6343,))
+
+    def test_not_an_index(self):
+        with open(self.index_path, 'r+b') as f:
+            f.write(b'NOTTAX01')
+        with self.assertRaises(ValueError):
+            TaxdumpIndex(self.index_path)
+
+    @patch('main.manifest_utils.Entrez')
+    def test_get_ncbi_data_taxdump_backend(self, entrez):
+        os.environ['NCBI_TAXONOMY_BACKEND'] = 'taxdump'
+        os.environ['NCBI_TAXDUMP_INDEX'] = self.index_path
+
+        manifest = SubmissionsManifest()
+        for taxonomy_id in [6344, 6345, 36342]:
+            sample = SubmissionsSample(taxonomy_id=taxonomy_id,
+                                       scientific_name='Arenicola marina',
+                                       genus='Arenicola',
+                                       family='Arenicolidae',
+                                       order_or_group='Scolecida')
+            sample.manifest = manifest
+        ncbi_data = get_ncbi_data(manifest)
+        os.environ.pop('NCBI_TAXONOMY_BACKEND')
+        os.environ.pop('NCBI_TAXDUMP_INDEX')
+
+        entrez.efetch.assert_not_called()
+        self.assertEqual(list(ncbi_data), [6344, 36342])
+        self.assertEqual(validate_against_ncbi(manifest.samples[0], ncbi_data), [])
+        self.assertEqual(validate_against_ncbi(manifest.samples[1], ncbi_data),
+                         [{'field': 'TAXON_ID',
+                           'message': 'Species not known in the NCBI service',
+                           'severity': 'ERROR'}])
+        self.assertEqual(validate_against_ncbi(manifest.samples[2], ncbi_data), [])
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
@@ -0,0 +1,25 @@
+"""job heartbeat
+
+Revision ID: 3c6e8a1f9d27
+Revises: f2a9c7d4b150
+Create Date: 2026-10-18 23:05:12.548871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c6e8a1f9d27'
+down_revision = 'f2a9c7d4b150'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('job', sa.Column('updated_at', sa.DateTime(), nullable=True),
+                  schema='public')
+
+
+def downgrade():
+    op.drop_column('job', 'updated_at', schema='public')
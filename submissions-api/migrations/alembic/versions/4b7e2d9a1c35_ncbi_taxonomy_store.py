@@ -0,0 +1,32 @@
+"""ncbi taxonomy store
+
+Revision ID: 4b7e2d9a1c35
+Revises: c93413efb7ec
+Create Date: 2026-10-18 10:12:45.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2d9a1c35'
+down_revision = 'c93413efb7ec'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('taxonomy',
+                    sa.Column('taxonomy_id', sa.Integer(), nullable=False),
+                    sa.Column('rank', sa.String(), nullable=False),
+                    sa.Column('scientific_name', sa.String(), nullable=False),
+                    sa.Column('lineage', sa.JSON(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False,
+                              server_default=sa.func.now()),
+                    sa.PrimaryKeyConstraint('taxonomy_id'),
+                    schema='public')
+
+
+def downgrade():
+    op.drop_table('taxonomy', schema='public')
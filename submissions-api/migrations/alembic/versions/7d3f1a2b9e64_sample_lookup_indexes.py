@@ -0,0 +1,34 @@
+"""sample lookup indexes
+
+Revision ID: 7d3f1a2b9e64
+Revises: 4b7e2d9a1c35
+Create Date: 2026-10-18 14:05:21.473316
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3f1a2b9e64'
+down_revision = '4b7e2d9a1c35'
+branch_labels = None
+depends_on = None
+
+# Samples are looked up by manifest (and by specimen and taxon within a manifest), by their
+# BioSample accession, and by the BioSample accessions that they refer to
+INDEXES = {'ix_sample_manifest_id_specimen_id_taxonomy_id': ['manifest_id', 'specimen_id',
+                                                             'taxonomy_id'],
+           'ix_sample_biosample_accession': ['biosample_accession'],
+           'ix_sample_sample_same_as': ['sample_same_as'],
+           'ix_sample_sample_derived_from': ['sample_derived_from'],
+           'ix_sample_sample_symbiont_of': ['sample_symbiont_of']}
+
+
+def upgrade():
+    for name, columns in INDEXES.items():
+        op.create_index(name, 'sample', columns, schema='public')
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name='sample', schema='public')
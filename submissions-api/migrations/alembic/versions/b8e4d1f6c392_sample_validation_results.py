@@ -0,0 +1,28 @@
+"""sample validation results
+
+Revision ID: b8e4d1f6c392
+Revises: e5c81f4d2a07
+Create Date: 2026-10-18 17:42:09.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e4d1f6c392'
+down_revision = 'e5c81f4d2a07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('sample', sa.Column('validation_hash', sa.String(), nullable=True),
+                  schema='public')
+    op.add_column('sample', sa.Column('validation_results', sa.JSON(), nullable=True),
+                  schema='public')
+
+
+def downgrade():
+    op.drop_column('sample', 'validation_results', schema='public')
+    op.drop_column('sample', 'validation_hash', schema='public')
@@ -0,0 +1,42 @@
+"""job queue
+
+Revision ID: e5c81f4d2a07
+Revises: 7d3f1a2b9e64
+Create Date: 2026-10-18 15:03:27.640115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c81f4d2a07'
+down_revision = '7d3f1a2b9e64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+                    sa.Column('job_id', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(), nullable=False),
+                    sa.Column('manifest_id', sa.Integer(), nullable=False),
+                    sa.Column('created_by', sa.Integer(), nullable=True),
+                    sa.Column('status', sa.String(), nullable=False),
+                    sa.Column('phase', sa.String(), nullable=True),
+                    sa.Column('progress', sa.Integer(), nullable=False),
+                    sa.Column('result', sa.JSON(), nullable=True),
+                    sa.Column('error', sa.String(), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('started_at', sa.DateTime(), nullable=True),
+                    sa.Column('finished_at', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['created_by'], ['user.user_id']),
+                    sa.ForeignKeyConstraint(['manifest_id'], ['manifest.manifest_id']),
+                    sa.PrimaryKeyConstraint('job_id'),
+                    schema='public')
+    op.create_index('ix_job_status_job_id', 'job', ['status', 'job_id'], schema='public')
+
+
+def downgrade():
+    op.drop_index('ix_job_status_job_id', table_name='job', schema='public')
+    op.drop_table('job', schema='public')
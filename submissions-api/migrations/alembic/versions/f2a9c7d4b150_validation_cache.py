@@ -0,0 +1,32 @@
+"""validation cache
+
+Revision ID: f2a9c7d4b150
+Revises: b8e4d1f6c392
+Create Date: 2026-10-18 21:12:45.102338
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a9c7d4b150'
+down_revision = 'b8e4d1f6c392'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('validation',
+                    sa.Column('cache_key', sa.String(), nullable=False),
+                    sa.Column('number_of_errors', sa.Integer(), nullable=False),
+                    sa.Column('validations', sa.JSON(), nullable=False),
+                    sa.Column('expires_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('cache_key'),
+                    schema='public')
+    op.create_index('ix_validation_expires_at', 'validation', ['expires_at'], schema='public')
+
+
+def downgrade():
+    op.drop_index('ix_validation_expires_at', table_name='validation', schema='public')
+    op.drop_table('validation', schema='public')